@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+"""A benchmark of the RPC endpoint DB API under a mixed read/write workload.
+
+By default the benchmark starts its own Gunicorn server, running templates/app.py on a temporary
+database seeded from the db_json folder, and stops it afterwards. The report with throughput and
+latency percentiles per operation is printed, or written to a file, as JSON so that runs before and
+after a change can be compared.
+
+To measure how the API scales with the size of the database, the local server can instead be
+seeded with a synthetic dataset from generate_dataset.py, of a given size or as multiples of the
+seed files' size. The report of a local server also holds the time it took to import the dataset
+into the database and to export it again, locally and over the API. The API, the local import and
+export, and the charm's actions all query the database through templates/db_repository.py, so its
+queries are measured by this one benchmark.
+
+Usage:
+    python3 benchmark_api.py --duration 30 --concurrency 16 --output bench.json
+    python3 benchmark_api.py --url http://localhost:8000 --auth-pw <PW> --write-ratio 0
+    python3 benchmark_api.py --scale 1,10,100 --output scaling.json
+
+    --url: Benchmark an already running API instead of starting a local one
+    --concurrency: Number of client threads sending requests
+    --write-ratio: Share of operations that create and delete records, 0-1
+    --threads, --write-batch-ms: Run the local server's workers with threads, whose writes are batched
+    --synthetic-chains, --synthetic-rpc-urls: Seed the local server with a synthetic dataset of this size
+    --scale: Run one benchmark per factor, each seeded with a synthetic dataset that many times the seed files
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import secrets
+import shutil
+import socket
+import subprocess as sp
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+
+import requests
+
+PATH_REPO = Path(__file__).resolve().parent.parent
+PATH_TEMPLATES = PATH_REPO / 'templates'
+PATH_DEFAULT_CHAINS = PATH_REPO / 'db_json' / 'chains.json'
+PATH_DEFAULT_RPC_URLS = PATH_REPO / 'db_json' / 'rpc_urls.json'
+
+# Relative weights of the read operations, writes are weighted separately through --write-ratio
+READ_WEIGHTS = {
+    'all_chains': 1,
+    'all_rpc_urls': 1,
+    'get_urls': 6,
+    'get_chain_by_url': 6,
+    'chain_info': 6,
+}
+
+sys.path.insert(0, str(PATH_TEMPLATES))
+import db_util  # noqa: E402
+from endpointdb_client import EndpointDBClient  # noqa: E402
+from generate_dataset import generate_dataset  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the RPC endpoint DB API with a mixed read/write workload')
+    parser.add_argument('--url', type=str, help='URL of a running API to benchmark, instead of starting a local one')
+    parser.add_argument('--auth-pw', type=str, help='Auth password of the API given by --url, needed for writes')
+    parser.add_argument('--chains', type=str, default=str(PATH_DEFAULT_CHAINS), help='JSON file with chains to seed with')
+    parser.add_argument('--rpc_urls', type=str, default=str(PATH_DEFAULT_RPC_URLS), help='JSON file with RPC URL:s to seed with')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds to run the workload for, default=10')
+    parser.add_argument('--warmup', type=float, default=1, help='Seconds to run the workload before measuring, default=1')
+    parser.add_argument('--concurrency', type=int, default=8, help='Number of client threads, default=8')
+    parser.add_argument('--workers', type=int, default=2, help='Gunicorn workers of the local server, default=2')
+    parser.add_argument('--threads', type=int, default=1, help='Gunicorn threads per worker of the local server, default=1')
+    parser.add_argument('--write-batch-ms', type=float, default=0,
+                        help='Write batching window of the local server in milliseconds, default=0 for no batching')
+    parser.add_argument('--write-ratio', type=float, default=0.05, help='Share of write operations, default=0.05')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the workload, default=0')
+    parser.add_argument('--synthetic-chains', type=int, help='Seed with this many synthetic chains instead')
+    parser.add_argument('--synthetic-rpc-urls', type=int, help='Number of synthetic RPC URL:s to seed with')
+    parser.add_argument('--scale', type=str, help='Comma separated factors of the seed files\' size to benchmark, e.g. 1,10,100')
+    parser.add_argument('--output', type=str, help='File to write the JSON report to, default is stdout')
+    args = parser.parse_args()
+    if args.url and (args.scale or args.synthetic_chains):
+        parser.error('--scale and --synthetic-chains need a local server, they can\'t be combined with --url')
+
+    chains = db_util.load_json_file(args.chains)
+    rpc_urls = db_util.load_json_file(args.rpc_urls)
+    if args.scale:
+        runs = []
+        for factor in [float(factor) for factor in args.scale.split(',')]:
+            dataset = generate_dataset(round(factor * len(chains)), round(factor * len(rpc_urls)), chains, rpc_urls, args.seed)
+            runs.append(benchmark_dataset(*dataset, args))
+        report = {'scaling': runs}
+    else:
+        if args.synthetic_chains:
+            chains, rpc_urls = generate_dataset(args.synthetic_chains, args.synthetic_rpc_urls, chains, rpc_urls, args.seed)
+        report = benchmark_dataset(chains, rpc_urls, args)
+
+    output = json.dumps(report, indent=4)
+    if args.output:
+        Path(args.output).write_text(output + '\n', encoding='utf-8')
+        print(f'Report written to {args.output}', file=sys.stderr)
+    else:
+        print(output)
+
+
+def benchmark_dataset(chains: list, rpc_urls: list, args) -> dict:
+    """Run the benchmark on the API, on a local server seeded with the dataset unless a URL is given."""
+    if args.url:
+        return run_benchmark(args.url, args.auth_pw, chains, rpc_urls, args)
+    with local_server(chains, rpc_urls, args.workers, args.threads, args.write_batch_ms) as server:
+        report = run_benchmark(server['url'], server['auth_pw'], chains, rpc_urls, args)
+        report['setup'] = {'import_s': server['import_s'], **time_exports(server['url'], server['db_path'])}
+    return report
+
+
+def time_exports(url: str, db_path: Path) -> dict:
+    """Time exports of the database to JSON files, both from the database file and over the API."""
+    with tempfile.TemporaryDirectory(prefix='endpointdb_bench_export_') as tmp_dir:
+        start = time.perf_counter()
+        db_util.local_export_to_json_files(Path(tmp_dir) / 'chains.json', Path(tmp_dir) / 'rpc_urls.json', str(db_path), force=True)
+        export_local_s = time.perf_counter() - start
+        start = time.perf_counter()
+        with EndpointDBClient(url) as client:
+            db_util.api_export_json(Path(tmp_dir) / 'chains.json', client.all_chains(), sort_by='name', force=True)
+            db_util.api_export_json(Path(tmp_dir) / 'rpc_urls.json', client.all_rpc_urls(), sort_by='chain_name', force=True)
+        export_api_s = time.perf_counter() - start
+    return {'export_local_s': round(export_local_s, 3), 'export_api_s': round(export_api_s, 3)}
+
+
+@contextlib.contextmanager
+def local_server(chains: list, rpc_urls: list, workers: int, threads: int = 1, write_batch_ms: float = 0):
+    """Run the app with Gunicorn in a temporary directory, on a database seeded with the chains and RPC URL:s.
+
+    Yields a dict with the URL of the server, its auth password, the path of its database and the
+    time it took to import the dataset.
+    """
+    with tempfile.TemporaryDirectory(prefix='endpointdb_bench_') as tmp_dir:
+        tmp_path = Path(tmp_dir)
+        for template in ('app.py', 'db_schema.py', 'db_repository.py', 'gunicorn.conf.py'):
+            shutil.copy(PATH_TEMPLATES / template, tmp_path / template)
+        auth_pw = secrets.token_hex(32)
+        (tmp_path / 'auth_password').write_text(auth_pw, encoding='utf-8')
+        (tmp_path / 'auth_jwt_secret_key').write_text(secrets.token_hex(32), encoding='utf-8')
+        (tmp_path / 'metrics').mkdir()
+        env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=str(tmp_path / 'metrics'), ENDPOINTDB_WRITE_BATCH_MS=str(write_batch_ms))
+        with listening_socket() as listener:
+            # Gunicorn serves on the socket it's handed, so the port is never free for another process to take
+            server = sp.Popen(
+                ['gunicorn', f'--workers={workers}', f'--threads={threads}', f'--bind=fd://{listener.fileno()}', '--log-level=warning',
+                 'app:app'],
+                cwd=tmp_path, env=env, pass_fds=(listener.fileno(),)
+            )
+            host, port = listener.getsockname()
+            url = f'http://{host}:{port}'
+        try:
+            wait_until_serving(url, server)
+            print(f'Seeding database with {len(chains)} chains and {len(rpc_urls)} RPC URL:s', file=sys.stderr)
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                db_util.local_import_from_json_files(chains, rpc_urls, str(tmp_path / 'live_database.db'))
+            import_s = round(time.perf_counter() - start, 3)
+            yield {'url': url, 'auth_pw': auth_pw, 'db_path': tmp_path / 'live_database.db', 'import_s': import_s}
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+
+
+def listening_socket() -> socket.socket:
+    """Open a socket listening on a port of the loopback interface picked by the OS, to hand to Gunicorn."""
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(128)
+    return listener
+
+
+def wait_until_serving(url: str, server: sp.Popen, timeout: float = 30) -> None:
+    """Wait until the server answers its readiness check, raises if it exits or doesn't answer within the timeout."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f'Gunicorn exited with code {server.returncode} before serving')
+        try:
+            if requests.get(url + '/readyz', timeout=1).status_code == 200:
+                return
+        except requests.exceptions.ConnectionError:
+            pass
+        time.sleep(0.1)
+    raise TimeoutError(f'Server on {url} not serving after {timeout} seconds')
+
+
+# # # WORKLOAD # # #
+
+class Workload:
+    """Picks and sends the benchmark's operations, each one a request or, for writes, a create/delete sequence."""
+
+    def __init__(self, url: str, auth_header: dict, chains: list, rpc_urls: list, write_ratio: float, seed: int):
+        self.url = url
+        self.auth_header = auth_header
+        self.chain_names = [chain['name'] for chain in chains]
+        self.rpc_urls = [rpc_url['url'] for rpc_url in rpc_urls]
+        self.write_ratio = write_ratio if auth_header else 0
+        self.seed = seed
+
+    def run(self, thread_index: int, stop: threading.Event, measure_from: float, results: dict) -> None:
+        """Send operations until stopped, recording those started after measure_from in the thread's results."""
+        rng = random.Random(self.seed + thread_index)
+        session = requests.Session()
+        reads = list(READ_WEIGHTS)
+        weights = list(READ_WEIGHTS.values())
+        while not stop.is_set():
+            if rng.random() < self.write_ratio:
+                self.write(session, rng, measure_from, results)
+            else:
+                operation = rng.choices(reads, weights)[0]
+                self.request(session, operation, *self.read(operation, rng), measure_from, results)
+
+    def read(self, operation: str, rng: random.Random) -> tuple:
+        """Return the method, path and request arguments of a read operation, on a random chain or URL."""
+        if operation == 'all_chains':
+            return 'GET', '/all/chains', {}
+        if operation == 'all_rpc_urls':
+            return 'GET', '/all/rpc_urls', {}
+        if operation == 'get_urls':
+            return 'GET', f'/get_urls/{rng.choice(self.chain_names)}', {}
+        if operation == 'get_chain_by_url':
+            protocol, address = rng.choice(self.rpc_urls).split('://', 1)
+            return 'GET', '/get_chain_by_url', {'params': {'protocol': protocol, 'address': address}}
+        return 'GET', '/chain_info', {'params': {'chain_name': rng.choice(self.chain_names)}}
+
+    def write(self, session: requests.Session, rng: random.Random, measure_from: float, results: dict) -> None:
+        """Create a chain with an RPC URL and delete them again, each request recorded as an operation of its own."""
+        chain = f'benchmark-{uuid.uuid4().hex}'
+        url = f'https://{chain}.example.com'
+        writes = [
+            ('create_chain', 'POST', '/create_chain', {'json': {'name': chain, 'api_class': 'ethereum'}}),
+            ('create_rpc_url', 'POST', '/create_rpc_url', {'json': {'url': url, 'chain_name': chain}}),
+            ('delete_url', 'DELETE', '/delete_url', {'params': {'protocol': 'https', 'address': f'{chain}.example.com'}}),
+            ('delete_chain', 'DELETE', '/delete_chain', {'params': {'name': chain}}),
+        ]
+        if rng.random() < 0.5:
+            # Leave the URL to be deleted along with its chain
+            writes.pop(2)
+        for operation, method, path, kwargs in writes:
+            self.request(session, operation, method, path, dict(kwargs, headers=self.auth_header), measure_from, results)
+
+    def request(self, session, operation, method, path, kwargs, measure_from, results) -> None:
+        """Send one request, recording its latency, and whether it failed, under the operation if measured."""
+        start = time.perf_counter()
+        try:
+            ok = session.request(method, self.url + path, timeout=30, **kwargs).status_code < 500
+        except requests.exceptions.RequestException:
+            ok = False
+        end = time.perf_counter()
+        if start < measure_from:
+            return
+        latencies, errors = results.setdefault(operation, ([], [0]))
+        latencies.append(end - start)
+        if not ok:
+            errors[0] += 1
+
+
+def run_benchmark(url: str, auth_pw: str, chains: list, rpc_urls: list, args) -> dict:
+    auth_header = EndpointDBClient(url, password=auth_pw).auth_header() if auth_pw else {}
+    if not auth_header and args.write_ratio > 0:
+        print('No auth password given, running read operations only', file=sys.stderr)
+    workload = Workload(url, auth_header, chains, rpc_urls, args.write_ratio, args.seed)
+    stop = threading.Event()
+    measure_from = time.perf_counter() + args.warmup
+    thread_results = [{} for _ in range(args.concurrency)]
+    threads = [
+        threading.Thread(target=workload.run, args=(i, stop, measure_from, thread_results[i]), daemon=True)
+        for i in range(args.concurrency)
+    ]
+    print(f'Running workload on {url} for {args.warmup + args.duration} seconds', file=sys.stderr)
+    for thread in threads:
+        thread.start()
+    time.sleep(args.warmup + args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    measured = time.perf_counter() - measure_from
+
+    operations = {}
+    for results in thread_results:
+        for operation, (latencies, errors) in results.items():
+            merged = operations.setdefault(operation, ([], [0]))
+            merged[0].extend(latencies)
+            merged[1][0] += errors[0]
+    return build_report(operations, measured, args, len(chains), len(rpc_urls))
+
+
+def build_report(operations: dict, measured: float, args, chain_count: int, rpc_url_count: int) -> dict:
+    all_latencies = [latency for latencies, _ in operations.values() for latency in latencies]
+    report = {
+        'config': {
+            'url': args.url or 'local',
+            'workers': None if args.url else args.workers,
+            'threads': None if args.url else args.threads,
+            'write_batch_ms': None if args.url else args.write_batch_ms,
+            'concurrency': args.concurrency,
+            'write_ratio': args.write_ratio,
+            'duration_s': args.duration,
+            'chains': chain_count,
+            'rpc_urls': rpc_url_count,
+        },
+        'measured_s': round(measured, 3),
+        'total': summarize(all_latencies, sum(errors[0] for _, errors in operations.values()), measured),
+        'operations': {},
+    }
+    for operation in sorted(operations):
+        latencies, errors = operations[operation]
+        report['operations'][operation] = summarize(latencies, errors[0], measured)
+    return report
+
+
+def summarize(latencies: list, errors: int, measured: float) -> dict:
+    ordered = sorted(latencies)
+    return {
+        'requests': len(ordered),
+        'errors': errors,
+        'throughput_rps': round(len(ordered) / measured, 2) if measured > 0 else 0,
+        'latency_ms': {
+            'mean': round(1000 * sum(ordered) / len(ordered), 3) if ordered else None,
+            'p50': percentile_ms(ordered, 50),
+            'p90': percentile_ms(ordered, 90),
+            'p99': percentile_ms(ordered, 99),
+            'max': round(1000 * ordered[-1], 3) if ordered else None,
+        },
+    }
+
+
+def percentile_ms(ordered: list, percent: float):
+    """Nearest-rank percentile of sorted latencies, in milliseconds."""
+    if not ordered:
+        return None
+    rank = max(1, -(-len(ordered) * percent // 100))
+    return round(1000 * ordered[int(rank) - 1], 3)
+
+
+if __name__ == '__main__':
+    main()
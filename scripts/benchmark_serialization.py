@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""A benchmark of the serialization of the API's largest responses, /all/rpc_urls and /chain_info.
+
+The payloads are queried with templates/db_repository.py, like the routes do, from a temporary
+database seeded with the db_json files or a synthetic dataset from generate_dataset.py. Each
+payload is encoded and decoded with every available format: JSON with the standard library, as
+Flask's default provider does, JSON with orjson, as the app does when it's installed, and msgpack,
+served to clients that send `Accept: application/msgpack`. The report with the median times and
+payload sizes is printed, or written to a file, as JSON.
+
+Usage:
+    python3 benchmark_serialization.py --output serialization.json
+    python3 benchmark_serialization.py --synthetic-chains 15000 --synthetic-rpc-urls 190000
+
+    --chain-name: Chain of the /chain_info payload, default is the one with the most RPC URL:s
+    --repeat: Number of timed runs per payload and format, the median is reported
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+PATH_REPO = Path(__file__).resolve().parent.parent
+PATH_TEMPLATES = PATH_REPO / 'templates'
+PATH_DEFAULT_CHAINS = PATH_REPO / 'db_json' / 'chains.json'
+PATH_DEFAULT_RPC_URLS = PATH_REPO / 'db_json' / 'rpc_urls.json'
+
+sys.path.insert(0, str(PATH_TEMPLATES))
+import db_repository  # noqa: E402
+import db_util  # noqa: E402
+from db_schema import init_database  # noqa: E402
+from generate_dataset import generate_dataset  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the serialization of the API\'s largest responses')
+    parser.add_argument('--chains', type=str, default=str(PATH_DEFAULT_CHAINS), help='JSON file with chains to seed with')
+    parser.add_argument('--rpc_urls', type=str, default=str(PATH_DEFAULT_RPC_URLS), help='JSON file with RPC URL:s to seed with')
+    parser.add_argument('--synthetic-chains', type=int, help='Seed with this many synthetic chains instead')
+    parser.add_argument('--synthetic-rpc-urls', type=int, help='Number of synthetic RPC URL:s to seed with')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the synthetic dataset, default=0')
+    parser.add_argument('--chain-name', type=str, help='Chain of the /chain_info payload, default is the one with the most RPC URL:s')
+    parser.add_argument('--repeat', type=int, default=20, help='Timed runs per payload and format, default=20')
+    parser.add_argument('--output', type=str, help='File to write the JSON report to, default is stdout')
+    args = parser.parse_args()
+
+    chains = db_util.load_json_file(args.chains)
+    rpc_urls = db_util.load_json_file(args.rpc_urls)
+    if args.synthetic_chains:
+        chains, rpc_urls = generate_dataset(args.synthetic_chains, args.synthetic_rpc_urls, chains, rpc_urls, args.seed)
+    payloads = query_payloads(chains, rpc_urls, args.chain_name)
+    available = codecs()
+    report = {
+        'config': {'chains': len(chains), 'rpc_urls': len(rpc_urls), 'repeat': args.repeat},
+        'payloads': {route: benchmark_payload(payload, available, args.repeat) for route, payload in payloads.items()},
+    }
+
+    output = json.dumps(report, indent=4)
+    if args.output:
+        Path(args.output).write_text(output + '\n', encoding='utf-8')
+        print(f'Report written to {args.output}', file=sys.stderr)
+    else:
+        print(output)
+
+
+def query_payloads(chains: list, rpc_urls: list, chain_name: str = None) -> dict:
+    """Seed a temporary database with the dataset, returns the data of the benchmarked routes' responses."""
+    with tempfile.TemporaryDirectory(prefix='endpointdb_bench_serialization_') as tmp_dir:
+        db_file = str(Path(tmp_dir) / 'database.db')
+        init_database(db_file)
+        with contextlib.redirect_stdout(io.StringIO()):
+            db_util.local_import_from_json_files(chains, rpc_urls, db_file)
+        conn = db_repository.connect(db_file)
+        try:
+            all_rpc_urls = db_repository.all_rpc_urls(conn)
+            if not chain_name:
+                url_counts = {}
+                for rpc_url in all_rpc_urls:
+                    url_counts[rpc_url['chain_name']] = url_counts.get(rpc_url['chain_name'], 0) + 1
+                chain_name = max(url_counts, key=url_counts.get)
+            chain_info = db_repository.chain_info(conn, chain_name)
+        finally:
+            conn.close()
+    if chain_info is None:
+        raise ValueError(f'Chain {chain_name} not found')
+    return {'/all/rpc_urls': all_rpc_urls, '/chain_info': chain_info}
+
+
+def codecs() -> dict:
+    """Return the encode and decode functions of the available formats, by name."""
+    available = {
+        # Compact and with sorted keys, like Flask's default JSON provider
+        'json': (lambda data: json.dumps(data, sort_keys=True, separators=(',', ':')).encode(), json.loads),
+    }
+    if orjson is not None:
+        available['orjson'] = (lambda data: orjson.dumps(data, option=orjson.OPT_SORT_KEYS), orjson.loads)
+    else:
+        print('orjson is not installed, skipping it', file=sys.stderr)
+    if msgpack is not None:
+        available['msgpack'] = (msgpack.packb, msgpack.unpackb)
+    else:
+        print('msgpack is not installed, skipping it', file=sys.stderr)
+    return available
+
+
+def benchmark_payload(payload, available: dict, repeat: int) -> dict:
+    """Time encoding and decoding the payload with every available format, returns the medians and sizes."""
+    results = {}
+    for name, (encode, decode) in available.items():
+        body = encode(payload)
+        if decode(body) != payload:
+            raise AssertionError(f'{name} does not round trip the payload')
+        results[name] = {
+            'bytes': len(body),
+            'encode_ms': median_ms(lambda: encode(payload), repeat),
+            'decode_ms': median_ms(lambda: decode(body), repeat),
+        }
+    return results
+
+
+def median_ms(function, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return round(statistics.median(timings) * 1000, 3)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""Generate synthetic chains and RPC URL:s datasets, of any size, for scaling tests of the endpoint DB.
+
+The datasets have the format of the db_json folder, so that they can be imported with db_util.py,
+and they follow the distributions of a real dataset: the API classes of the chains, the number of
+URL:s per chain, and the providers, schemes and paths of the URL:s.
+
+Usage:
+    python3 generate_dataset.py --chains 15000 --rpc-urls 190000 --target /tmp/dataset
+    python3 db_util.py import --chains /tmp/dataset/chains.json --rpc_urls /tmp/dataset/rpc_urls.json -db <DB file>
+
+    --chains: Number of chains to generate
+    --rpc-urls: Number of RPC URL:s to generate, default follows the real URL:s per chain
+    --source: Directory with the real chains.json and rpc_urls.json the distributions are taken from
+"""
+
+import argparse
+import random
+import re
+import sys
+from pathlib import Path
+from urllib.parse import urlparse
+
+PATH_REPO = Path(__file__).resolve().parent.parent
+PATH_DEFAULT_SOURCE = PATH_REPO / 'db_json'
+
+sys.path.insert(0, str(PATH_REPO / 'templates'))
+import db_util  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic chains and RPC URL:s in the db_json format')
+    parser.add_argument('--chains', type=int, required=True, help='Number of chains to generate')
+    parser.add_argument('--rpc-urls', type=int, help='Number of RPC URL:s to generate, at least one per chain')
+    parser.add_argument('--source', type=str, default=str(PATH_DEFAULT_SOURCE),
+                        help=f'Directory with the dataset to take distributions from, default={PATH_DEFAULT_SOURCE}')
+    parser.add_argument('--target', type=str, required=True, help='Directory to write chains.json and rpc_urls.json to')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed, default=0')
+    args = parser.parse_args()
+
+    source_chains = db_util.load_json_file(Path(args.source) / 'chains.json')
+    source_rpc_urls = db_util.load_json_file(Path(args.source) / 'rpc_urls.json')
+    chains, rpc_urls = generate_dataset(args.chains, args.rpc_urls, source_chains, source_rpc_urls, args.seed)
+
+    target = Path(args.target)
+    target.mkdir(parents=True, exist_ok=True)
+    db_util.export_to_file(target / 'chains.json', chains)
+    db_util.export_to_file(target / 'rpc_urls.json', rpc_urls)
+    print(f'Generated {len(chains)} chains and {len(rpc_urls)} RPC URL:s in {target}')
+
+
+def generate_dataset(chain_count: int, rpc_url_count: int, source_chains: list, source_rpc_urls: list,
+                     seed: int = 0) -> tuple:
+    """Generate chains and RPC URL:s following the distributions of the source dataset.
+
+    Each chain is modeled on a random source chain, taking its API class, and gets as many URL:s
+    as a random source chain has. Each URL is modeled on a random source URL, taking its scheme,
+    provider domain and path. If rpc_url_count is given the URL counts are adjusted to add up to it.
+    Returns the lists of chains and RPC URL:s.
+    """
+    if rpc_url_count is not None and rpc_url_count < chain_count:
+        raise ValueError('Every chain needs at least one RPC URL')
+    rng = random.Random(seed)
+    urls_per_chain = {}
+    for rpc_url in source_rpc_urls:
+        urls_per_chain[rpc_url['chain_name']] = urls_per_chain.get(rpc_url['chain_name'], 0) + 1
+    url_counts = [rng.choice(list(urls_per_chain.values())) for _ in range(chain_count)]
+    if rpc_url_count is not None:
+        adjust_counts(url_counts, rpc_url_count, rng)
+
+    chains = []
+    rpc_urls = []
+    width = len(str(chain_count))
+    for index, url_count in enumerate(url_counts):
+        template = rng.choice(source_chains)
+        name = f'{template["name"]} synthetic-{index:0{width}}'
+        chains.append({'name': name, 'api_class': template['api_class']})
+        slug = re.sub(r'[^a-z0-9]+', '-', name.lower()).strip('-')
+        for url_index in range(url_count):
+            url_slug = slug if url_index == 0 else f'{slug}-{url_index}'
+            rpc_urls.append({'url': synthetic_url(rng.choice(source_rpc_urls)['url'], url_slug), 'chain_name': name})
+    return chains, rpc_urls
+
+
+def adjust_counts(counts: list, total: int, rng: random.Random) -> None:
+    """Add or remove one URL at a time from random chains, keeping at least one, until the counts add up to total."""
+    difference = total - sum(counts)
+    while difference != 0:
+        index = rng.randrange(len(counts))
+        if difference > 0:
+            counts[index] += 1
+            difference -= 1
+        elif counts[index] > 1:
+            counts[index] -= 1
+            difference += 1
+
+
+def synthetic_url(template_url: str, slug: str) -> str:
+    """Return a URL for the slug on the template URL's provider, e.g. https://api-x.n.dwellir.com -> https://<slug>.n.dwellir.com.
+
+    Providers serving all chains on one host, like https://1rpc.io/aptos/v1, get the slug in the path instead.
+    """
+    parsed = urlparse(template_url)
+    labels = parsed.hostname.split('.')
+    if len(labels) > 2:
+        return f'{parsed.scheme}://{slug}.{".".join(labels[1:])}{parsed.path}'
+    return f'{parsed.scheme}://{parsed.hostname}/{slug}{parsed.path}'
+
+
+if __name__ == '__main__':
+    main()
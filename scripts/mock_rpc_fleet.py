@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""A local fleet of mock RPC nodes, to benchmark and test the endpoint probes without network access.
+
+One server emulates any number of virtual endpoints, each one answering JSON-RPC over HTTP (POST) and
+WebSocket on its own path: http://<host>:<port>/<api_class>/<index> and ws://<host>:<port>/<api_class>/<index>.
+Every endpoint gets its own latency, error rate and block height drift, derived from the random seed,
+so that a fleet behaves the same between runs.
+
+Usage:
+    python3 mock_rpc_fleet.py --endpoints 2000 --dataset /tmp/mock_fleet
+    python3 ../templates/db_util.py json /tmp/mock_fleet
+    python3 check_endpoint.py --file /tmp/mock_fleet/rpc_urls.json --both
+
+    --endpoints: Number of virtual endpoints, per API class, listed in the dataset
+    --dataset: Directory to write chains.json and rpc_urls.json with the fleet's endpoints to
+    --latency-ms, --jitter-ms: Base response latency of the endpoints, and its random variation
+    --error-rate: Highest share of requests an endpoint fails, each endpoint fails a random share below it
+    --max-drift: Highest number of blocks an endpoint lags behind the head of its chain
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from pathlib import Path
+
+from aiohttp import WSMsgType, web
+
+BLOCK_TIME_S = 6
+GENESIS_HEIGHT = 1_000_000
+API_CLASSES = ['substrate', 'ethereum', 'starknet', 'sui', 'ton']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a local fleet of mock RPC nodes')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Host to listen on, default=127.0.0.1')
+    parser.add_argument('--port', type=int, default=9900, help='Port to listen on, default=9900')
+    parser.add_argument('--endpoints', type=int, default=100, help='Number of virtual endpoints per API class, default=100')
+    parser.add_argument('--latency-ms', type=float, default=20, help='Base response latency in ms, default=20')
+    parser.add_argument('--jitter-ms', type=float, default=10, help='Random variation of the latency in ms, default=10')
+    parser.add_argument('--error-rate', type=float, default=0.05, help='Highest share of failing requests, default=0.05')
+    parser.add_argument('--max-drift', type=int, default=10, help='Highest number of blocks an endpoint lags, default=10')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the endpoint behaviours, default=0')
+    parser.add_argument('--dataset', type=str, help='Directory to write chains.json and rpc_urls.json for the fleet to')
+    args = parser.parse_args()
+
+    fleet = MockFleet(args.latency_ms, args.jitter_ms, args.error_rate, args.max_drift, args.seed)
+    if args.dataset:
+        write_dataset(Path(args.dataset), f'{args.host}:{args.port}', args.endpoints)
+        print(f'Wrote the fleet\'s {args.endpoints * len(API_CLASSES)} endpoints to {args.dataset}')
+    print(f'Serving mock RPC endpoints on http://{args.host}:{args.port}/<api_class>/<index>')
+    web.run_app(fleet.make_app(), host=args.host, port=args.port, print=None)
+
+
+class MockEndpoint:
+    """Behaviour of one virtual endpoint, fixed by the fleet's seed."""
+
+    def __init__(self, rng: random.Random, latency_ms: float, jitter_ms: float, error_rate: float, max_drift: int):
+        self.latency_s = max(0.0, latency_ms + rng.uniform(-jitter_ms, jitter_ms)) / 1000
+        self.jitter_s = jitter_ms / 1000
+        self.error_rate = rng.uniform(0, error_rate)
+        self.drift = rng.randint(0, max_drift)
+        self.rng = rng
+
+    async def respond_delay(self) -> None:
+        await asyncio.sleep(max(0.0, self.latency_s + self.rng.uniform(-self.jitter_s, self.jitter_s) / 2))
+
+    def fails(self) -> bool:
+        return self.rng.random() < self.error_rate
+
+    def height(self, started_at: float) -> int:
+        return GENESIS_HEIGHT + int((time.time() - started_at) / BLOCK_TIME_S) - self.drift
+
+
+class MockFleet:
+    """The fleet of virtual endpoints, served by one aiohttp application."""
+
+    def __init__(self, latency_ms: float, jitter_ms: float, error_rate: float, max_drift: int, seed: int):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.max_drift = max_drift
+        self.seed = seed
+        self.started_at = time.time()
+        self.endpoints = {}
+        self.stats = {'requests': 0, 'errors': 0}
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/stats', self.handle_stats)
+        app.router.add_route('*', '/{api_class}/{index:\\d+}', self.handle_endpoint)
+        return app
+
+    def endpoint(self, api_class: str, index: int) -> MockEndpoint:
+        key = (api_class, index)
+        if key not in self.endpoints:
+            rng = random.Random(f'{self.seed}-{api_class}-{index}')
+            self.endpoints[key] = MockEndpoint(rng, self.latency_ms, self.jitter_ms, self.error_rate, self.max_drift)
+        return self.endpoints[key]
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({**self.stats, 'endpoints_seen': len(self.endpoints)})
+
+    async def handle_endpoint(self, request: web.Request) -> web.StreamResponse:
+        api_class = request.match_info['api_class']
+        if api_class not in API_CLASSES:
+            return web.json_response({'error': f'unknown api class {api_class}'}, status=404)
+        endpoint = self.endpoint(api_class, int(request.match_info['index']))
+        if request.headers.get('Upgrade', '').lower() == 'websocket':
+            return await self.handle_websocket(request, api_class, endpoint)
+        if request.method != 'POST':
+            return web.json_response({'error': 'JSON-RPC requests are sent with POST'}, status=405)
+        try:
+            payload = await request.json()
+        except json.JSONDecodeError:
+            return web.json_response(jsonrpc_error(None, -32700, 'Parse error'), status=400)
+        await endpoint.respond_delay()
+        self.stats['requests'] += 1
+        if endpoint.fails():
+            self.stats['errors'] += 1
+            return web.Response(status=503, text='Service Unavailable')
+        return web.json_response(self.rpc_response(api_class, endpoint, payload))
+
+    async def handle_websocket(self, request: web.Request, api_class: str, endpoint: MockEndpoint) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        async for message in ws:
+            if message.type != WSMsgType.TEXT:
+                break
+            await endpoint.respond_delay()
+            self.stats['requests'] += 1
+            if endpoint.fails():
+                self.stats['errors'] += 1
+                await ws.close(code=1011, message=b'Internal error')
+                break
+            try:
+                payload = json.loads(message.data)
+            except json.JSONDecodeError:
+                await ws.send_json(jsonrpc_error(None, -32700, 'Parse error'))
+                continue
+            await ws.send_json(self.rpc_response(api_class, endpoint, payload))
+        return ws
+
+    def rpc_response(self, api_class: str, endpoint: MockEndpoint, payload: dict) -> dict:
+        request_id = payload.get('id')
+        method = payload.get('method')
+        height = endpoint.height(self.started_at)
+        results = {
+            'substrate': {
+                'chain_getHeader': lambda: {'number': hex(height), 'parentHash': block_hash(api_class, height - 1)},
+                'chain_getBlockHash': lambda: block_hash(api_class, first_param(payload, height)),
+            },
+            'ethereum': {
+                'eth_blockNumber': lambda: hex(height),
+                'eth_chainId': lambda: hex(1),
+            },
+            'starknet': {'starknet_blockNumber': lambda: height},
+            'sui': {'sui_getLatestCheckpointSequenceNumber': lambda: str(height)},
+            'ton': {'getMasterchainInfo': lambda: {'last': {'workchain': -1, 'seqno': height}}},
+        }[api_class]
+        if method not in results:
+            return jsonrpc_error(request_id, -32601, f'Method not found: {method}')
+        return {'jsonrpc': '2.0', 'result': results[method](), 'id': request_id}
+
+
+def jsonrpc_error(request_id, code: int, message: str) -> dict:
+    return {'jsonrpc': '2.0', 'error': {'code': code, 'message': message}, 'id': request_id}
+
+
+def first_param(payload: dict, default):
+    params = payload.get('params') or []
+    return params[0] if params else default
+
+
+def block_hash(api_class: str, height) -> str:
+    return '0x' + random.Random(f'{api_class}-{height}').getrandbits(256).to_bytes(32, 'big').hex()
+
+
+def write_dataset(target: Path, address: str, endpoints: int) -> None:
+    """Write chains and RPC URL:s in the db_json format, one chain per API class, alternating HTTP and WS URL:s."""
+    chains = [{'name': f'Mock {api_class}', 'api_class': api_class} for api_class in API_CLASSES]
+    rpc_urls = []
+    for api_class in API_CLASSES:
+        for index in range(endpoints):
+            scheme = 'http' if index % 2 == 0 else 'ws'
+            rpc_urls.append({'url': f'{scheme}://{address}/{api_class}/{index}', 'chain_name': f'Mock {api_class}'})
+    target.mkdir(parents=True, exist_ok=True)
+    for name, data in (('chains.json', chains), ('rpc_urls.json', rpc_urls)):
+        with open(target / name, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+
+
+if __name__ == '__main__':
+    main()
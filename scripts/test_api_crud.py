@@ -1,13 +1,30 @@
 #!/bin/env python3
 
+import asyncio
+import gzip
+import io
 import os
 import sqlite3
 import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, redirect_stdout
 from pathlib import Path
 import unittest
+from unittest import mock
+
+import msgpack
+from aiohttp import web
+from prometheus_client import REGISTRY
 
 # TODO: fix import path
-from app import app, create_tables_if_not_exist
+from app import ReplicationSettings, app, run_write
+import db_repository
+import db_util
+import endpointdb_client
+import mock_rpc_fleet
+from db_schema import init_database
 
 
 class CRUDTestCase(unittest.TestCase):
@@ -20,6 +37,10 @@ class CRUDTestCase(unittest.TestCase):
     def setUp(self):
         app.config['TESTING'] = True
         self.db_fd, app.config['DATABASE'] = tempfile.mkstemp(prefix='unittest_database_', suffix='.db')
+        self.snapshot_dir = tempfile.TemporaryDirectory(prefix='unittest_snapshots_')
+        app.config['SNAPSHOT_DIR'] = self.snapshot_dir.name
+        self.profile_dir = tempfile.TemporaryDirectory(prefix='unittest_profiles_')
+        app.config['PROFILE_DIR'] = self.profile_dir.name
 
         # Initialize the test database with schema and test data
         with app.app_context():
@@ -34,19 +55,24 @@ class CRUDTestCase(unittest.TestCase):
         # Close the database connection and remove the temporary test database
         os.close(self.db_fd)
         os.unlink(app.config['DATABASE'])
+        self.snapshot_dir.cleanup()
+        self.profile_dir.cleanup()
 
     def init_db(self):
-        # Use the same create_table as for the live database.
-        create_tables_if_not_exist()
+        # Use the same schema init as for the live database.
+        init_database(app.config['DATABASE'])
 
     def populate_db(self):
         conn = sqlite3.connect(app.config['DATABASE'])
         c = conn.cursor()
         c.execute('INSERT INTO chains (name, api_class) VALUES (?, ?)', ('Ethereum mainnet', 'ethereum'))
         c.execute('INSERT INTO chains (name, api_class) VALUES (?, ?)', ('Polkadot', 'substrate'))
-        c.execute('INSERT INTO rpc_urls (url, chain_name) VALUES (?, ?)', ('https://cloudflare-eth.com', 'Ethereum mainnet'))
-        c.execute('INSERT INTO rpc_urls (url, chain_name) VALUES (?, ?)', ('wss://rpc.polkadot.io', 'Polkadot'))
-        c.execute('INSERT INTO rpc_urls (url, chain_name) VALUES (?, ?)', ('https://rpc.polkadot.io', 'Polkadot'))
+        c.execute('INSERT INTO rpc_urls (url, chain_name, host, provider) VALUES (?, ?, ?, ?)',
+                  ('https://cloudflare-eth.com', 'Ethereum mainnet', 'cloudflare-eth.com', 'cloudflare-eth.com'))
+        c.execute('INSERT INTO rpc_urls (url, chain_name, host, provider) VALUES (?, ?, ?, ?)',
+                  ('wss://rpc.polkadot.io', 'Polkadot', 'rpc.polkadot.io', 'polkadot.io'))
+        c.execute('INSERT INTO rpc_urls (url, chain_name, host, provider) VALUES (?, ?, ?, ?)',
+                  ('https://rpc.polkadot.io', 'Polkadot', 'rpc.polkadot.io', 'polkadot.io'))
         conn.commit()
         conn.close()
 
@@ -163,6 +189,70 @@ class CRUDTestCase(unittest.TestCase):
         self.assertIn('wss://rpc.polkadot.io', response.json)  # Defined in setUp()
         self.assertIn('https://rpc.polkadot.io', response.json)  # Defined in setUp()
 
+    def test_get_providers(self):
+        response = self.app.get('/providers')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn({'provider': 'polkadot.io', 'hosts': 1, 'urls': 2, 'disabled_urls': 0}, response.json)
+
+    def test_get_urls_by_host(self):
+        url_data = {'url': 'wss://api-polkadot.n.dwellir.com', 'chain_name': 'Polkadot'}
+        self.app.post('/create_rpc_url', json=url_data, headers=self.auth_header)
+        response = self.app.get('/urls_by_host/api-polkadot.n.dwellir.com')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, [url_data])
+        # Provider lookup matches every host of the provider
+        response = self.app.get('/urls_by_host/dwellir.com')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, [url_data])
+
+    def test_get_urls_by_host_not_found(self):
+        response = self.app.get('/urls_by_host/unknown.host')
+        self.assertEqual(response.status_code, 404)
+
+    def test_disable_and_enable_urls(self):
+        response = self.app.patch('/rpc_urls/disable', json={'urls': ['wss://rpc.polkadot.io']}, headers=self.auth_header)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['updated'], 1)
+        self.assertEqual(self.app.get('/get_urls/Polkadot').json, ['https://rpc.polkadot.io'])
+        response = self.app.get('/get_url', query_string={'protocol': 'wss', 'address': 'rpc.polkadot.io'})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(len(self.app.get('/all/rpc_urls').json), 2)
+        all_urls = self.app.get('/all/rpc_urls', query_string={'include_disabled': 'true'}).json
+        self.assertIn({'url': 'wss://rpc.polkadot.io', 'chain_name': 'Polkadot', 'enabled': False}, all_urls)
+
+        response = self.app.patch('/rpc_urls/enable', json={'host': 'polkadot.io'}, headers=self.auth_header)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['updated'], 1)
+        self.assertEqual(len(self.app.get('/get_urls/Polkadot').json), 2)
+
+    def test_disable_urls_by_chain(self):
+        response = self.app.patch('/rpc_urls/disable', json={'chain_name': 'Polkadot'}, headers=self.auth_header)
+        self.assertEqual(response.json['updated'], 2)
+        response = self.app.get('/chain_info', query_string={'chain_name': 'Polkadot'})
+        self.assertEqual(response.json['urls'], [])
+
+    def test_disable_urls_requires_one_selector(self):
+        data = {'chain_name': 'Polkadot', 'host': 'polkadot.io'}
+        response = self.app.patch('/rpc_urls/disable', json=data, headers=self.auth_header)
+        self.assertEqual(response.status_code, 400)
+
+    def test_disable_urls_rejects_invalid_url_list(self):
+        for data in ({'urls': 'wss://rpc.polkadot.io'}, {'urls': []}, {'urls': ['wss://rpc.polkadot.io', 5]}):
+            response = self.app.patch('/rpc_urls/disable', json=data, headers=self.auth_header)
+            self.assertEqual(response.status_code, 400, data)
+        self.assertEqual(len(self.app.get('/get_urls/Polkadot').json), 2)
+
+    def test_disable_urls_by_empty_chain_name(self):
+        response = self.app.patch('/rpc_urls/disable', json={'chain_name': ''}, headers=self.auth_header)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['updated'], 0)
+
+    def test_disable_urls_rejects_non_string_selector(self):
+        for data in ({'host': 5}, {'chain_name': None}, {'chain_name': ['Polkadot']}):
+            response = self.app.patch('/rpc_urls/disable', json=data, headers=self.auth_header)
+            self.assertEqual(response.status_code, 400, data)
+        self.assertEqual(len(self.app.get('/get_urls/Polkadot').json), 2)
+
     def test_update_url_record(self):
         # Create a new record
         url_data = {
@@ -193,8 +283,63 @@ class CRUDTestCase(unittest.TestCase):
         response = self.app.delete('/delete_chain', query_string=query_string, headers=self.auth_header)
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json['message'], 'Chain record deleted successfully')
+        self.assertEqual(response.json['deleted_urls'], 2)
         all_chains_response = self.app.get('/all/chains')
         self.assertNotIn(query_string['name'], all_chains_response.json)
+        # The urls of the chain are deleted with it
+        all_urls = self.app.get('/all/rpc_urls', query_string={'include_disabled': 'true'}).json
+        self.assertEqual(all_urls, [{'url': 'https://cloudflare-eth.com', 'chain_name': 'Ethereum mainnet'}])
+
+    def test_vacuum_orphans(self):
+        conn = sqlite3.connect(app.config['DATABASE'])  # Foreign keys aren't enforced by default
+        conn.execute('INSERT INTO rpc_urls (url, chain_name) VALUES (?, ?)', ('https://orphan.io', 'Missing chain'))
+        conn.commit()
+        conn.close()
+        response = self.app.post('/vacuum/orphans', headers=self.auth_header)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['deleted_urls'], 1)
+        self.assertEqual(len(self.app.get('/all/rpc_urls').json), 3)
+
+    def test_vacuum_during_writes(self):
+        chains = [{'name': f'Chain {i}', 'api_class': 'substrate'} for i in range(32)]
+
+        def request(chain):
+            client = app.test_client()
+            if chain is None:
+                return client.post('/vacuum/orphans', headers=self.auth_header).status_code
+            return client.post('/create_chain', json=chain, headers=self.auth_header).status_code
+
+        for write_batch_ms in (0, 20):
+            with self.subTest(write_batch_ms=write_batch_ms), mock.patch.dict(app.config, {'WRITE_BATCH_MS': write_batch_ms}):
+                with db_repository.transaction(app.config['DATABASE']) as conn:
+                    db_repository.delete_chains(conn, [chain['name'] for chain in chains])
+                # The vacuums are sent in the middle of the writes, in flight on the other threads
+                requests = chains[:16] + [None] + chains[16:] + [None]
+                with ThreadPoolExecutor(max_workers=8) as executor:
+                    status_codes = list(executor.map(request, requests))
+                self.assertEqual(status_codes, [201] * 16 + [200] + [201] * 16 + [200])
+                self.assertEqual(len(self.app.get('/all/chains').json), 2 + len(chains))
+
+    def test_vacuum_waits_for_write(self):
+        started, release = threading.Event(), threading.Event()
+
+        def slow_write(conn):
+            db_repository.insert_chains(conn, [{'name': 'Slow chain', 'api_class': 'substrate'}])
+            started.set()
+            release.wait(timeout=5)
+            return 1
+
+        with mock.patch.dict(app.config, {'WRITE_BATCH_MS': 20}), ThreadPoolExecutor(max_workers=2) as executor:
+            write = executor.submit(run_write, slow_write)
+            self.assertTrue(started.wait(timeout=5))
+            vacuum = executor.submit(lambda: app.test_client().post('/vacuum/orphans', headers=self.auth_header))
+            # The vacuum waits for the write's transaction rather than failing on the database lock
+            time.sleep(0.2)
+            self.assertFalse(vacuum.done())
+            release.set()
+            self.assertEqual(write.result(timeout=5), 1)
+            self.assertEqual(vacuum.result(timeout=5).status_code, 200)
+        self.assertEqual(self.app.get('/get_chain_by_name/Slow chain').status_code, 200)
 
     def test_delete_url_record(self):
         query_string = {'protocol': 'wss', 'address': 'rpc.polkadot.io'}  # Added in setUp()
@@ -246,11 +391,483 @@ class CRUDTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 404)
         self.assertIn('not found', response.json['error'])
 
+    def test_conditional_get(self):
+        response = self.app.get('/all/rpc_urls')
+        etag = response.headers['ETag']
+        response = self.app.get('/all/rpc_urls', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        # A write changes the data version, so the cached response is no longer current
+        url_data = {'url': 'wss://kusama-rpc.polkadot.io', 'chain_name': 'Polkadot'}
+        self.app.post('/create_rpc_url', json=url_data, headers=self.auth_header)
+        response = self.app.get('/all/rpc_urls', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertIn(url_data, response.json)
+
+    def test_snapshot_reload_keeps_old_connection_open(self):
+        with tempfile.TemporaryDirectory(prefix='unittest_snapshot_') as tmp_dir:
+            path = Path(tmp_dir) / 'snapshot.db'
+            path.write_bytes(self.app.get('/snapshot').get_data())
+            snapshot = endpointdb_client.EndpointDBSnapshot(str(path))
+            self.addCleanup(snapshot.close)
+            rows = snapshot._conn.execute('SELECT url FROM rpc_urls WHERE chain_name = ?', ('Polkadot',))
+            self.app.delete('/delete_chain', query_string={'name': 'Polkadot'}, headers=self.auth_header)
+            tmp_path = path.with_suffix('.tmp')
+            tmp_path.write_bytes(self.app.get('/snapshot').get_data())
+            tmp_path.replace(path)
+
+            self.assertTrue(snapshot.reload())
+            # A lookup on another thread that began before the reload can still read its rows
+            self.assertEqual(len(rows.fetchall()), 2)
+            self.assertEqual(snapshot.urls('Polkadot'), [])
+            old_conn = snapshot._retired[0][1]
+            with mock.patch('time.monotonic', return_value=time.monotonic() + endpointdb_client.SNAPSHOT_CLOSE_GRACE_S + 1):
+                self.assertFalse(snapshot.reload())
+            self.assertEqual(snapshot._retired, [])
+            with self.assertRaises(sqlite3.ProgrammingError):
+                old_conn.execute('SELECT 1')
+
+    def test_names_with_reserved_characters(self):
+        with db_repository.transaction(app.config['DATABASE']) as conn:
+            db_repository.insert_chains(conn, [{'name': 'Parachain?#1', 'api_class': 'substrate'}])
+            db_repository.insert_rpc_urls(conn, [{'url': 'wss://para.io', 'chain_name': 'Parachain?#1'}])
+        name = endpointdb_client.path_segment('Parachain?#1')
+        self.assertEqual(self.app.get(f'/get_chain_by_name/{name}').json['name'], 'Parachain?#1')
+        self.assertEqual(self.app.get(f'/get_urls/{name}').json, ['wss://para.io'])
+
+    def test_errors_have_no_etag(self):
+        response = self.app.get('/get_chain_by_name/nope')
+        self.assertEqual(response.status_code, 404)
+        self.assertNotIn('ETag', response.headers)
+        etag = self.app.get('/all/chains').headers['ETag']
+        response = self.app.get('/get_chain_by_name/nope', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 404)
+
+    def test_msgpack_negotiation(self):
+        response = self.app.get('/all/rpc_urls')
+        self.assertEqual(response.mimetype, 'application/json')
+        json_etag = response.headers['ETag']
+        response = self.app.get('/all/rpc_urls', headers={'Accept': 'application/msgpack'})
+        self.assertEqual(response.mimetype, 'application/msgpack')
+        self.assertIn('Accept', response.headers['Vary'])
+        self.assertEqual(msgpack.unpackb(response.data), self.app.get('/all/rpc_urls').json)
+        # Each representation has an ETag of its own, so a cached JSON response isn't served to a msgpack client
+        self.assertNotEqual(response.headers['ETag'], json_etag)
+        response = self.app.get('/all/rpc_urls', headers={'Accept': 'application/msgpack', 'If-None-Match': json_etag})
+        self.assertEqual(response.status_code, 200)
+        response = self.app.get('/chain_info', query_string={'chain_name': 'Foo'}, headers={'Accept': 'application/msgpack'})
+        self.assertEqual(response.status_code, 404)
+        self.assertIn('not found', msgpack.unpackb(response.data)['error'])
+
+    def test_snapshot(self):
+        response = self.app.get('/snapshot')
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        with tempfile.NamedTemporaryFile(suffix='.db') as snapshot_file:
+            snapshot_file.write(response.get_data())
+            snapshot_file.flush()
+            conn = sqlite3.connect(snapshot_file.name)
+            urls = conn.execute('SELECT url FROM rpc_urls WHERE chain_name = ?', ('Polkadot',)).fetchall()
+            conn.close()
+        self.assertEqual(sorted(urls), [('https://rpc.polkadot.io',), ('wss://rpc.polkadot.io',)])
+        response = self.app.get('/snapshot', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.app.delete('/delete_chain?name=Polkadot', headers=self.auth_header)
+        response = self.app.get('/snapshot', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_metrics(self):
+        self.app.get('/get_urls/Polkadot')
+        response = self.app.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        metrics = response.get_data(as_text=True)
+        self.assertIn('endpointdb_requests_total{method="GET",route="/get_urls/<string:chain_name>",status="200"}', metrics)
+        self.assertIn('endpointdb_table_rows{table="rpc_urls"} 3.0', metrics)
+
+    def test_readiness(self):
+        with mock.patch('app.READY_MAX_LOAD_PER_CPU', float('inf')):  # Independent of the load on the test host
+            response = self.app.get('/readyz')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json['ready'])
+        self.assertEqual(set(response.json['checks']), {'database', 'schema', 'cache', 'load'})
+        self.assertEqual(self.app.get('/healthz').status_code, 200)
+
+    def test_readiness_cache_check(self):
+        self.app.get('/all/chains')
+        cache = self.app.get('/readyz').json['checks']['cache']
+        self.assertTrue(cache['ok'])
+        stale_entries = cache['stale_entries']
+        self.assertGreater(cache['entries'], stale_entries)
+        self.app.delete('/delete_chain', query_string={'name': 'Polkadot'}, headers=self.auth_header)
+        cache = self.app.get('/readyz').json['checks']['cache']
+        self.assertEqual(cache['entries'], cache['stale_entries'])
+        self.assertGreater(cache['stale_entries'], stale_entries)
+
+        # Without its triggers the data version no longer changes on writes, and cached responses would go stale
+        with db_repository.transaction(app.config['DATABASE']) as conn:
+            conn.execute('DROP TRIGGER chains_delete_data_version')
+        with mock.patch('app.READY_MAX_LOAD_PER_CPU', float('inf')):
+            response = self.app.get('/readyz')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json['checks']['cache']['missing_triggers'], ['chains_delete_data_version'])
+
+    def test_readiness_before_init(self):
+        with tempfile.NamedTemporaryFile(suffix='.db') as db_file:
+            app.config['DATABASE'], live_database = db_file.name, app.config['DATABASE']
+            try:
+                response = self.app.get('/readyz')
+            finally:
+                app.config['DATABASE'] = live_database
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(response.json['checks']['schema']['ok'])
+        self.assertFalse(response.json['checks']['cache']['ok'])
+
+    def test_replica_rejects_writes(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as replication_file:
+            replication_file.write('{"writer_url": "http://10.0.0.1:8000"}')
+            replication_file.flush()
+            with mock.patch('app.REPLICATION', ReplicationSettings(Path(replication_file.name))):
+                response = self.app.post('/create_chain', json={'name': 'Kusama', 'api_class': 'substrate'},
+                                         headers=self.auth_header)
+                self.assertEqual(response.status_code, 403)
+                self.assertIn('http://10.0.0.1:8000', response.json['error'])
+                self.assertEqual(self.app.get('/get_chain_by_name/Polkadot').status_code, 200)
+                self.assertEqual(self.app.post('/token', json={'username': self.username, 'password': self.password}).status_code, 200)
+
+    def test_repository_batch_writes(self):
+        self.assertEqual(self.app.get('/get_chain_by_name/Kusama').status_code, 404)  # Cached until the data changes
+        with db_repository.transaction(app.config['DATABASE']) as conn:
+            added = db_repository.insert_chains(conn, [{'name': 'Kusama', 'api_class': 'substrate'},
+                                                       {'name': 'Polkadot', 'api_class': 'substrate'}])
+            added_urls = db_repository.insert_rpc_urls(conn, [{'url': 'wss://kusama-rpc.polkadot.io', 'chain_name': 'Kusama'}])
+        self.assertEqual((added, added_urls), (1, 1))
+        self.assertEqual(self.app.get('/get_urls/Kusama').json, ['wss://kusama-rpc.polkadot.io'])
+        with db_repository.transaction(app.config['DATABASE']) as conn:
+            self.assertEqual(db_repository.delete_chains(conn, ['Kusama', 'Polkadot', 'Unknown']), (2, 3))
+            self.assertEqual(db_repository.delete_rpc_urls(conn, ['https://cloudflare-eth.com']), 1)
+            self.assertEqual(db_repository.list_chains(conn), [{'name': 'Ethereum mainnet', 'api_class': 'ethereum'}])
+            self.assertEqual(db_repository.list_rpc_urls(conn), [])
+
+    def test_repository_lists_are_ordered(self):
+        with db_repository.transaction(app.config['DATABASE']) as conn:
+            db_repository.set_rpc_urls_enabled(conn, False, urls=['https://rpc.polkadot.io'])
+            self.assertEqual([chain['name'] for chain in db_repository.list_chains(conn)], ['Ethereum mainnet', 'Polkadot'])
+            self.assertEqual(db_repository.list_rpc_urls(conn, 'Polkadot'), [
+                {'url': 'https://rpc.polkadot.io', 'chain_name': 'Polkadot', 'enabled': False},
+                {'url': 'wss://rpc.polkadot.io', 'chain_name': 'Polkadot', 'enabled': True},
+            ])
+
+    def test_repository_invalid_batch_writes_nothing(self):
+        with self.assertRaises(ValueError):
+            with db_repository.transaction(app.config['DATABASE']) as conn:
+                db_repository.insert_chains(conn, [{'name': 'Kusama', 'api_class': 'substrate'}])
+                db_repository.insert_rpc_urls(conn, [{'url': 'wss://kusama-rpc.polkadot.io', 'chain_name': 'Kusama'},
+                                                     {'url': 'wss://moonbeam.io', 'chain_name': 'Moonbeam'}])
+        with db_repository.transaction(app.config['DATABASE']) as conn:
+            self.assertIsNone(db_repository.chain_info(conn, 'Kusama'))
+            self.assertEqual(db_repository.chain_info(conn, 'Polkadot')['urls'], ['https://rpc.polkadot.io', 'wss://rpc.polkadot.io'])
+
+    def test_repository_upsert(self):
+        with db_repository.transaction(app.config['DATABASE']) as conn:
+            self.assertEqual(db_repository.upsert_chains(conn, [{'name': 'Polkadot', 'api_class': 'substrate'},
+                                                               {'name': 'Ethereum mainnet', 'api_class': 'sidecar'}]), 1)
+            self.assertEqual(db_repository.upsert_rpc_urls(conn, [{'url': 'wss://rpc.polkadot.io', 'chain_name': 'Ethereum mainnet'},
+                                                                 {'url': 'wss://eth.io', 'chain_name': 'Ethereum mainnet'}]), 2)
+        self.assertEqual(self.app.get('/get_chain_by_name/Ethereum mainnet').json['api_class'], 'sidecar')
+        self.assertEqual(self.app.get('/get_chain_by_url?protocol=wss&address=rpc.polkadot.io').json['name'], 'Ethereum mainnet')
+
+    def test_get_chain_by_id(self):
+        genesis_hash = '0x91b171bb158e2d3848fa23a9f1c25182fb8e20313b2c1eb49219da7a70ce90c3'
+        with db_repository.transaction(app.config['DATABASE']) as conn:
+            db_repository.set_chain_identifiers(conn, [{'name': 'Ethereum mainnet', 'chain_id': 1},
+                                                       {'name': 'Polkadot', 'genesis_hash': genesis_hash}])
+        expected = {'name': 'Ethereum mainnet', 'api_class': 'ethereum', 'chain_id': 1}
+        self.assertEqual(self.app.get('/chain_by_id/1').json, expected)
+        self.assertEqual(self.app.get('/chain_by_id/0x1').json, expected)
+        self.assertEqual(self.app.get(f'/chain_by_id/{genesis_hash.upper()[2:]}').status_code, 400)
+        self.assertEqual(self.app.get(f'/chain_by_id/0x{genesis_hash.upper()[2:]}').json['name'], 'Polkadot')
+        self.assertEqual(self.app.get('/chain_by_id/137').status_code, 404)
+        self.assertEqual(self.app.get('/chain_by_id/polkadot').status_code, 400)
+        self.assertIn(expected, self.app.get('/all/chains').json)
+        self.assertEqual(self.app.get('/chain_info', query_string={'chain_name': 'Polkadot'}).json['genesis_hash'], genesis_hash)
+
+    def test_create_chain_with_identifiers(self):
+        chain = {'name': 'Moonbeam', 'api_class': 'ethereum', 'chain_id': 1284}
+        response = self.app.post('/create_chain', json=chain, headers=self.auth_header)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.app.get('/chain_by_id/1284').json, chain)
+        for invalid in ({'chain_id': -1}, {'chain_id': '1284'}, {'genesis_hash': '0x1234'}):
+            response = self.app.post('/create_chain', json={'name': 'Moonriver', 'api_class': 'ethereum', **invalid},
+                                     headers=self.auth_header)
+            self.assertEqual(response.status_code, 400, invalid)
+        self.assertEqual(self.app.get('/get_chain_by_name/Moonriver').status_code, 404)
+
+    def data_generation(self) -> str:
+        with db_repository.transaction(app.config['DATABASE']) as conn:
+            return db_repository.data_version(conn).split('-')[0]
+
+    def test_backup_and_restore(self):
+        with tempfile.TemporaryDirectory(prefix='unittest_backup_') as tmp_dir:
+            backup_file = Path(tmp_dir) / 'backup.db.gz'
+            checksum = db_util.backup_database(app.config['DATABASE'], backup_file, pages=1)
+            self.assertEqual(db_util.checksum_path(backup_file).read_text(encoding='utf-8').split()[0], checksum)
+            chains = self.app.get('/all/chains').json
+            generation = self.data_generation()
+            self.app.delete('/delete_chain', query_string={'name': 'Polkadot'}, headers=self.auth_header)
+            self.assertEqual(len(self.app.get('/all/chains').json), 1)
+
+            db_util.restore_database(backup_file, app.config['DATABASE'])
+            self.assertEqual(self.app.get('/all/chains').json, chains)
+            self.assertEqual(len(self.app.get('/get_urls/Polkadot').json), 2)
+            # ETags of the data before the restore must never match the restored data
+            self.assertNotEqual(self.data_generation(), generation)
+            self.assertEqual(sorted(os.listdir(tmp_dir)), ['backup.db.gz', 'backup.db.gz.sha256'])
+
+    def test_restore_rejects_checksum_mismatch(self):
+        with tempfile.TemporaryDirectory(prefix='unittest_backup_') as tmp_dir:
+            backup_file = Path(tmp_dir) / 'backup.db.gz'
+            db_util.backup_database(app.config['DATABASE'], backup_file)
+            self.app.delete('/delete_chain', query_string={'name': 'Polkadot'}, headers=self.auth_header)
+            db_util.checksum_path(backup_file).write_text(f'{"0" * 64}  backup.db.gz\n', encoding='utf-8')
+            with self.assertRaisesRegex(ValueError, 'Checksum mismatch'):
+                db_util.restore_database(backup_file, app.config['DATABASE'])
+        self.assertEqual(len(self.app.get('/all/chains').json), 1)
+
+    def assert_restore_leaves_database(self, backup_data: bytes, error: type):
+        """Restore a backup holding the data, unverified, and check that it fails without touching the database."""
+        with tempfile.TemporaryDirectory(prefix='unittest_backup_') as tmp_dir:
+            backup_file = Path(tmp_dir) / 'backup.db.gz'
+            backup_file.write_bytes(backup_data)
+            generation = self.data_generation()
+            with self.assertRaises(error):
+                db_util.restore_database(backup_file, app.config['DATABASE'], verify=False)
+        self.assertEqual(self.data_generation(), generation)
+        self.assertEqual(len(self.app.get('/all/chains').json), 2)
+        target = Path(app.config['DATABASE'])
+        self.assertFalse(target.with_name(f'.{target.name}.restore.tmp').exists())
+
+    def test_restore_rejects_corrupt_gzip(self):
+        self.assert_restore_leaves_database(b'not a gzip file', gzip.BadGzipFile)
+
+    def test_restore_rejects_failed_integrity_check(self):
+        with db_repository.transaction(app.config['DATABASE']) as conn:
+            db_repository.insert_chains(conn, [{'name': 'Integrity', 'api_class': 'substrate'}])
+        with tempfile.TemporaryDirectory(prefix='unittest_backup_') as tmp_dir:
+            backup_file = Path(tmp_dir) / 'backup.db.gz'
+            db_util.backup_database(app.config['DATABASE'], backup_file)
+            database = gzip.decompress(backup_file.read_bytes())
+        self.app.delete('/delete_chain', query_string={'name': 'Integrity'}, headers=self.auth_header)
+        # Renaming the chain in only one of its table row and index entry breaks their consistency
+        database = database.replace(b'Integrity', b'Intrgrity', 1)
+        self.assert_restore_leaves_database(gzip.compress(database), ValueError)
+
+    def test_local_import_skips_urls_of_missing_chains(self):
+        rpc_urls = [{'url': 'wss://quartz.io', 'chain_name': 'Quartz'}, {'url': 'wss://polkadot.dotters.network', 'chain_name': 'Polkadot'}]
+        with redirect_stdout(io.StringIO()) as output:
+            db_util.local_import_from_json_files([], rpc_urls, app.config['DATABASE'])
+        self.assertIn("were skipped: ['quartz']", output.getvalue())
+        self.assertEqual(len(self.app.get('/get_urls/Polkadot').json), 3)
+
+    def test_local_import_rejects_urls_without_chain(self):
+        rpc_urls = [{'url': 'wss://polkadot.dotters.network', 'chain_name': 'Polkadot'}, {'url': 'wss://quartz.io'}]
+        with redirect_stdout(io.StringIO()) as output:
+            db_util.local_import_from_json_files([], rpc_urls, app.config['DATABASE'])
+        self.assertIn('nothing was imported', output.getvalue())
+        self.assertEqual(len(self.app.get('/get_urls/Polkadot').json), 2)
+
+    def test_replace_import(self):
+        target = Path(app.config['DATABASE'])
+        query_objects = "SELECT type, name FROM sqlite_master WHERE type IN ('index', 'trigger') ORDER BY name"
+        with db_repository.transaction(app.config['DATABASE']) as conn:
+            objects = conn.execute(query_objects).fetchall()
+        self.assertEqual({object_type for object_type, _ in objects}, {'index', 'trigger'})
+        etag_file = target.with_name(target.name + '.etag')
+        etag_file.write_text('"replicated-version"', encoding='utf-8')
+        self.addCleanup(etag_file.unlink, missing_ok=True)
+        chains = [{'name': 'Kusama', 'api_class': 'substrate'}, {'name': 'Moonbeam', 'api_class': 'ethereum'}]
+        rpc_urls = [{'url': 'wss://kusama-rpc.polkadot.io', 'chain_name': 'Kusama'}, {'url': 'wss://moonbeam.io', 'chain_name': 'Moonbeam'},
+                    {'url': 'https://moonbeam.io', 'chain_name': 'Moonbeam'}]
+
+        # Open while the database is replaced, like the connections of a running service
+        reader = sqlite3.connect(target)
+        self.addCleanup(reader.close)
+        self.assertEqual(reader.execute('SELECT COUNT(*) FROM chains').fetchone()[0], 2)
+
+        with redirect_stdout(io.StringIO()):
+            db_util.local_import_replace(chains, rpc_urls, str(target))
+        self.assertFalse(etag_file.exists())
+        self.assertEqual([name for name in os.listdir(target.parent) if name.startswith(target.name) or name.startswith(f'.{target.name}')],
+                         [target.name])
+        self.assertEqual(reader.execute("SELECT name FROM chains ORDER BY name").fetchall(), [('Kusama',), ('Moonbeam',)])
+        with db_repository.transaction(app.config['DATABASE']) as conn:
+            self.assertEqual(db_repository.count_rows(conn), {'chains': 2, 'enabled_rpc_urls': 3, 'disabled_rpc_urls': 0})
+            self.assertEqual(conn.execute(query_objects).fetchall(), objects)
+            data_version = conn.execute("SELECT value FROM meta WHERE key = 'data_version'").fetchone()[0]
+        self.assertIsNone(self.app.get('/get_chain_by_name/Polkadot').json.get('name'))
+        # The recreated triggers keep bumping the data version
+        self.app.delete('/delete_url', query_string={'protocol': 'https', 'address': 'moonbeam.io'}, headers=self.auth_header)
+        with db_repository.transaction(app.config['DATABASE']) as conn:
+            self.assertGreater(int(conn.execute("SELECT value FROM meta WHERE key = 'data_version'").fetchone()[0]), int(data_version))
+            self.assertEqual(db_repository.count_rows(conn)['enabled_rpc_urls'], 2)
+
+    def test_replace_import_skips_entries_without_names(self):
+        with tempfile.TemporaryDirectory(prefix='unittest_import_') as tmp_dir:
+            db_file = str(Path(tmp_dir) / 'database.db')
+            chains = [{'api_class': 'ethereum'}, {'name': 'Kusama', 'api_class': 'substrate'}]
+            rpc_urls = [{'url': 'wss://kusama.io'}, {'chain_name': 'Kusama'}, {'url': 'wss://kusama-rpc.polkadot.io', 'chain_name': 'Kusama'}]
+            with redirect_stdout(io.StringIO()):
+                db_util.local_import_replace(chains, rpc_urls, db_file)
+            self.assertEqual(os.listdir(tmp_dir), ['database.db'])
+            with db_repository.transaction(db_file) as conn:
+                self.assertEqual(db_repository.count_rows(conn), {'chains': 1, 'enabled_rpc_urls': 1, 'disabled_rpc_urls': 0})
+
+    def test_failed_replace_import_removes_its_file(self):
+        with mock.patch('db_repository.bulk_load', side_effect=sqlite3.OperationalError('disk I/O error')):
+            with self.assertRaises(sqlite3.OperationalError):
+                db_util.local_import_replace([{'name': 'Kusama', 'api_class': 'substrate'}], [], app.config['DATABASE'])
+        target = Path(app.config['DATABASE'])
+        self.assertFalse(target.with_name(f'.{target.name}.import.tmp').exists())
+        self.assertEqual(len(self.app.get('/all/chains').json), 2)
+
+    def test_repository_chain_identifiers(self):
+        with db_repository.transaction(app.config['DATABASE']) as conn:
+            self.assertEqual(db_repository.set_chain_identifiers(conn, [{'name': 'Ethereum mainnet', 'chain_id': 1}]), 1)
+            # An identifier another chain has is skipped, an unchanged one isn't counted
+            identifiers = [{'name': 'Polkadot', 'chain_id': 1}, {'name': 'Ethereum mainnet', 'chain_id': 1}]
+            self.assertEqual(db_repository.set_chain_identifiers(conn, identifiers), 0)
+            with self.assertRaises(ValueError):
+                db_repository.set_chain_identifiers(conn, [{'name': 'Polkadot', 'genesis_hash': '0x12'}])
+            with self.assertRaises(sqlite3.IntegrityError):
+                db_repository.insert_chains(conn, [{'name': 'Sepolia', 'api_class': 'ethereum', 'chain_id': 1}], skip_existing=False)
+            self.assertIsNone(db_repository.get_chain(conn, 'Polkadot').get('chain_id'))
+
+    def test_identify_chains(self):
+        genesis_hash = '0x' + 'ab' * 32
+
+        def jsonrpc_request(url, method, params, timeout):
+            if url == 'https://rpc.polkadot.io':
+                raise OSError('Connection refused')
+            return {'eth_chainId': '0x1', 'chain_getBlockHash': genesis_hash}[method]
+
+        with mock.patch('db_util.jsonrpc_request', side_effect=jsonrpc_request) as probe, redirect_stdout(io.StringIO()):
+            self.assertEqual(db_util.local_identify_chains(app.config['DATABASE']), 2)
+            self.assertEqual(db_util.local_identify_chains(app.config['DATABASE']), 0)
+        # The chains aren't probed again once identified, and an unreachable URL falls through to the next one
+        self.assertEqual(probe.call_count, 3)
+        self.assertEqual(self.app.get(f'/chain_by_id/{genesis_hash}').json['name'], 'Polkadot')
+
+    def test_identify_chains_from_mock_fleet(self):
+        # A database of its own, the test data's chains would be probed on the network
+        db_fd, db_file = tempfile.mkstemp(prefix='unittest_identify_', suffix='.db')
+        self.addCleanup(os.unlink, db_file)
+        os.close(db_fd)
+        init_database(db_file)
+        with serve_mock_fleet() as address:
+            with db_repository.transaction(db_file) as conn:
+                db_repository.insert_chains(conn, [{'name': 'Mock ethereum', 'api_class': 'ethereum'},
+                                                   {'name': 'Mock substrate', 'api_class': 'substrate'}])
+                db_repository.insert_rpc_urls(conn, [{'url': f'http://{address}/ethereum/0', 'chain_name': 'Mock ethereum'},
+                                                     {'url': f'ws://{address}/substrate/1', 'chain_name': 'Mock substrate'}])
+            with redirect_stdout(io.StringIO()):
+                self.assertEqual(db_util.local_identify_chains(db_file, timeout=2), 2)
+        with db_repository.transaction(db_file) as conn:
+            self.assertEqual(db_repository.get_chain(conn, 'Mock ethereum')['chain_id'], 1)
+            self.assertEqual(db_repository.get_chain(conn, 'Mock substrate')['genesis_hash'], mock_rpc_fleet.block_hash('substrate', 0))
+
+    def test_write_batching(self):
+        chains = [{'name': f'Chain {i}', 'api_class': 'substrate'} for i in range(16)] + [{'name': 'Polkadot', 'api_class': 'substrate'}]
+
+        def create_chain(chain):
+            return app.test_client().post('/create_chain', json=chain, headers=self.auth_header).status_code
+
+        batches_before = REGISTRY.get_sample_value('endpointdb_write_batch_size_count')
+        with mock.patch.dict(app.config, {'WRITE_BATCH_MS': 50}):
+            with ThreadPoolExecutor(max_workers=len(chains)) as executor:
+                status_codes = list(executor.map(create_chain, chains))
+        self.assertEqual(status_codes, [201] * 16 + [400])  # The duplicate is rolled back alone
+        self.assertLess(REGISTRY.get_sample_value('endpointdb_write_batch_size_count') - batches_before, len(chains))
+        self.assertEqual(len(self.app.get('/all/chains').json), 18)
+
+    def test_concurrent_cache_misses_share_one_query(self):
+        all_rpc_urls = db_repository.all_rpc_urls
+        queries = []
+
+        def slow_all_rpc_urls(*args, **kwargs):
+            queries.append(args)
+            time.sleep(0.2)
+            return all_rpc_urls(*args, **kwargs)
+
+        with mock.patch('db_repository.all_rpc_urls', side_effect=slow_all_rpc_urls):
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                responses = list(executor.map(lambda _: app.test_client().get('/all/rpc_urls'), range(8)))
+        self.assertEqual(len(queries), 1)
+        self.assertEqual({response.status_code for response in responses}, {200})
+        self.assertEqual(len({response.get_data() for response in responses}), 1)
+
+    def test_request_id(self):
+        response = self.app.get('/all/chains')
+        self.assertRegex(response.headers['X-Request-ID'], r'^[0-9a-f]{32}$')
+        response = self.app.get('/all/chains', headers={'X-Request-ID': 'client-42'})
+        self.assertEqual(response.headers['X-Request-ID'], 'client-42')
+        response = self.app.get('/all/chains', headers={'X-Request-ID': 'not valid'})
+        self.assertRegex(response.headers['X-Request-ID'], r'^[0-9a-f]{32}$')
+
+    def test_server_timing(self):
+        self.assertNotIn('Server-Timing', self.app.get('/all/rpc_urls').headers)
+        with mock.patch.dict(app.config, {'SERVER_TIMING': True}):
+            response = self.app.post('/create_chain', json={'name': 'Kusama', 'api_class': 'substrate'}, headers=self.auth_header)
+            phases = [metric.split(';')[0] for metric in response.headers['Server-Timing'].split(', ')]
+            self.assertEqual(phases, ['auth', 'db', 'total'])
+            response = self.app.get('/all/rpc_urls')  # A miss, the write changed the data version
+            phases = [metric.split(';')[0] for metric in response.headers['Server-Timing'].split(', ')]
+            self.assertEqual(phases, ['db', 'cache', 'serialize', 'total'])
+            self.assertIn('desc="SQLite"', response.headers['Server-Timing'])
+
+    def test_profile(self):
+        self.assertEqual(self.app.post('/profile', json={'duration': 0.2}).status_code, 401)
+        self.assertEqual(self.app.post('/profile', json={'duration': 600}, headers=self.auth_header).status_code, 400)
+        response = self.app.post('/profile', json={'duration': 0.3, 'interval_ms': 1}, headers=self.auth_header)
+        self.assertEqual(response.status_code, 202)
+        profile_id = response.json['id']
+        self.assertEqual(self.app.post('/profile', json={'duration': 0.3}, headers=self.auth_header).status_code, 409)
+        self.assertEqual(self.app.get(f'/profile/{profile_id}', headers=self.auth_header).status_code, 202)
+        time.sleep(0.5)
+        response = self.app.get(f'/profile/{profile_id}', headers=self.auth_header)
+        self.assertEqual(response.status_code, 200)
+        stacks = response.get_data(as_text=True).splitlines()
+        self.assertTrue(stacks)
+        for stack in stacks:
+            self.assertRegex(stack, r'^[^;]+;.+ \d+$')
+        self.assertTrue(any('test_profile (test_api_crud.py:' in stack for stack in stacks))
+        self.assertEqual(self.app.get('/profile/unknown', headers=self.auth_header).status_code, 404)
+
     def test_jwt_protection(self):
         url_data = {'url': 'http://some.chain.rpc', 'chain_name': 'SomeChain'}
         response_failure = self.app.post('/create_rpc_url', json=url_data)  # No auth header leads to failure
         self.assertEqual(response_failure.status_code, 401)
 
 
+@contextmanager
+def serve_mock_fleet():
+    """Serve a fleet of mock RPC nodes that always answer at once, on a free port, yields its address."""
+    fleet = mock_rpc_fleet.MockFleet(latency_ms=0, jitter_ms=0, error_rate=0, max_drift=0, seed=0)
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(fleet.make_app())
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    loop.run_until_complete(site.start())
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    try:
+        host, port = runner.addresses[0][:2]
+        yield f'{host}:{port}'
+    finally:
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result(timeout=5)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout=5)
+        loop.close()
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -5,12 +5,13 @@
 # Learn more at: https://juju.is/docs/sdk
 
 
+import json
 import logging
 import shutil
 import subprocess as sp
-import time
 
 import ops
+import requests
 from ops.charm import ActionEvent, CharmBase
 from ops.model import ActiveStatus, MaintenanceStatus, ModelError, WaitingStatus
 
@@ -31,18 +32,27 @@ class EndpointDBCharm(CharmBase):
         self.framework.observe(self.on.stop, self._on_stop)
         self.framework.observe(self.on.update_status, self._on_update_status)
         self.framework.observe(self.on.upgrade_charm, self._on_upgrade_charm)
+        self.framework.observe(self.on.leader_elected, self._on_leader_elected)
+        self.framework.observe(self.on[c.PEER_RELATION].relation_changed, self._on_replicas_relation_changed)
 
         # API actions
         self.framework.observe(self.on.get_access_token_action, self._on_get_access_token_action)
-        # TODO: before committing to below, figure out how to make use of db_util in both charm and in-containter without introducing code duplication
-        # TODO: add chain
-        # TODO: add RPC
-        # TODO: list chains
-        # TODO: list RPCs
-        # TODO: show chain info
-        # TODO: delete RPC
-        # TODO: delete chain
-        # TODO: import from JSON (with/without overwrite protection?)
+        # Database actions, run by db_util.py on the database file in one transaction each
+        self.framework.observe(self.on.add_chains_action, self._on_add_chains_action)
+        self.framework.observe(self.on.add_rpc_urls_action, self._on_add_rpc_urls_action)
+        self.framework.observe(self.on.list_chains_action, self._on_list_chains_action)
+        self.framework.observe(self.on.list_rpc_urls_action, self._on_list_rpc_urls_action)
+        self.framework.observe(self.on.chain_info_action, self._on_chain_info_action)
+        self.framework.observe(self.on.delete_rpc_urls_action, self._on_delete_rpc_urls_action)
+        self.framework.observe(self.on.delete_chains_action, self._on_delete_chains_action)
+        self.framework.observe(self.on.identify_chains_action, self._on_identify_chains_action)
+        self.framework.observe(self.on.import_json_action, self._on_import_json_action)
+        # Backup actions
+        self.framework.observe(self.on.backup_action, self._on_backup_action)
+        self.framework.observe(self.on.restore_action, self._on_restore_action)
+        # Diagnostics actions
+        self.framework.observe(self.on.set_query_profiling_action, self._on_set_query_profiling_action)
+        self.framework.observe(self.on.profile_action, self._on_profile_action)
         # File actions
         self.framework.observe(self.on.get_auth_password_action, self._on_get_auth_password_action)
         self.framework.observe(self.on.set_auth_password_action, self._on_set_auth_password_action)
@@ -58,40 +68,62 @@ class EndpointDBCharm(CharmBase):
         self.unit.status = MaintenanceStatus('Installing script and service')
         self.install_files()
         util.generate_auth_files()
-        util.update_service_args(self.config.get('wsgi-server-port'), c.SERVICE_NAME, c.GUNICORN_HARDCODED_ARGS, False)
+        self.update_service_args(reload=False)
+        util.init_database()
         self.import_db_from_resources()
         self.unit.status = ActiveStatus('Installation complete')
 
     def install_files(self) -> None:
+        """Install the app, its scripts and its systemd units from the charm's templates."""
         self.copy_template_files()
         util.install_service_file(f'templates/etc/systemd/system/{c.SERVICE_NAME}.service', c.SERVICE_NAME)
+        util.install_service_file(f'templates/etc/systemd/system/{c.REPLICA_SERVICE_NAME}.service', c.REPLICA_SERVICE_NAME)
+        util.install_timer_file(f'templates/etc/systemd/system/{c.REPLICA_SERVICE_NAME}.timer', c.REPLICA_SERVICE_NAME)
+        util.install_service_file(f'templates/etc/systemd/system/{c.IDENTIFY_SERVICE_NAME}.service', c.IDENTIFY_SERVICE_NAME)
+        util.install_timer_file(f'templates/etc/systemd/system/{c.IDENTIFY_SERVICE_NAME}.timer', c.IDENTIFY_SERVICE_NAME)
         util.create_env_file_for_service(c.SERVICE_NAME)
 
+    def update_service_args(self, reload: bool) -> None:
+        """Write the service's arguments from the charm's config, reloading the service if reload."""
+        util.update_service_args(self.config.get('wsgi-server-port'), c.SERVICE_NAME, c.GUNICORN_HARDCODED_ARGS, reload,
+                                 write_batch_ms=self.config.get('write-batch-ms'), server_timing=self.config.get('server-timing'))
+
     def copy_template_files(self) -> None:
+        """Copy the app and the modules it shares with db_util.py to the unit's home directory."""
         shutil.copy(self.charm_dir / 'templates/app.py', c.APP_SCRIPT_PATH)
         shutil.copy(self.charm_dir / 'templates/db_util.py', c.DB_UTIL_SCRIPT_PATH)
+        shutil.copy(self.charm_dir / 'templates/endpointdb_client.py', c.CLIENT_LIBRARY_PATH)
+        shutil.copy(self.charm_dir / 'templates/db_schema.py', c.DB_SCHEMA_MODULE_PATH)
+        shutil.copy(self.charm_dir / 'templates/db_repository.py', c.DB_REPOSITORY_MODULE_PATH)
+        shutil.copy(self.charm_dir / 'templates/gunicorn.conf.py', c.GUNICORN_CONFIG_PATH)
 
     def import_db_from_resources(self) -> None:
+        """Replace the database with the resources' chains and RPC URL:s, built in a new file and copied in."""
         try:
             rpc_chains_path = self.model.resources.fetch('rpc-chains')
             rpc_urls_path = self.model.resources.fetch('rpc-urls')
-            rpc_chains = util.load_json_file(rpc_chains_path)
-            rpc_urls = util.load_json_file(rpc_urls_path)
-            util.start_service(c.SERVICE_NAME)  # Start service to initialize DB before import
-            time.sleep(5)  # Give service time to initialize DB
-            util.local_import_from_json_files(rpc_chains, rpc_urls, str(c.DATABASE_PATH))
-        except (NameError, ModelError) as e:
+            util.import_database(rpc_chains_path, rpc_urls_path)
+        except (NameError, ModelError, sp.CalledProcessError) as e:
             logger.error('Error trying to import DB from resources: %s', e)
 
     def _on_config_changed(self, event: ops.ConfigChangedEvent):
         """Handle changed configuration."""
         self.unit.status = MaintenanceStatus('Updating config')
-        util.update_service_args(self.config.get('wsgi-server-port'), c.SERVICE_NAME, c.GUNICORN_HARDCODED_ARGS, True)
+        self.update_service_args(reload=True)
+        self.configure_replication()
         self.unit.status = ActiveStatus('Configuration updated')
 
     def _on_start(self, event: ops.StartEvent):
         """Handle start event."""
         util.start_service(c.SERVICE_NAME)
+        self.wait_until_ready()
+
+    def wait_until_ready(self) -> None:
+        """Wait for the app to report ready, and set the unit's status by whether it did."""
+        if util.wait_until_ready(self.config.get('wsgi-server-port')):
+            self.unit.status = ActiveStatus('Service running')
+        else:
+            self.unit.status = WaitingStatus('Service not ready')
 
     def _on_stop(self, event: ops.StopEvent):
         """Handle stop event."""
@@ -102,14 +134,55 @@ class EndpointDBCharm(CharmBase):
         if not util.service_running(c.SERVICE_NAME):
             self.unit.status = WaitingStatus("Service not yet started")
             return
-        self.unit.status = ActiveStatus("Service running")
+        ready, failing_checks = util.check_readiness(self.config.get('wsgi-server-port'))
+        if not ready:
+            self.unit.status = WaitingStatus(f"Service not ready, failing: {', '.join(failing_checks) or 'unknown'}")
+            return
+        writer_url = util.replicated_writer_url()
+        if writer_url:
+            self.unit.status = ActiveStatus(f"Service running, read-only replica of {writer_url}")
+        elif self.unit.is_leader():
+            self.unit.status = ActiveStatus("Service running")
+        else:
+            self.unit.status = WaitingStatus("Service running, waiting for the leader's writer URL")
 
     def _on_upgrade_charm(self, event: ops.UpgradeCharmEvent):
-        """Handle charm upgrade."""
-        util.stop_service(c.SERVICE_NAME)
+        """Handle charm upgrade, reloading the running service without dropping requests."""
+        self.unit.status = MaintenanceStatus('Upgrading')
         self.install_files()
-        util.update_service_args(self.config.get('wsgi-server-port'), c.SERVICE_NAME, c.GUNICORN_HARDCODED_ARGS, False)
-        util.start_service(c.SERVICE_NAME)
+        self.update_service_args(reload=False)
+        util.init_database()
+        util.reload_service(c.SERVICE_NAME)
+        self.wait_until_ready()
+
+    def _on_leader_elected(self, event: ops.LeaderElectedEvent):
+        """Handle leader election, the leader unit becomes the writer the other units replicate."""
+        self.configure_replication()
+
+    def _on_replicas_relation_changed(self, event: ops.RelationChangedEvent):
+        """Handle changes to the peer relation, e.g. a new writer URL published by the leader."""
+        self.configure_replication()
+
+    def configure_replication(self) -> None:
+        """Make the leader unit the writer, and the other units read-only replicas of it.
+
+        The leader publishes its API's URL in the peer relation's application data. The other units
+        replace their database with the writer's snapshot whenever it changes, see the endpointdb-replica
+        timer, and reject writes. Only the writer probes new chains for their identifiers, see the
+        endpointdb-identify timer, the replicas get them with the writer's snapshot.
+        """
+        relation = self.model.get_relation(c.PEER_RELATION)
+        if self.unit.is_leader():
+            util.disable_replication()
+            util.enable_timer(c.IDENTIFY_SERVICE_NAME)
+            if relation:
+                address = self.model.get_binding(relation).network.ingress_address
+                relation.data[self.app]['writer-url'] = f'http://{address}:{self.config.get("wsgi-server-port")}'
+            return
+        util.disable_timer(c.IDENTIFY_SERVICE_NAME)
+        writer_url = relation.data[self.app].get('writer-url') if relation else None
+        if writer_url:
+            util.enable_replication(writer_url)
 
     def _on_get_access_token_action(self, event: ActionEvent) -> None:
         event.log("Getting API access token...")
@@ -119,6 +192,166 @@ class EndpointDBCharm(CharmBase):
             logger.error('Error trying to get the API access token: %s', e)
             event.fail("Unable to get API access token")
 
+    def _on_add_chains_action(self, event: ActionEvent) -> None:
+        """Add chains to the database, skipping those that already exist."""
+        if not self.writable(event):
+            return
+        event.log("Adding chains...")
+        try:
+            chains = util.load_json_list(event.params['chains'])
+            event.set_results(results=util.run_database_action('add_chains', {'chains': chains}))
+        except ValueError as e:
+            logger.error('Error trying to add chains: %s', e)
+            event.fail(f"Unable to add chains, none were added: {e}")
+
+    def _on_add_rpc_urls_action(self, event: ActionEvent) -> None:
+        """Add RPC URL:s to the database, skipping those that already exist."""
+        if not self.writable(event):
+            return
+        event.log("Adding RPC URL:s...")
+        try:
+            rpc_urls = util.load_json_list(event.params['rpc-urls'])
+            event.set_results(results=util.run_database_action('add_rpc_urls', {'rpc_urls': rpc_urls}))
+        except ValueError as e:
+            logger.error('Error trying to add RPC URL:s: %s', e)
+            event.fail(f"Unable to add RPC URL:s, none were added: {e}")
+
+    def _on_list_chains_action(self, event: ActionEvent) -> None:
+        """List the chains in the database."""
+        try:
+            chains = util.run_database_action('list_chains', {})['chains']
+            event.set_results(results={'chains': json.dumps(chains), 'count': len(chains)})
+        except ValueError as e:
+            logger.error('Error trying to list chains: %s', e)
+            event.fail(f"Unable to list chains: {e}")
+
+    def _on_list_rpc_urls_action(self, event: ActionEvent) -> None:
+        """List the RPC URL:s in the database, of all chains or one."""
+        try:
+            rpc_urls = util.run_database_action('list_rpc_urls', {'chain': event.params.get('chain', '')})['rpc_urls']
+            event.set_results(results={'rpc-urls': json.dumps(rpc_urls), 'count': len(rpc_urls)})
+        except ValueError as e:
+            logger.error('Error trying to list RPC URL:s: %s', e)
+            event.fail(f"Unable to list RPC URL:s: {e}")
+
+    def _on_chain_info_action(self, event: ActionEvent) -> None:
+        """Show a chain with its API class and enabled RPC URL:s."""
+        try:
+            info = util.run_database_action('chain_info', {'chain': event.params['chain']})['chain']
+        except ValueError as e:
+            logger.error('Error trying to get chain info: %s', e)
+            event.fail(f"Unable to get chain info: {e}")
+            return
+        if not info:
+            event.fail(f"Chain '{event.params['chain']}' not found in database")
+            return
+        event.set_results(results={'chain-name': info['chain_name'], 'api-class': info['api_class'], 'urls': json.dumps(info['urls'])})
+
+    def _on_delete_rpc_urls_action(self, event: ActionEvent) -> None:
+        """Delete RPC URL:s from the database."""
+        if not self.writable(event):
+            return
+        event.log("Deleting RPC URL:s...")
+        try:
+            urls = util.load_json_list(event.params['urls'])
+            event.set_results(results=util.run_database_action('delete_rpc_urls', {'urls': urls}))
+        except ValueError as e:
+            logger.error('Error trying to delete RPC URL:s: %s', e)
+            event.fail(f"Unable to delete RPC URL:s, none were deleted: {e}")
+
+    def _on_delete_chains_action(self, event: ActionEvent) -> None:
+        """Delete chains from the database, together with their RPC URL:s."""
+        if not self.writable(event):
+            return
+        event.log("Deleting chains and their RPC URL:s...")
+        try:
+            names = util.load_json_list(event.params['chains'])
+            result = util.run_database_action('delete_chains', {'chains': names})
+            event.set_results(results={'deleted-chains': result['deleted_chains'], 'deleted-urls': result['deleted_urls']})
+        except ValueError as e:
+            logger.error('Error trying to delete chains: %s', e)
+            event.fail(f"Unable to delete chains, none were deleted: {e}")
+
+    def _on_identify_chains_action(self, event: ActionEvent) -> None:
+        """Probe the chains' RPC URL:s for their chain ID:s and genesis hashes."""
+        if not self.writable(event):
+            return
+        event.log("Probing the chains' RPC URL:s for their identifiers...")
+        try:
+            event.set_results(results={'result': util.identify_chains(event.params['all'])})
+        except sp.CalledProcessError as e:
+            logger.error('Error trying to identify chains: %s', e)
+            event.fail(f"Unable to identify chains: {e}")
+
+    def _on_import_json_action(self, event: ActionEvent) -> None:
+        """Import chains and RPC URL:s into the database, skipping or updating those that already exist."""
+        if not self.writable(event):
+            return
+        event.log("Importing chains and RPC URL:s...")
+        try:
+            chains = util.load_json_list(event.params['chains'])
+            rpc_urls = util.load_json_list(event.params['rpc-urls'])
+            result = util.run_database_action('import', {'chains': chains, 'rpc_urls': rpc_urls, 'upsert': event.params['upsert']})
+        except ValueError as e:
+            logger.error('Error trying to import chains and RPC URL:s: %s', e)
+            event.fail(f"Unable to import, nothing was imported: {e}")
+            return
+        event.set_results(results={'chains': result['chains'], 'rpc-urls': result['rpc_urls'],
+                                   'skipped-chains': result['skipped_chains'], 'skipped-rpc-urls': result['skipped_rpc_urls'],
+                                   'skipped-orphans': result['orphans'], 'missing-chains': json.dumps(result['missing_chains'])})
+
+    def writable(self, event: ActionEvent) -> bool:
+        """Fail the action if the unit is a read-only replica, whose database is replaced by the writer's.
+
+        Decided from the same replication settings as the app's rejection of writes, see util.replicated_writer_url.
+        """
+        writer_url = util.replicated_writer_url()
+        if writer_url:
+            event.fail(f"This unit is a read-only replica, run on the leader unit, the writer at {writer_url}")
+            return False
+        return True
+
+    def _on_backup_action(self, event: ActionEvent) -> None:
+        """Back up the live database to a compressed, checksummed file."""
+        event.log("Backing up database...")
+        try:
+            event.set_results(results=util.backup_database(event.params['target-dir'], event.params['pages']))
+        except (sp.CalledProcessError, OSError) as e:
+            logger.error('Error trying to back up the database: %s', e)
+            event.fail(f"Unable to back up database: {e}")
+
+    def _on_restore_action(self, event: ActionEvent) -> None:
+        """Restore the live database from a backup, after verifying its checksum."""
+        if not self.writable(event):
+            return
+        event.log("Restoring database...")
+        try:
+            util.restore_database(event.params['backup-file'])
+            event.set_results(results={'restored-from': event.params['backup-file']})
+        except sp.CalledProcessError as e:
+            logger.error('Error trying to restore the database: %s', e.stderr)
+            event.fail(f"Unable to restore database: {e.stderr.strip().splitlines()[-1] if e.stderr else e}")
+
+    def _on_set_query_profiling_action(self, event: ActionEvent) -> None:
+        """Turn the app's query profiling on or off, without restarting the service."""
+        event.log("Setting query profiling...")
+        try:
+            util.set_query_profiling(event.params['enabled'], event.params['threshold-ms'])
+            event.set_results(results={'enabled': event.params['enabled'], 'threshold-ms': event.params['threshold-ms']})
+        except (OSError, ValueError) as e:
+            logger.error('Error trying to set query profiling: %s', e)
+            event.fail(f"Unable to set query profiling: {e}")
+
+    def _on_profile_action(self, event: ActionEvent) -> None:
+        """Profile one of the app's workers and return the path of the profile."""
+        event.log(f"Profiling a worker for {event.params['duration']} s...")
+        try:
+            event.set_results(results=util.profile_worker(self.config.get('wsgi-server-port'), event.params['duration'],
+                                                          event.params['interval-ms']))
+        except (requests.exceptions.RequestException, TimeoutError) as e:
+            logger.error('Error trying to profile a worker: %s', e)
+            event.fail(f"Unable to profile a worker: {e}")
+
     def _on_get_auth_password_action(self, event: ActionEvent) -> None:
         event.log("Getting API auth password...")
         try:
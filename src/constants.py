@@ -4,18 +4,31 @@ from pathlib import Path
 
 # Strings
 SERVICE_NAME = 'endpointdb'
+REPLICA_SERVICE_NAME = 'endpointdb-replica'
+IDENTIFY_SERVICE_NAME = 'endpointdb-identify'
+PEER_RELATION = 'replicas'
 APP_SCRIPT_NAME = 'app.py'
-GUNICORN_HARDCODED_ARGS = '--workers=2 --access-logfile=- app:app'
+GUNICORN_HARDCODED_ARGS = '--access-logfile=- app:app'
+GUNICORN_WORKERS = 2
+# Threads per worker while write batching is enabled, their concurrent writes share a transaction
+GUNICORN_THREADS = 8
 DATABASE_USERNAME = 'dwellir_endpointdb'
 
 # Paths
 HOME_PATH = Path('/home/ubuntu')
 APP_SCRIPT_PATH = HOME_PATH / APP_SCRIPT_NAME
 DB_UTIL_SCRIPT_PATH = HOME_PATH / 'db_util.py'
+CLIENT_LIBRARY_PATH = HOME_PATH / 'endpointdb_client.py'
+DB_SCHEMA_MODULE_PATH = HOME_PATH / 'db_schema.py'
+DB_REPOSITORY_MODULE_PATH = HOME_PATH / 'db_repository.py'
+GUNICORN_CONFIG_PATH = HOME_PATH / 'gunicorn.conf.py'
+GUNICORN_SETTINGS_PATH = HOME_PATH / 'gunicorn_settings.json'
 JWT_SECRET_KEY_PATH = HOME_PATH / 'auth_jwt_secret_key'
 AUTH_PASSWORD_PATH = HOME_PATH / 'auth_password'
 DATABASE_PATH = HOME_PATH / 'live_database.db'
-
-# Database
-TABLE_CHAINS = 'chains'
-TABLE_RPC_URLS = 'rpc_urls'
+QUERY_PROFILING_PATH = HOME_PATH / 'query_profiling.json'
+# Written by the app's sampling profiler, see the profile action
+PROFILES_PATH = HOME_PATH / 'profiles'
+REPLICATION_PATH = HOME_PATH / 'replication.json'
+# Written next to a replicated database, with the ETag of the snapshot it was replaced by
+REPLICA_ETAG_PATH = HOME_PATH / 'live_database.db.etag'
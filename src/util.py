@@ -2,9 +2,11 @@
 
 import json
 import shutil
-import sqlite3
 import subprocess as sp
+import time
+from datetime import datetime, timezone
 from pathlib import Path
+from typing import Optional
 
 import requests
 
@@ -27,6 +29,12 @@ def install_service_file(source_path: str, service_name: str) -> None:
     sp.run(['systemctl', 'daemon-reload'], check=False)
 
 
+def install_timer_file(source_path: str, timer_name: str) -> None:
+    target_path = Path(f'/etc/systemd/system/{timer_name.lower()}.timer')
+    shutil.copyfile(source_path, target_path)
+    sp.run(['systemctl', 'daemon-reload'], check=False)
+
+
 def create_env_file_for_service(service_name: str) -> None:
     with open(f'/etc/default/{service_name.lower()}', 'w', encoding='utf-8') as f:
         f.write(f"{service_name.upper()}_CLI_ARGS=''")
@@ -48,6 +56,73 @@ def set_jwt_secret_key(key: str) -> None:
             f.write(key)
 
 
+def set_query_profiling(enabled: bool, threshold_ms: float) -> None:
+    """Write the query profiling settings, which the app's workers pick up without a restart."""
+    if threshold_ms < 0:
+        raise ValueError('The slow query threshold must not be negative')
+    tmp_path = c.QUERY_PROFILING_PATH.with_suffix('.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'enabled': enabled, 'threshold_ms': threshold_ms}, f)
+    tmp_path.replace(c.QUERY_PROFILING_PATH)
+
+
+def profile_worker(wsgi_server_port: str, duration: float, interval_ms: float) -> dict:
+    """Profile one of the app's workers through its API and wait for the profile, returns the profile's file and worker."""
+    url = f'http://localhost:{wsgi_server_port}'
+    headers = {'Authorization': f'Bearer {get_access_token(url)}'}
+    response = requests.post(url + '/profile', json={'duration': duration, 'interval_ms': interval_ms}, headers=headers, timeout=5)
+    if response.status_code != 202:
+        raise requests.exceptions.HTTPError(f"Couldn't start a profile, {response.text}")
+    profile = response.json()
+    deadline = time.monotonic() + duration + 30
+    while time.monotonic() < deadline:
+        time.sleep(1)
+        # The profile is written to a file shared by the workers, so any of them can answer
+        response = requests.get(f"{url}/profile/{profile['id']}", headers=headers, timeout=5)
+        if response.status_code == 200:
+            return {'path': str(c.PROFILES_PATH / f"{profile['id']}.folded"), 'pid': profile['pid'],
+                    'stacks': len(response.text.splitlines())}
+        if response.status_code != 202:
+            raise requests.exceptions.HTTPError(f"Couldn't get profile {profile['id']}, {response.text}")
+    raise TimeoutError(f"Profile {profile['id']} didn't finish in time")
+
+
+def enable_timer(timer_name: str) -> None:
+    sp.run(['systemctl', 'enable', '--now', f'{timer_name}.timer'], check=False)
+
+
+def disable_timer(timer_name: str) -> None:
+    sp.run(['systemctl', 'disable', '--now', f'{timer_name}.timer'], check=False)
+
+
+def enable_replication(writer_url: str) -> None:
+    """Make the unit a read-only replica of the writer, replacing its database with the writer's snapshots."""
+    with open(c.REPLICATION_PATH, 'w', encoding='utf-8') as f:
+        json.dump({'writer_url': writer_url}, f)
+    enable_timer(c.REPLICA_SERVICE_NAME)
+
+
+def replicated_writer_url() -> Optional[str]:
+    """Return the URL of the writer the unit replicates, or None if the unit isn't a read-only replica.
+
+    The app reads the same file to decide whether to reject writes, so the unit is a replica for both once
+    replication is configured with a writer URL.
+    """
+    try:
+        with open(c.REPLICATION_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f).get('writer_url')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def disable_replication() -> None:
+    """Make the unit the writer, keeping the database as last replicated."""
+    disable_timer(c.REPLICA_SERVICE_NAME)
+    c.REPLICATION_PATH.unlink(missing_ok=True)
+    # The database now changes locally, so it must not be taken as up to date with any future writer's snapshot
+    c.REPLICA_ETAG_PATH.unlink(missing_ok=True)
+
+
 def is_valid_hex(string: str) -> bool:
     try:
         int(string, 16)
@@ -56,7 +131,15 @@ def is_valid_hex(string: str) -> bool:
         return False
 
 
-# TODO: merge usage with get_auth_header in db_util.py?
+def load_json_list(value: str) -> list:
+    """Parse an action parameter holding a JSON list, raises ValueError if it isn't one."""
+    parsed = json.loads(value)
+    if not isinstance(parsed, list):
+        raise ValueError(f"Expected a JSON list, got {type(parsed).__name__}")
+    return parsed
+
+
+# TODO: merge usage with EndpointDBClient.token in endpointdb_client.py?
 def get_access_token(url: str, password: str = "") -> str:
     if not password:
         with open(c.AUTH_PASSWORD_PATH, 'r', encoding='utf-8') as f:
@@ -71,68 +154,97 @@ def get_access_token(url: str, password: str = "") -> str:
     return token_response.json()["access_token"]
 
 
-# TODO: merge usage with local_import_from_json_files in db_util.py?
-def local_import_from_json_files(chains: dict, rpc_urls: dict, db_file: str) -> None:
-    """Imports data from JSON files into an SQLite database.
-    Assumes the JSON files has a specific format, see `db_json` folder in this repository.
+def import_database(chains_file: str, rpc_urls_file: str) -> None:
+    """Replace the database with the chains and RPC URL:s in the JSON files, copied in one step by db_util.py."""
+    sp.run(['python3', c.DB_UTIL_SCRIPT_PATH, 'import', '--chains', chains_file, '--rpc_urls', rpc_urls_file,
+            '--target_db', c.DATABASE_PATH, '--replace'], cwd=c.HOME_PATH, check=True)
+
+
+def run_database_action(name: str, params: dict) -> dict:
+    """Run a database action with db_util.py, in one transaction on the database file, returns the action's results.
+
+    Raises ValueError with db_util.py's error if the action failed, in which case nothing was written.
     """
-    conn = sqlite3.connect(db_file)
-    conn.execute('PRAGMA foreign_keys = ON')
-    cursor = conn.cursor()
-
-    if chains:
-        unique_chain_counter = 0
-        for entry in chains:
-            name = entry['name']
-            api_class = entry['api_class']
-            query = f'INSERT INTO {c.TABLE_CHAINS} (name, api_class) VALUES (?, ?)'
-            values = (name, api_class)
-            try:
-                cursor.execute(query, values)
-                print(f'> Added chain {entry["name"]}')
-            except sqlite3.IntegrityError as e:
-                if "UNIQUE constraint failed" in str(e):
-                    unique_chain_counter = unique_chain_counter + 1
-        if unique_chain_counter > 0:
-            print(f"{unique_chain_counter} chains already existing in the database were skipped")
-
-    if rpc_urls:
-        unique_rpc_counter = 0
-        for entry in rpc_urls:
-            url = entry['url']
-            chain_name = entry['chain_name']
-            query = f'INSERT INTO {c.TABLE_RPC_URLS} (url, chain_name) VALUES (?, ?)'
-            values = (url, chain_name)
-            try:
-                cursor.execute(query, values)
-                print(f'> Added RPC URL {entry["url"]}')
-            except sqlite3.IntegrityError as e:
-                if "UNIQUE constraint failed" in str(e):
-                    unique_rpc_counter = unique_rpc_counter + 1
-        if unique_rpc_counter > 0:
-            print(f"{unique_rpc_counter} RPC URL:s already existing in the database were skipped")
-
-    conn.commit()
-    conn.close()
-
-
-# TODO: merge usage with load_json_file in db_util.py?
-def load_json_file(filepath: Path):
+    result = sp.run(['python3', c.DB_UTIL_SCRIPT_PATH, 'action', name, '--target_db', c.DATABASE_PATH], input=json.dumps(params),
+                    cwd=c.HOME_PATH, check=False, stdout=sp.PIPE, stderr=sp.PIPE, text=True)
+    if result.returncode != 0:
+        lines = result.stderr.strip().splitlines()
+        raise ValueError(lines[-1].removeprefix('Error: ') if lines else f'db_util.py exited with {result.returncode}')
+    return json.loads(result.stdout)
+
+
+def identify_chains(probe_all: bool) -> str:
+    """Probe the chains' RPC URL:s for their identifiers with db_util.py, returns its summary of the result."""
+    args = ['python3', c.DB_UTIL_SCRIPT_PATH, 'identify', '--target_db', c.DATABASE_PATH] + (['--all'] if probe_all else [])
+    result = sp.run(args, cwd=c.HOME_PATH, check=True, stdout=sp.PIPE, text=True)
+    return result.stdout.strip().splitlines()[-1].lstrip('> ')
+
+
+def init_database() -> None:
+    """Create the database or migrate it to the current schema, with the same code the app uses."""
+    sp.run(['python3', c.DB_UTIL_SCRIPT_PATH, 'init', '--target_db', c.DATABASE_PATH], cwd=c.HOME_PATH, check=True)
+
+
+def backup_database(target_dir: str, pages: int) -> dict:
+    """Back up the live database with db_util.py, returns the path, checksum and size of the backup."""
+    timestamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    target = Path(target_dir) / f'endpointdb-{timestamp}.db.gz'
+    sp.run(['python3', c.DB_UTIL_SCRIPT_PATH, 'backup', '--source_db', c.DATABASE_PATH, '--target', target, '--pages', str(pages)],
+           cwd=c.HOME_PATH, check=True)
+    checksum = target.with_name(target.name + '.sha256').read_text(encoding='utf-8').split()[0]
+    return {'path': str(target), 'sha256': checksum, 'size': target.stat().st_size}
+
+
+def restore_database(backup_file: str) -> None:
+    """Restore the live database from a backup with db_util.py, which verifies the backup's checksum first."""
+    sp.run(['python3', c.DB_UTIL_SCRIPT_PATH, 'restore', backup_file, '--target_db', c.DATABASE_PATH],
+           cwd=c.HOME_PATH, check=True, stderr=sp.PIPE, text=True)
+
+
+def check_readiness(wsgi_server_port: str, timeout: float = 2) -> tuple:
+    """Poll the app's readiness endpoint, returns whether it reports ready and the names of its failing checks."""
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            result = json.load(f)
-    except FileNotFoundError as e:
-        print(e)
-        result = None
-    return result
+        response = requests.get(f'http://localhost:{wsgi_server_port}/readyz', timeout=timeout)
+    except requests.exceptions.RequestException:
+        return False, ['unreachable']
+    try:
+        checks = response.json().get('checks', {})
+    except ValueError:
+        checks = {}
+    failing = [name for name, check in checks.items() if not check.get('ok')]
+    return response.status_code == 200, failing
+
 
+def wait_until_ready(wsgi_server_port: str, timeout: float = 30) -> bool:
+    """Poll the app's readiness endpoint until it reports ready, returns whether it did before the timeout."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if check_readiness(wsgi_server_port, timeout=1)[0]:
+            return True
+        time.sleep(0.2)
+    return False
 
-def update_service_args(wsgi_server_port: str, service_name: str, hardcoded_args: str, restart: bool) -> None:
-    args = f"{service_name.upper()}_CLI_ARGS='{hardcoded_args} --bind=0.0.0.0:{wsgi_server_port}'"
+
+def update_service_args(wsgi_server_port: str, service_name: str, hardcoded_args: str, reload: bool, write_batch_ms: float = 0,
+                        server_timing: bool = False) -> None:
+    """Write the service's arguments, the ones that can change go to the Gunicorn settings applied on reload.
+
+    With write batching the workers run several threads, whose concurrent writes the app commits together.
+    """
+    args = f"{service_name.upper()}_CLI_ARGS='{hardcoded_args}'"
     with open(f'/etc/default/{service_name.lower()}', 'w', encoding='utf-8') as f:
         f.write(args)
-    if restart:
-        restart_service(service_name)
+    settings = {
+        'bind': f'0.0.0.0:{wsgi_server_port}',
+        'workers': c.GUNICORN_WORKERS,
+        'threads': c.GUNICORN_THREADS if write_batch_ms > 0 else 1,
+        'write_batch_ms': write_batch_ms,
+        'server_timing': server_timing,
+    }
+    with open(c.GUNICORN_SETTINGS_PATH, 'w', encoding='utf-8') as f:
+        json.dump(settings, f)
+    if reload:
+        reload_service(service_name)
 
 
 def start_service(service_name: str) -> None:
@@ -147,6 +259,11 @@ def restart_service(service_name: str) -> None:
     sp.run(['systemctl', 'restart', f'{service_name.lower()}.service'], check=False)
 
 
+def reload_service(service_name: str) -> None:
+    """Reload the service gracefully if it's running, or start it if it isn't."""
+    sp.run(['systemctl', 'reload-or-restart', f'{service_name.lower()}.service'], check=False)
+
+
 def service_running(service_name: str) -> bool:
     service_status = sp.run(['service', f'{service_name.lower()}', 'status'], stdout=sp.PIPE, check=False).returncode
     return service_status == 0
@@ -2,20 +2,65 @@
 
 """Application to manage a database of blockchain endpoints."""
 
+import abc
+import fcntl
+import functools
+import json
 import logging
+import os
+import queue
+import re
 import sqlite3
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Future
 from pathlib import Path
-from urllib.parse import urlparse
 
-from flask import Flask, Response, jsonify, request
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required
+from flask import Flask, Response, g, has_request_context, jsonify, request, send_file
+from flask.json.provider import DefaultJSONProvider
+from flask_jwt_extended import JWTManager, create_access_token, verify_jwt_in_request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from prometheus_client.core import GaugeMetricFamily
+
+try:
+    import orjson
+except ImportError:  # Flask's default JSON provider, with the standard library's encoder, is used instead
+    orjson = None
+try:
+    import msgpack
+except ImportError:  # The read routes only answer with JSON
+    msgpack = None
+
+import db_repository
+from db_schema import (
+    SCHEMA_VERSION,
+    TABLE_CHAINS,
+    TABLE_RPC_URLS,
+    init_database,
+    missing_data_version_triggers,
+    schema_version,
+)
 
-TABLE_CHAINS = "chains"
-TABLE_RPC_URLS = "rpc_urls"
 PATH_DIR = Path(__file__).resolve().parent
 PATH_DB = PATH_DIR / "live_database.db"
 PATH_JWT_SECRET_KEY = PATH_DIR / "auth_jwt_secret_key"
 PATH_PASSWORD = PATH_DIR / "auth_password"
+PATH_QUERY_PROFILING = PATH_DIR / "query_profiling.json"
+PATH_SNAPSHOTS = PATH_DIR / "snapshots"
+PATH_PROFILES = PATH_DIR / "profiles"
+PATH_REPLICATION = PATH_DIR / "replication.json"
 
 logging.basicConfig(level=logging.INFO)
 
@@ -30,28 +75,994 @@ if not PATH_JWT_SECRET_KEY.exists():
 
 # FLASK APP SETUP
 
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider serializing with orjson, which is several times faster than the standard library's encoder.
+
+    Keys are sorted like with the default provider, and the output is compact, UTF-8 encoded JSON.
+    """
+
+    def dumps(self, obj, **kwargs) -> str:
+        return self.dumps_bytes(obj).decode()
+
+    def dumps_bytes(self, obj) -> bytes:
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_SORT_KEYS if self.sort_keys else 0)
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs) -> Response:
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self.dumps_bytes(obj) + b"\n", mimetype=self.mimetype)
+
+
 app = Flask(__name__)
+if orjson is not None:
+    app.json = OrjsonProvider(app)
 app.config["DATABASE"] = str(PATH_DB)
+app.config["SNAPSHOT_DIR"] = str(PATH_SNAPSHOTS)
+app.config["PROFILE_DIR"] = str(PATH_PROFILES)
+# Window in milliseconds over which concurrent writes are batched into one transaction, 0 disables batching
+app.config["WRITE_BATCH_MS"] = float(os.environ.get("ENDPOINTDB_WRITE_BATCH_MS", "0"))
+# Whether responses carry a Server-Timing header with the breakdown of the time spent handling the request
+app.config["SERVER_TIMING"] = os.environ.get("ENDPOINTDB_SERVER_TIMING", "0") == "1"
 with PATH_JWT_SECRET_KEY.open() as jwt_file:
     JWT_SECRET_KEY = jwt_file.read().strip()
 app.config["JWT_SECRET_KEY"] = JWT_SECRET_KEY
 jwt = JWTManager(app)
 
 
-# DATABASE SETUP
+# METRICS
+
+# Gunicorn workers write their metrics to files in this directory, aggregated when scraped
+PROMETHEUS_MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+
+REQUEST_COUNT = Counter(
+    "endpointdb_requests_total", "Number of HTTP requests handled", ["route", "method", "status"]
+)
+REQUEST_LATENCY = Histogram(
+    "endpointdb_request_duration_seconds",
+    "Time spent handling HTTP requests",
+    ["route", "method"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+QUERY_LATENCY = Histogram(
+    "endpointdb_sqlite_query_duration_seconds",
+    "Time spent executing SQLite statements and fetching their rows",
+    ["statement"],
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0),
+)
+
+
+CACHE_LOOKUPS = Counter(
+    "endpointdb_response_cache_lookups_total",
+    "Lookups in the response cache of the read routes, not_modified being conditional requests answered with 304 "
+    "and coalesced being misses that got the response of a concurrent request's query",
+    ["result"],
+)
+WRITE_BATCH_SIZE = Histogram(
+    "endpointdb_write_batch_size",
+    "Number of writes committed together in one transaction while write batching is enabled",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256),
+)
+QUERY_LOCK_WAIT = Histogram(
+    "endpointdb_sqlite_lock_wait_seconds",
+    "Time spent waiting for the database write lock, recorded while query profiling is enabled",
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0, 5.0),
+)
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that records the time spent in SQLite by statement type, and profiles statements on demand."""
+
+    profile = None
+
+    def execute(self, sql, parameters=()):
+        return self._run(sql, super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._run(sql, super().executemany, sql, seq_of_parameters)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(0 if row is None else 1, time.perf_counter() - start)
+        return row
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(len(rows), time.perf_counter() - start)
+        return rows
+
+    def _run(self, sql, method, *args):
+        traced_from = len(self.connection.traced)
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            duration = time.perf_counter() - start
+            QUERY_LATENCY.labels(statement_type(sql)).observe(duration)
+            record_timing("db", duration)
+            if self.connection.profiling:
+                self.profile = QueryProfile(sql, duration, self.connection.traced[traced_from:])
+
+    def _fetched(self, rows: int, duration: float) -> None:
+        QUERY_LATENCY.labels("FETCH").observe(duration)
+        record_timing("db", duration)
+        if self.profile:
+            self.profile.rows += rows
+            self.profile.duration += duration
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection that hands out instrumented cursors, also for its execute shortcuts.
+
+    While query profiling is enabled the connection traces the statements SQLite runs, which includes
+    the BEGIN statements of its transactions and the statements with their parameters expanded.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.traced = []
+        self.profiling = QUERY_PROFILING.enabled
+        if self.profiling:
+            self.set_trace_callback(self.trace)
+
+    def trace(self, statement: str) -> None:
+        self.traced.append((time.perf_counter(), statement))
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+class DatabaseCollector:
+    """Collects the row counts of the database tables when the metrics are scraped."""
+
+    def collect(self):
+        rows = GaugeMetricFamily("endpointdb_table_rows", "Number of rows in the database tables", labels=["table"])
+        conn = connect_db()
+        counts = db_repository.count_rows(conn)
+        conn.close()
+        rows.add_metric([TABLE_CHAINS], counts["chains"])
+        rows.add_metric([TABLE_RPC_URLS], counts["enabled_rpc_urls"] + counts["disabled_rpc_urls"])
+        yield rows
+        urls = GaugeMetricFamily("endpointdb_rpc_urls", "Number of RPC urls by state", labels=["state"])
+        urls.add_metric(["enabled"], counts["enabled_rpc_urls"])
+        urls.add_metric(["disabled"], counts["disabled_rpc_urls"])
+        yield urls
+
+
+DATABASE_REGISTRY = CollectorRegistry(auto_describe=False)
+DATABASE_REGISTRY.register(DatabaseCollector())
+
+
+def connect_db() -> sqlite3.Connection:
+    """Open a connection to the database, with its statements instrumented.
+
+    Transactions take the write lock when they begin, which makes the wait for it measurable.
+    """
+    return db_repository.connect(app.config["DATABASE"], factory=InstrumentedConnection)
+
+
+def statement_type(sql: str) -> str:
+    """Return the type of an SQL statement, i.e. its first keyword."""
+    return sql.lstrip().split(maxsplit=1)[0].upper() if sql.strip() else "EMPTY"
+
+
+@app.before_request
+def start_request_timer() -> None:
+    """Note the start time and the ID of the request, for the latency metrics and the logs."""
+    g.request_start = time.perf_counter()
+    g.request_id = request_id()
+    QUERY_PROFILING.refresh()
+
+
+@app.after_request
+def record_request_metrics(response: Response) -> Response:
+    """Count the request and record its latency, labeled by the route rule rather than the full path."""
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    duration = time.perf_counter() - g.request_start
+    REQUEST_LATENCY.labels(route, request.method).observe(duration)
+    REQUEST_COUNT.labels(route, request.method, response.status_code).inc()
+    response.headers[REQUEST_ID_HEADER] = g.request_id
+    if app.config["SERVER_TIMING"]:
+        response.headers["Server-Timing"] = server_timing(g.get("timings", {}), duration)
+    return response
+
+
+# REQUEST TIMING
+
+# The ID of a request is echoed in this response header, and logged by Gunicorn with the request, see gunicorn.conf.py
+REQUEST_ID_HEADER = "X-Request-ID"
+# Request ID:s given by clients are used if they're reasonably short and plain
+VALID_REQUEST_ID = re.compile(r"[A-Za-z0-9._:-]{1,128}")
+# Phases of the Server-Timing breakdown, with their descriptions
+TIMING_PHASES = {
+    "auth": "JWT verification",
+    "db": "SQLite",
+    "cache": "Response cache",
+    "serialize": "Serialization",
+}
+
+
+def request_id() -> str:
+    """Return the ID of the request, the one in its X-Request-ID header if it's valid or a new one."""
+    given = request.headers.get(REQUEST_ID_HEADER, "")
+    return given if VALID_REQUEST_ID.fullmatch(given) else uuid.uuid4().hex
+
+
+def record_timing(phase: str, duration: float) -> None:
+    """Add time spent in a phase of handling the request, one of TIMING_PHASES, to its Server-Timing breakdown.
+
+    Time spent outside of a request, e.g. by the writer thread of the write queue, isn't recorded.
+    """
+    if has_request_context():
+        timings = g.setdefault("timings", {})
+        timings[phase] = timings.get(phase, 0.0) + duration
+
+
+@contextmanager
+def timed(phase: str):
+    """Record the time spent in the block as time spent in the phase."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_timing(phase, time.perf_counter() - start)
+
+
+def server_timing(timings: dict, total: float) -> str:
+    """Return the Server-Timing header value of the phases' timings and the total time, in milliseconds."""
+    metrics = [
+        f'{phase};dur={timings[phase] * 1000:.3f};desc="{description}"'
+        for phase, description in TIMING_PHASES.items()
+        if phase in timings
+    ]
+    metrics.append(f"total;dur={total * 1000:.3f}")
+    return ", ".join(metrics)
+
+
+def authenticated(view):
+    """Require a valid access token for the route, like flask_jwt_extended's jwt_required(), timing its verification."""
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        with timed("auth"):
+            verify_jwt_in_request()
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics() -> Response:
+    """Expose the app's metrics in the Prometheus text format, aggregated over all Gunicorn workers.
+
+    curl 'http://localhost:5000/metrics'
+    """
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry) + generate_latest(DATABASE_REGISTRY), mimetype=CONTENT_TYPE_LATEST)
+
+
+# QUERY PROFILING
+
+
+class SettingsFile(abc.ABC):
+    """Settings read from a JSON file that can be changed while the app is running, e.g. by a charm action.
+
+    Each worker checks the file for changes at most once per CHECK_INTERVAL seconds, and applies the
+    settings it holds, or no settings if the file doesn't exist.
+    """
+
+    CHECK_INTERVAL = 1.0
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._mtime = None
+        self._checked_at = float("-inf")
+
+    def refresh(self) -> None:
+        """Re-read the settings if the file has changed since the last check."""
+        now = time.monotonic()
+        if now - self._checked_at < self.CHECK_INTERVAL:
+            return
+        self._checked_at = now
+        try:
+            mtime = self.path.stat().st_mtime
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._mtime:
+            return
+        self._mtime = mtime
+        settings = {}
+        if mtime is not None:
+            try:
+                settings = json.loads(self.path.read_text())
+            except (OSError, ValueError) as e:
+                app.logger.error("Couldn't read settings from %s: %s", self.path, e)
+        self.apply(settings)
+
+    @abc.abstractmethod
+    def apply(self, settings: dict) -> None:
+        """Apply the settings read from the file, an empty dict if it doesn't exist or can't be read.
+
+        Called on every change of the file, so the subclass must reset what the settings leave out to its defaults.
+        """
+
+
+class QueryProfilingSettings(SettingsFile):
+    """Query profiling settings, from a file holding JSON like {"enabled": true, "threshold_ms": 100}.
+
+    The file is written by the charm's set-query-profiling action.
+    """
+
+    def __init__(self, path: Path):
+        super().__init__(path)
+        self.enabled = False
+        self.threshold_ms = 100.0
+
+    def apply(self, settings: dict) -> None:
+        self.enabled = bool(settings.get("enabled", False))
+        self.threshold_ms = float(settings.get("threshold_ms", 100.0))
+        app.logger.info("Query profiling enabled=%s, slow query threshold %s ms", self.enabled, self.threshold_ms)
+
+
+QUERY_PROFILING = QueryProfilingSettings(PATH_QUERY_PROFILING)
+
+
+class QueryProfile:
+    """Profile of one statement: its text, time spent executing and fetching, rows returned and lock wait."""
+
+    def __init__(self, sql: str, duration: float, traced: list):
+        # The traced statements have their parameters expanded, the BEGIN of an implicit transaction
+        # runs right before the statement itself and blocks until the write lock is taken
+        statements = [statement for _, statement in traced]
+        self.sql = statements[-1] if statements else sql
+        self.duration = duration
+        self.rows = 0
+        self.lock_wait = 0.0
+        if statement_type(sql) == "BEGIN":
+            self.lock_wait = duration
+        elif len(traced) > 1 and statement_type(traced[0][1]) == "BEGIN":
+            self.lock_wait = traced[1][0] - traced[0][0]
+        if self.lock_wait:
+            QUERY_LOCK_WAIT.observe(self.lock_wait)
+        if has_request_context():
+            g.setdefault("query_profiles", []).append(self)
+
+
+@app.teardown_request
+def log_slow_queries(exception=None) -> None:
+    """Log the profiled statements of the request that took longer than the slow query threshold."""
+    for profile in g.pop("query_profiles", []):
+        duration_ms = profile.duration * 1000
+        if duration_ms >= QUERY_PROFILING.threshold_ms:
+            app.logger.warning(
+                "SLOW QUERY %.2f ms (lock wait %.2f ms, %s rows) in %s %s, request %s: %s",
+                duration_ms,
+                profile.lock_wait * 1000,
+                profile.rows,
+                request.method,
+                request.path,
+                g.get("request_id"),
+                profile.sql,
+            )
+
+
+# RESPONSE CACHE
+
+
+class ResponseCache:
+    """Responses of the read routes, each one valid for as long as the data version it was made from.
+
+    Every worker has its own cache, holding at most max_entries responses in least recently used order.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, version: str):
+        """Return the (body, mimetype) of a cached response of the data version, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1:]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def count_versions(self, version: str) -> tuple:
+        """Return the numbers of cached responses of the data version and of older ones, which are never served."""
+        with self._lock:
+            current = sum(1 for entry in self._entries.values() if entry[0] == version)
+            return current, len(self._entries) - current
+
+    def put(self, key: str, version: str, body: bytes, mimetype: str) -> None:
+        with self._lock:
+            self._entries[key] = (version, body, mimetype)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+RESPONSE_CACHE = ResponseCache(max_entries=1024)
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one, whose result all of the callers get.
+
+    Used for the misses of the response cache, so that when the data changes the worker's threads
+    requesting the same response wait for one query rather than all querying the database at once.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function) -> tuple:
+        """Return the result of the function and whether it was shared from a call with the same key in flight.
+
+        The function is only called if there's no such call. An exception it raises is shared the same way.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+        if not leader:
+            return call.result(), True
+        try:
+            call.set_result(function())
+        except BaseException as e:  # Also wakes the waiting callers if the worker is interrupted
+            call.set_exception(e)
+        finally:
+            with self._lock:
+                del self._calls[key]
+        return call.result(), False
+
+
+RESPONSE_FLIGHTS = SingleFlight()
+
+
+JSON_MIMETYPE = "application/json"
+MSGPACK_MIMETYPE = "application/msgpack"
+
+
+def response_mimetype() -> str:
+    """Return the mimetype a read route answers the request with, msgpack if the client prefers it and it's installed."""
+    if msgpack is not None and request.accept_mimetypes.best_match([JSON_MIMETYPE, MSGPACK_MIMETYPE]) == MSGPACK_MIMETYPE:
+        return MSGPACK_MIMETYPE
+    return JSON_MIMETYPE
+
+
+def serialize(data, mimetype: str) -> bytes:
+    """Return the data of a read route serialized as JSON, with the app's JSON provider, or msgpack."""
+    if mimetype == MSGPACK_MIMETYPE:
+        return msgpack.packb(data)
+    return app.json.response(data).get_data()
+
+
+def cached_response(view):
+    """Serve a read route from the response cache, and tag its responses with the data version as ETag.
+
+    The route returns its data, optionally with a status code, which is serialized as JSON or, if the
+    request's Accept header prefers application/msgpack, as msgpack. Only successful responses are cached
+    and tagged, every representation with an ETag of its own. Conditional requests with a matching
+    If-None-Match header are answered with 304 Not Modified.
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        conn = connect_db()
+        version = db_repository.data_version(conn)
+        conn.close()
+        mimetype = response_mimetype()
+        key = f"{mimetype} {request.full_path}"
+        with timed("cache"):
+            cached = RESPONSE_CACHE.get(key, version)
+        if cached:
+            outcome, body, status = "hit", cached[0], 200
+        else:
+            start = time.perf_counter()
+            (body, status), shared = RESPONSE_FLIGHTS.do(
+                (key, version), lambda: render_response(view, args, kwargs, key, version, mimetype)
+            )
+            if shared:  # Waited for the response of a concurrent request
+                record_timing("cache", time.perf_counter() - start)
+            outcome = "coalesced" if shared else "miss"
+        if status != 200:  # Errors aren't tagged, so they're never answered with 304
+            CACHE_LOOKUPS.labels(outcome).inc()
+            response = Response(body, status=status, mimetype=mimetype)
+        else:
+            etag = version if mimetype == JSON_MIMETYPE else f"{version}-msgpack"
+            if request.if_none_match.contains(etag):
+                CACHE_LOOKUPS.labels("not_modified").inc()
+                response = Response(status=304)
+            else:
+                CACHE_LOOKUPS.labels(outcome).inc()
+                response = Response(body, mimetype=mimetype)
+            response.set_etag(etag)
+        response.vary.add("Accept")
+        return response
+
+    return wrapper
+
+
+def render_response(view, args: tuple, kwargs: dict, key: str, version: str, mimetype: str) -> tuple:
+    """Return the serialized body and status of the view's response, caching it if successful."""
+    cached = RESPONSE_CACHE.get(key, version)  # Cached by a call that finished after the lookup
+    if cached:
+        return cached[0], 200
+    rv = view(*args, **kwargs)
+    data, status = rv if isinstance(rv, tuple) else (rv, 200)
+    with timed("serialize"):
+        body = serialize(data, mimetype)
+    if status == 200:
+        RESPONSE_CACHE.put(key, version, body, mimetype)
+    return body, status
+
+
+# SNAPSHOTS
+
+# Number of snapshot files kept, older ones may still be downloading when a new one is made
+SNAPSHOTS_KEPT = 3
+
+
+def snapshot_path(version: str) -> Path:
+    return Path(app.config["SNAPSHOT_DIR"]) / f"snapshot-{version}.db"
+
+
+def create_snapshot(version: str) -> tuple:
+    """Write a compact, read-only copy of the database for the data version, unless one exists.
+
+    The copy is made with VACUUM INTO, which reads a consistent state of the database, and is named by
+    the data version it actually holds, which is newer than the requested one if there was a write
+    in between. Workers take turns through a file lock so that a version is only copied once.
+    Returns the (path, version) of the snapshot.
+    """
+    snapshot_dir = Path(app.config["SNAPSHOT_DIR"])
+    snapshot_dir.mkdir(parents=True, exist_ok=True)
+    with open(snapshot_dir / ".lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        if snapshot_path(version).exists():
+            return snapshot_path(version), version
+        tmp_path = snapshot_dir / f".snapshot-{os.getpid()}.tmp"
+        tmp_path.unlink(missing_ok=True)
+        conn = connect_db()
+        try:
+            conn.execute("VACUUM INTO ?", (str(tmp_path),))
+        finally:
+            conn.close()
+        snapshot = sqlite3.connect(tmp_path)
+        version = db_repository.data_version(snapshot)
+        snapshot.close()
+        os.replace(tmp_path, snapshot_path(version))
+        snapshots = sorted(snapshot_dir.glob("snapshot-*.db"), key=lambda path: path.stat().st_mtime, reverse=True)
+        for old_snapshot in snapshots[SNAPSHOTS_KEPT:]:
+            old_snapshot.unlink(missing_ok=True)
+    return snapshot_path(version), version
+
+
+@app.route("/snapshot", methods=["GET"])
+def get_snapshot() -> Response:
+    """Download a read-only SQLite snapshot of the database, for lookups in process without network I/O.
+
+    The snapshot is tagged with its data version as ETag, so a consumer can poll for a newer one with
+    If-None-Match and swap it in when the response isn't 304 Not Modified.
+
+    curl -o endpoints.db 'http://localhost:5000/snapshot'
+    """
+    conn = connect_db()
+    version = db_repository.data_version(conn)
+    conn.close()
+    if request.if_none_match.contains(version):
+        response = Response(status=304)
+    else:
+        path, version = create_snapshot(version)
+        response = send_file(path, mimetype="application/vnd.sqlite3", download_name="endpoints.db", etag=False)
+    response.set_etag(version)
+    return response
+
+
+# SAMPLING PROFILER
+
+# Longest profile in seconds, and shortest interval between samples in milliseconds
+PROFILE_MAX_DURATION_S = 60
+PROFILE_MIN_INTERVAL_MS = 1
+# Number of profile files kept
+PROFILES_KEPT = 20
+VALID_PROFILE_ID = re.compile(r"[0-9A-Za-z-]{1,64}")
+
+
+def profile_path(profile_id: str, running: bool = False) -> Path:
+    """Return the path of a profile's collapsed stacks, or of the file they're collected in while it's running."""
+    return Path(app.config["PROFILE_DIR"]) / f"{profile_id}.{'running' if running else 'folded'}"
+
+
+def collapse_stack(frame) -> str:
+    """Return the stack of a frame as the frames' functions, root first, separated by semicolons."""
+    functions = []
+    while frame is not None:
+        code = frame.f_code
+        functions.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(functions))
+
+
+class StackSampler:
+    """Statistical profiler of a worker, sampling the stacks of its threads from a thread of its own.
+
+    The profile counts how many samples caught each distinct stack, and is written in the collapsed stack
+    format read by flamegraph.pl and speedscope: one "thread;function;...;function count" line per stack.
+    Threads waiting for work are sampled too, so the profile shows wall clock time rather than CPU time.
+    A worker runs one profile at a time.
+    """
+
+    def __init__(self):
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self, profile_id: str, duration: float, interval: float) -> bool:
+        """Start profiling for duration seconds, returns False if the worker is already running a profile."""
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return False
+            running_path = profile_path(profile_id, running=True)
+            running_path.parent.mkdir(parents=True, exist_ok=True)
+            running_path.touch()
+            self._thread = threading.Thread(
+                target=self._run, args=(profile_id, duration, interval), name="stack-sampler", daemon=True
+            )
+            self._thread.start()
+            return True
+
+    def _run(self, profile_id: str, duration: float, interval: float) -> None:
+        running_path = profile_path(profile_id, running=True)
+        try:
+            counts = self.sample(duration, interval)
+            running_path.write_text("".join(f"{stack} {count}\n" for stack, count in counts.items()))
+            os.replace(running_path, profile_path(profile_id))
+        except Exception as e:
+            app.logger.error("Profile %s failed: %s", profile_id, e)
+            running_path.unlink(missing_ok=True)
+            return
+        profile_dir = profile_path(profile_id).parent
+        profiles = sorted(profile_dir.glob("*.folded"), key=lambda path: path.stat().st_mtime, reverse=True)
+        for old_profile in profiles[PROFILES_KEPT:]:
+            old_profile.unlink(missing_ok=True)
+
+    @staticmethod
+    def sample(duration: float, interval: float) -> dict:
+        """Sample the stacks of the worker's other threads every interval seconds, returns the count of each stack."""
+        sampler = threading.get_ident()
+        counts = {}
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != sampler:
+                    stack = f"{names.get(ident, ident)};{collapse_stack(frame)}"
+                    counts[stack] = counts.get(stack, 0) + 1
+            time.sleep(interval)
+        return counts
+
+
+STACK_SAMPLER = StackSampler()
+
+
+@app.route("/profile", methods=["POST"])
+@authenticated
+def start_profile() -> Response:
+    """Start a profile of the worker handling the request, sampling the stacks of its threads.
+
+    Optional JSON data with the 'duration' in seconds, default 10 and at most 60, and the sampling
+    'interval_ms', default 5. Answers 202 with the ID of the profile, whose collapsed stacks can be
+    downloaded from /profile/<id> when it's done. The workers share the requests, so under load one
+    worker's profile shows the hot paths of all of them. Example:
+
+    curl -X POST http://localhost:5000/profile -H 'Authorization: Bearer <token>' \
+        -H 'Content-Type: application/json' -d '{"duration": 30}'
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        duration = float(data.get("duration", 10))
+        interval_ms = float(data.get("interval_ms", 5))
+    except (TypeError, ValueError):
+        return jsonify({"error": "duration and interval_ms must be numbers"}), 400
+    if not 0 < duration <= PROFILE_MAX_DURATION_S or interval_ms < PROFILE_MIN_INTERVAL_MS:
+        return (
+            jsonify(
+                {
+                    "error": f"duration must be in (0, {PROFILE_MAX_DURATION_S}] seconds "
+                    f"and interval_ms at least {PROFILE_MIN_INTERVAL_MS}"
+                }
+            ),
+            400,
+        )
+    profile_id = f"{time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    if not STACK_SAMPLER.start(profile_id, duration, interval_ms / 1000):
+        return jsonify({"error": "This worker is already running a profile"}), 409
+    return jsonify({"id": profile_id, "pid": os.getpid(), "duration": duration, "interval_ms": interval_ms}), 202
+
+
+@app.route("/profile/<string:profile_id>", methods=["GET"])
+@authenticated
+def get_profile(profile_id: str) -> Response:
+    """Download the collapsed stacks of a profile, answers 202 while it's still running.
+
+    curl -o profile.folded http://localhost:5000/profile/<id> -H 'Authorization: Bearer <token>'
+    """
+    if not VALID_PROFILE_ID.fullmatch(profile_id):
+        return jsonify({"error": f"Invalid profile id {profile_id}"}), 400
+    if profile_path(profile_id).exists():
+        return send_file(profile_path(profile_id), mimetype="text/plain", download_name=f"{profile_id}.folded")
+    if profile_path(profile_id, running=True).exists():
+        return jsonify({"id": profile_id, "status": "running"}), 202
+    return jsonify({"error": f"Profile {profile_id} not found"}), 404
+
+
+# HEALTH
+
+# Readiness limits, beyond them the unit reports not ready so that load balancers drain it
+READY_MAX_DB_LATENCY_MS = 500
+READY_MAX_LOAD_PER_CPU = 2.0
+
+
+class InFlightRequests:
+    """Number of requests the worker is handling, over all its threads."""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def add(self, delta: int) -> None:
+        with self._lock:
+            self.count += delta
+
 
-app.logger.info("CREATING database and tables %s", app.config["DATABASE"])
-conn = sqlite3.connect(app.config["DATABASE"])
-cursor = conn.cursor()
-cursor.execute("""CREATE TABLE IF NOT EXISTS chains
-                    (name TEXT PRIMARY KEY UNIQUE COLLATE NOCASE NOT NULL,
-                    api_class TEXT COLLATE NOCASE NOT NULL)""")
-cursor.execute("""CREATE TABLE IF NOT EXISTS rpc_urls
-                    (url TEXT PRIMARY KEY UNIQUE COLLATE NOCASE NOT NULL,
-                    chain_name TEXT COLLATE NOCASE NOT NULL,
-                    FOREIGN KEY(chain_name) REFERENCES chains(name))""")
-conn.commit()
-conn.close()
+IN_FLIGHT_REQUESTS = InFlightRequests()
+
+
+@app.before_request
+def count_request_start() -> None:
+    IN_FLIGHT_REQUESTS.add(1)
+    g.in_flight = True
+
+
+@app.teardown_request
+def count_request_end(exception=None) -> None:
+    if g.pop("in_flight", False):
+        IN_FLIGHT_REQUESTS.add(-1)
+
+
+@app.route("/healthz", methods=["GET"])
+def liveness() -> Response:
+    """Report that the worker is alive and handling requests, without touching the database.
+
+    curl 'http://localhost:5000/healthz'
+    """
+    return jsonify({"alive": True, "pid": os.getpid()})
+
+
+@app.route("/readyz", methods=["GET"])
+def readiness() -> Response:
+    """Report whether the app is ready to serve, with the result of each check it's made of.
+
+    - database: the database is reachable, and answers within READY_MAX_DB_LATENCY_MS
+    - schema: the database is on the current schema version, which it isn't until initialized
+    - cache: the data version, which cached responses are only served for, is readable and bumped on every
+      write by its triggers, reporting the numbers of cached responses of the current and older versions
+    - load: the load average per CPU is at most READY_MAX_LOAD_PER_CPU
+
+    Responds 503 if any check fails, for the charm and load balancers to poll.
+
+    curl 'http://localhost:5000/readyz'
+    """
+    checks = {}
+    start = time.perf_counter()
+    try:
+        conn = connect_db()
+        try:
+            version = schema_version(conn)
+            latency_ms = (time.perf_counter() - start) * 1000
+            checks["database"] = {"ok": latency_ms <= READY_MAX_DB_LATENCY_MS, "latency_ms": round(latency_ms, 2)}
+            checks["schema"] = {"ok": version == SCHEMA_VERSION, "version": version, "expected": SCHEMA_VERSION}
+            try:
+                data_version = db_repository.data_version(conn)
+                missing_triggers = missing_data_version_triggers(conn)
+                current_entries, stale_entries = RESPONSE_CACHE.count_versions(data_version)
+                checks["cache"] = {
+                    "ok": not missing_triggers,
+                    "data_version": data_version,
+                    "entries": current_entries + stale_entries,
+                    "stale_entries": stale_entries,
+                }
+                if missing_triggers:
+                    checks["cache"]["missing_triggers"] = missing_triggers
+            except sqlite3.Error as e:
+                checks["cache"] = {"ok": False, "error": str(e)}
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        checks["database"] = {"ok": False, "error": str(e)}
+    load_per_cpu = os.getloadavg()[0] / (os.cpu_count() or 1)
+    checks["load"] = {
+        "ok": load_per_cpu <= READY_MAX_LOAD_PER_CPU,
+        "load_per_cpu": round(load_per_cpu, 2),
+        "in_flight_requests": IN_FLIGHT_REQUESTS.count,
+    }
+    ready = all(check["ok"] for check in checks.values())
+    role = "replica" if REPLICATION.read_only else "writer"
+    return jsonify({"ready": ready, "role": role, "checks": checks}), 200 if ready else 503
+
+
+# REPLICATION
+
+
+class ReplicationSettings(SettingsFile):
+    """Replication settings, from a file holding JSON like {"writer_url": "http://10.0.0.1:8000"}.
+
+    The file is written by the charm on units that replicate the writer unit's database, and removed on
+    the writer. While it exists the database is replaced by snapshots of the writer's, and the app is
+    a read-only replica.
+    """
+
+    def __init__(self, path: Path):
+        super().__init__(path)
+        self.writer_url = None
+
+    @property
+    def read_only(self) -> bool:
+        return self.writer_url is not None
+
+    def apply(self, settings: dict) -> None:
+        self.writer_url = settings.get("writer_url")
+        if self.read_only:
+            app.logger.info("Serving as a read-only replica of %s", self.writer_url)
+        else:
+            app.logger.info("Serving as the writer")
+
+
+REPLICATION = ReplicationSettings(PATH_REPLICATION)
+
+
+@app.before_request
+def reject_writes_on_replica():
+    """Reject requests to the write routes on a read-only replica, pointing to the writer instead."""
+    REPLICATION.refresh()
+    # Tokens and profiles aren't writes to the database
+    read_only_endpoints = ("generate_token", "start_profile")
+    if REPLICATION.read_only and request.method not in ("GET", "HEAD", "OPTIONS") and request.endpoint not in read_only_endpoints:
+        return jsonify({"error": f"This unit is a read-only replica, send writes to {REPLICATION.writer_url}"}), 403
+    return None
+
+
+# WRITE BATCHING
+
+
+# Held by every write of the worker, so that statements that can't run in a write's transaction, e.g. VACUUM,
+# run between them rather than racing them for the database lock
+WRITE_LOCK = threading.Lock()
+# How long VACUUM waits for other workers' and processes' transactions, it needs the database to itself
+VACUUM_BUSY_TIMEOUT_MS = 30_000
+
+
+class WriteQueue:
+    """Group commit of the writes of a worker's request threads, committed together in one transaction per batch.
+
+    A request submits its write, a function of a database connection, and waits for its result. One writer
+    thread per worker collects the writes submitted within the batch window, runs each in a savepoint of the
+    same transaction, so that a failing write is rolled back alone, and commits once. Each request is then
+    handed its own result or exception, as if its write had been committed on its own.
+    """
+
+    def __init__(self, max_batch: int = 256):
+        self.max_batch = max_batch
+        self._pending = queue.SimpleQueue()
+        self._writer = None
+        self._lock = threading.Lock()
+
+    def submit(self, write):
+        """Run the write in the next batch, returns its result or raises its exception once the batch is committed."""
+        future = Future()
+        self._pending.put((write, future))
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._run, name="write-queue", daemon=True)
+                self._writer.start()
+        return future.result()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._pending.get()]
+            deadline = time.monotonic() + app.config["WRITE_BATCH_MS"] / 1000
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._pending.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            self.commit(batch)
+
+    def commit(self, batch: list) -> None:
+        WRITE_BATCH_SIZE.observe(len(batch))
+        outcomes = []
+        with WRITE_LOCK:
+            conn = connect_db()
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                for write, future in batch:
+                    conn.execute("SAVEPOINT write")
+                    try:
+                        outcomes.append((future, write(conn), None))
+                    except Exception as e:
+                        conn.execute("ROLLBACK TO write")
+                        outcomes.append((future, None, e))
+                    conn.execute("RELEASE write")
+                conn.commit()
+            except Exception as e:  # The batch as a whole failed, e.g. waiting for the database lock timed out
+                conn.rollback()
+                outcomes = [(future, None, e) for _, future in batch]
+            finally:
+                conn.close()
+        for future, result, exception in outcomes:
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+
+
+WRITE_QUEUE = WriteQueue()
+
+
+def run_write(write):
+    """Run a write, a function of a database connection, and commit it, returns the write's result.
+
+    The write is committed in a transaction of its own, or together with other requests' writes if write
+    batching is enabled. Raises the write's exception, after rolling it back, if it fails.
+    """
+    if app.config["WRITE_BATCH_MS"] > 0:
+        return WRITE_QUEUE.submit(write)
+    with WRITE_LOCK:
+        conn = connect_db()
+        try:
+            result = write(conn)
+            conn.commit()
+            return result
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+
+def run_vacuum() -> None:
+    """Compact the database file, between the worker's writes.
+
+    VACUUM can't run in a transaction, so it doesn't go through run_write, but it takes the same write lock.
+    It waits up to VACUUM_BUSY_TIMEOUT_MS for the transactions of other workers to finish.
+    """
+    with WRITE_LOCK:
+        conn = connect_db()
+        try:
+            conn.execute(f"PRAGMA busy_timeout = {VACUUM_BUSY_TIMEOUT_MS}")
+            conn.execute("VACUUM")
+        finally:
+            conn.close()
 
 
 # API ROUTES
@@ -61,7 +1072,7 @@ conn.close()
 def generate_token():
     """Generate an access token.
 
-    The token is needed to make requests to any protected (@jwt_required decorator)
+    The token is needed to make requests to any protected (@authenticated decorator)
     functions in this API. The password is stored securely on the machine of the app.
     Requires JSON data with parameters 'username' and 'password' in the request, example:
 
@@ -80,33 +1091,24 @@ def generate_token():
     return jsonify(access_token=access_token)
 
 
-def insert_into_database(table: str, request_data: dict) -> Response:
-    """Insert a record into the database table."""
+def insert_records(insert, records: list) -> Response:
+    """Insert records with an insert function of db_repository, answering 400 if they don't fit the data."""
     try:
-        conn = sqlite3.connect(app.config["DATABASE"])
-        conn.execute("PRAGMA foreign_keys = ON")  # enforce that any URL has an existing chain
-        cursor = conn.cursor()
-        columns = ", ".join(request_data.keys())
-        placeholders = ":" + ", :".join(request_data.keys())
-        query = f"INSERT INTO {table} ({columns}) VALUES ({placeholders})"
-        cursor.execute(query, request_data)
-        conn.commit()
-        conn.close()
+        run_write(lambda conn: insert(conn, records, skip_existing=False))
         return jsonify({"message": "Record created successfully"}), 201
-    except sqlite3.IntegrityError as e:
-        conn.rollback()  # Roll back the transaction
-        conn.close()
+    except (sqlite3.IntegrityError, ValueError) as e:
         return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
 @app.route("/create_chain", methods=["POST"])
-@jwt_required()
+@authenticated
 def create_chain_record() -> Response:
     """Create a record in the 'chains' table, corresponding to the input data.
 
-    Requires JSON data with parameters 'name' and 'api_class' in the request, example:
+    Requires JSON data with parameters 'name' and 'api_class' in the request, and optionally the chain's
+    'chain_id' and 'genesis_hash', example:
 
     curl -X POST http://localhost:5000/create_chain -d '{"name": "chain1", "api_class": "substrate"}' \
         -H 'Content-Type: application/json'
@@ -116,14 +1118,19 @@ def create_chain_record() -> Response:
     if not all(key in data for key in ("name", "api_class")):
         return jsonify({"error": "Both name and api_class entries are required"}), 400
     values = {"name": data["name"], "api_class": data["api_class"]}
-    if not is_valid_api(values["api_class"]):
+    if not db_repository.is_valid_api(values["api_class"]):
         return jsonify({"error": {"error": "Invalid api"}}), 500
-    return insert_into_database(TABLE_CHAINS, values)
+    values.update({key: data[key] for key in ("chain_id", "genesis_hash") if data.get(key) is not None})
+    try:
+        db_repository.validate_chain_identifiers(values)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return insert_records(db_repository.insert_chains, [values])
 
 
 # TODO: add endpoint to create multiple URL entries with one request?
 @app.route("/create_rpc_url", methods=["POST"])
-@jwt_required()
+@authenticated
 def create_rpc_url_record() -> Response:
     """Create a record in the 'rpc_urls' table, corresponding to the input data.
 
@@ -137,58 +1144,50 @@ def create_rpc_url_record() -> Response:
     if not all(key in data for key in ("url", "chain_name")):
         return jsonify({"error": "Both url and chain_name entries are required"}), 400
     values = {"url": data["url"], "chain_name": data["chain_name"]}
-    if not is_valid_url(values["url"]):
+    if not db_repository.is_valid_url(values["url"]):
         return jsonify({"error": {"error": "Invalid url."}}), 500
-    return insert_into_database(TABLE_RPC_URLS, values)
+    return insert_records(db_repository.insert_rpc_urls, [values])
 
 
 @app.route("/all/<string:table>", methods=["GET"])
-def get_all_records(table: str) -> Response:
+@cached_response
+def get_all_records(table: str):
     """Get all the entries of the table in the path.
 
+    Disabled RPC urls are left out unless url parameter 'include_disabled' is true, example:
+
     curl 'http://localhost:5000/all/chains'
+    curl 'http://localhost:5000/all/rpc_urls?include_disabled=true'
     """
     if table not in [TABLE_CHAINS, TABLE_RPC_URLS]:
-        return jsonify({"error": f"unknown table {table}"}), 400
-    conn = sqlite3.connect(app.config["DATABASE"])
-    cursor = conn.cursor()
-
+        return {"error": f"unknown table {table}"}, 400
+    conn = connect_db()
     if table == TABLE_CHAINS:
-        cursor.execute(f"SELECT name, api_class FROM {TABLE_CHAINS}")
-    if table == TABLE_RPC_URLS:
-        cursor.execute(f"SELECT url, chain_name FROM {TABLE_RPC_URLS}")
-
-    records = cursor.fetchall()
+        results = db_repository.list_chains(conn)
+    else:
+        results = db_repository.all_rpc_urls(conn, include_disabled=include_disabled())
     conn.close()
-    results = []
-
-    if table == TABLE_CHAINS:
-        for record in records:
-            results.append({"name": record[0], "api_class": record[1]})
-    if table == TABLE_RPC_URLS:
-        for record in records:
-            results.append({"url": record[0], "chain_name": record[1]})
-    return jsonify(results)
+    return results
 
 
 @app.route("/get_chain_by_name/<string:name>", methods=["GET"])
-def get_chain_by_name(name: str) -> Response:
+@cached_response
+def get_chain_by_name(name: str):
     """Get the chain entry corresponding to the input chain name.
 
     curl 'http://localhost:5000/get_chain_by_name/PulseChain%20mainnet'
     """
-    conn = sqlite3.connect(app.config["DATABASE"])
-    cursor = conn.cursor()
-    cursor.execute(f"SELECT name, api_class FROM {TABLE_CHAINS} WHERE name=?", (name,))
-    record = cursor.fetchone()
+    conn = connect_db()
+    chain = db_repository.get_chain(conn, name)
     conn.close()
-    if record:
-        return jsonify({"name": record[0], "api_class": record[1]})
-    return jsonify({"error": "Record not found"}), 404
+    if chain:
+        return chain
+    return {"error": "Record not found"}, 404
 
 
 @app.route("/get_chain_by_url", methods=["GET"])
-def get_chain_by_url() -> Response:
+@cached_response
+def get_chain_by_url():
     """Get the chain entry corresponding to the input url.
 
     Requires that url parameters 'protocol' and 'address' are present in the request, example:
@@ -199,23 +1198,41 @@ def get_chain_by_url() -> Response:
         url = url_from_request_args()
     except TypeError as e:
         app.logger.error("TypeError when trying to build RPC url from parameters: %s", str(e))
-        return jsonify({"error": "url parameters 'protocol' and 'address' required for get_chain_by_url request"}), 400
-
-    conn = sqlite3.connect(app.config["DATABASE"])
-    cursor = conn.cursor()
-    cursor.execute(f"SELECT url, chain_name FROM {TABLE_RPC_URLS} WHERE url=?", (url,))
-    url_record = cursor.fetchone()
-    if url_record:
-        cursor.execute(f"SELECT name, api_class FROM {TABLE_CHAINS} WHERE name = ?", (url_record[1],))
-        chain_record = cursor.fetchone()
-        if chain_record:
-            return jsonify({"name": chain_record[0], "api_class": chain_record[1]})
+        return {"error": "url parameters 'protocol' and 'address' required for get_chain_by_url request"}, 400
+
+    conn = connect_db()
+    chain = db_repository.get_chain_by_url(conn, url)
     conn.close()
-    return jsonify({"error": "Record not found"}), 404
+    if chain:
+        return chain
+    return {"error": "Record not found"}, 404
+
+
+@app.route("/chain_by_id/<string:chain_identifier>", methods=["GET"])
+@cached_response
+def get_chain_by_id(chain_identifier: str):
+    """Get the chain with a chain ID, e.g. an EVM chain's eth_chainId in decimal or hex, or with a genesis hash.
+
+    The identifiers are set by `db_util.py identify`, which probes the chains' RPC urls for them. Examples:
+
+    curl 'http://localhost:5000/chain_by_id/1'
+    curl 'http://localhost:5000/chain_by_id/0x91b171bb158e2d3848fa23a9f1c25182fb8e20313b2c1eb49219da7a70ce90c3'
+    """
+    conn = connect_db()
+    try:
+        chain = db_repository.get_chain_by_identifier(conn, chain_identifier)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    finally:
+        conn.close()
+    if chain:
+        return chain
+    return {"error": "Record not found"}, 404
 
 
 @app.route("/get_url", methods=["GET"])
-def get_url() -> Response:
+@cached_response
+def get_url():
     """Get the RPC url entry corresponding to the input url.
 
     Requires that url parameters 'protocol' and 'address' are present in the request, example:
@@ -226,40 +1243,105 @@ def get_url() -> Response:
         url = url_from_request_args()
     except TypeError as e:
         app.logger.error("TypeError when trying to build RPC url from parameters: %s", str(e))
-        return jsonify({"error": "url parameters 'protocol' and 'address' required for update_url_record request"}), 400
+        return {"error": "url parameters 'protocol' and 'address' required for update_url_record request"}, 400
 
-    conn = sqlite3.connect(app.config["DATABASE"])
-    cursor = conn.cursor()
-    cursor.execute(f"SELECT url, chain_name FROM {TABLE_RPC_URLS} WHERE url=?", (url,))
-    record = cursor.fetchone()
+    conn = connect_db()
+    rpc_url = db_repository.get_rpc_url(conn, url)
     conn.close()
-    if record:
-        return jsonify({"url": record[0], "chain_name": record[1]})
-    return jsonify({"error": "Record not found"}), 404
+    if rpc_url:
+        return rpc_url
+    return {"error": "Record not found"}, 404
 
 
 # Get urls for a specific chain
 @app.route("/get_urls/<string:chain_name>", methods=["GET"])
-def get_urls(chain_name: str) -> Response:
+@cached_response
+def get_urls(chain_name: str):
     """Get the RPC URL entries corresponding to the chain name in the path.
 
     curl -X GET 'http://localhost:5000/get_urls/chain5'
     """
-    conn = sqlite3.connect(app.config["DATABASE"])
-    cursor = conn.cursor()
-    cursor.execute(f"SELECT url, chain_name FROM {TABLE_RPC_URLS} WHERE chain_name=?", (chain_name,))
-    records = cursor.fetchall()
+    conn = connect_db()
+    urls = db_repository.chain_urls(conn, chain_name)
     conn.close()
-    urls = []
-    for record in records:
-        urls.append(record[0])
     if len(urls) > 0:
-        return jsonify(urls)
-    return jsonify({"error": f"No urls found for chain {chain_name}"}), 404
+        return urls
+    return {"error": f"No urls found for chain {chain_name}"}, 404
+
+
+@app.route("/providers", methods=["GET"])
+@cached_response
+def get_providers():
+    """Get all providers, i.e. the domains hosting the RPC urls, with their host and url counts.
+
+    The url count includes enabled urls only, disabled ones are counted separately.
+
+    curl 'http://localhost:5000/providers'
+    """
+    conn = connect_db()
+    results = db_repository.list_providers(conn)
+    conn.close()
+    return results
+
+
+@app.route("/urls_by_host/<string:host>", methods=["GET"])
+@cached_response
+def get_urls_by_host(host: str):
+    """Get the RPC url entries served by the host or provider in the path.
+
+    Disabled RPC urls are left out unless url parameter 'include_disabled' is true, example:
+
+    curl 'http://localhost:5000/urls_by_host/dwellir.com?include_disabled=true'
+    curl 'http://localhost:5000/urls_by_host/dwellir.com'
+    curl 'http://localhost:5000/urls_by_host/api-polkadot.n.dwellir.com'
+    """
+    host = host.lower()
+    conn = connect_db()
+    results = db_repository.list_rpc_urls_by_host(conn, host, include_disabled=include_disabled())
+    conn.close()
+    if len(results) > 0:
+        return results
+    return {"error": f"No urls found for host {host}"}, 404
+
+
+@app.route("/rpc_urls/<string:action>", methods=["PATCH"])
+@authenticated
+def set_rpc_urls_enabled(action: str) -> Response:
+    """Enable or disable RPC urls in bulk, selected by a list of urls, a chain name or a host.
+
+    Disabled urls stay in the database but are left out of the read routes. The update is made in one
+    transaction. Requires JSON data with exactly one of the parameters 'urls', 'chain_name' or 'host', examples:
+
+    curl -X PATCH -H 'Content-Type: application/json' -d '{"urls": ["https://chain1.com", "wss://chain1.com"]}' \
+        http://localhost:5000/rpc_urls/disable
+    curl -X PATCH -H 'Content-Type: application/json' -d '{"host": "dwellir.com"}' \
+        http://localhost:5000/rpc_urls/enable
+    """
+    if action not in ("enable", "disable"):
+        return jsonify({"error": f"unknown action {action}, expected enable or disable"}), 404
+    data = request.get_json()
+    selectors = [key for key in ("urls", "chain_name", "host") if key in data]
+    if len(selectors) != 1:
+        return jsonify({"error": "Exactly one of urls, chain_name or host entries is required"}), 400
+    selector = selectors[0]
+    if selector == "urls":
+        urls = data["urls"]
+        if not isinstance(urls, list) or not urls or not all(isinstance(url, str) for url in urls):
+            return jsonify({"error": "The urls entry must be a non-empty list of strings"}), 400
+    elif not isinstance(data[selector], str):
+        return jsonify({"error": f"The {selector} entry must be a string"}), 400
+
+    try:
+        updated = run_write(
+            lambda conn: db_repository.set_rpc_urls_enabled(conn, action == "enable", **{selector: data[selector]})
+        )
+    except sqlite3.Error as e:
+        return jsonify({"error": str(e)}), 500
+    return jsonify({"message": f"RPC url records {action}d successfully", "updated": updated})
 
 
 @app.route("/update_url", methods=["PUT"])
-@jwt_required()
+@authenticated
 def update_url_record() -> Response:
     """Update the rpc_urls entry corresponding to the input url.
 
@@ -279,27 +1361,17 @@ def update_url_record() -> Response:
         chain_name = request.json["chain_name"]
     except KeyError as e:
         return jsonify({"error": f"Missing required parameters, {e}"}), 400
-    if not is_valid_url(url_new):
+    if not db_repository.is_valid_url(url_new):
         return jsonify({"error": "Invalid url"}), 500
 
-    conn = sqlite3.connect(app.config["DATABASE"])
-    conn.execute("PRAGMA foreign_keys = ON")
-    cursor = conn.cursor()
     try:
-        cursor.execute(
-            f"UPDATE {TABLE_RPC_URLS} SET url=?, chain_name=? WHERE url=?",
-            (url_new, chain_name, url_old),
-        )
+        updated = run_write(lambda conn: db_repository.update_rpc_url(conn, url_old, url_new, chain_name))
     except sqlite3.IntegrityError as e:
-        conn.rollback()
-        conn.close()
         return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-    conn.commit()
-    conn.close()
-    if cursor.rowcount == 0:
+    if updated == 0:
         rval = jsonify({"error": "No such record"})
     else:
         rval = jsonify({"url": url_new, "chain_name": chain_name})
@@ -307,35 +1379,29 @@ def update_url_record() -> Response:
 
 
 @app.route("/delete_chain", methods=["DELETE"])
-@jwt_required()
+@authenticated
 def delete_chain_record() -> Response:
-    """Delete the chain entry corresponding to the input name.
+    """Delete the chain entry corresponding to the input name, together with its RPC urls.
 
-    Requires that url parameter 'name' is present in the request, example:
+    The chain and its urls are deleted in one transaction. Requires that url parameter 'name' is present
+    in the request, example:
 
     curl -X DELETE 'http://localhost:5000/delete_chain?name=chain5'
     """
     name = request.args.get("name")
-    conn = sqlite3.connect(app.config["DATABASE"])
-    cursor = conn.cursor()
     try:
-        cursor.execute(f"DELETE FROM {TABLE_CHAINS} WHERE name=?", (name,))
-        # TODO: should urls referencing this chains entry also be deleted at this point? since their foreign key now is missing
+        chain_count, url_count = run_write(lambda conn: db_repository.delete_chains(conn, [name]))
     except sqlite3.IntegrityError as e:
-        conn.rollback()
-        conn.close()
         return jsonify({"error": str(e)}), 400
-    conn.commit()
-    conn.close()
-    if cursor.rowcount == 0:
+    if chain_count == 0:
         rval = jsonify({"error": f"Record with name '{name}' not found"})
     else:
-        rval = jsonify({"message": "Chain record deleted successfully"})
+        rval = jsonify({"message": "Chain record deleted successfully", "deleted_chains": chain_count, "deleted_urls": url_count})
     return rval
 
 
 @app.route("/delete_url", methods=["DELETE"])
-@jwt_required()
+@authenticated
 def delete_url_record() -> Response:
     """Delete the rpc_urls entry corresponding to the input url.
 
@@ -349,17 +1415,11 @@ def delete_url_record() -> Response:
         app.logger.error("TypeError when trying to build RPC url from parameters: %s", str(e))
         return jsonify({"error": "url parameters 'protocol' and 'address' required for delete_url request"}), 400
 
-    conn = sqlite3.connect(app.config["DATABASE"])
-    cursor = conn.cursor()
     try:
-        cursor.execute(f"DELETE FROM {TABLE_RPC_URLS} WHERE url=?", (url,))
+        deleted = run_write(lambda conn: db_repository.delete_rpc_urls(conn, [url]))
     except sqlite3.IntegrityError as e:
-        conn.rollback()
-        conn.close()
         return jsonify({"error": str(e)}), 400
-    conn.commit()
-    conn.close()
-    if cursor.rowcount == 0:
+    if deleted == 0:
         rval = jsonify({"error": f"Record with url '{url}' not found"})
     else:
         rval = jsonify({"message": "RPC url record deleted successfully"})
@@ -367,7 +1427,7 @@ def delete_url_record() -> Response:
 
 
 @app.route("/delete_urls", methods=["DELETE"])
-@jwt_required()
+@authenticated
 def delete_url_records() -> Response:
     """Delete the url entries corresponding to the input chain_name.
 
@@ -376,24 +1436,43 @@ def delete_url_records() -> Response:
     curl -X DELETE 'http://localhost:5000/delete_urls?chain_name=chain3'
     """
     chain_name = request.args.get("chain_name")
-    conn = sqlite3.connect(app.config["DATABASE"])
-    cursor = conn.cursor()
     try:
-        cursor.execute(f"DELETE FROM {TABLE_RPC_URLS} WHERE chain_name=?", (chain_name,))
+        deleted = run_write(lambda conn: db_repository.delete_chain_rpc_urls(conn, [chain_name]))
     except sqlite3.IntegrityError as e:
-        conn.rollback()
-        conn.close()
         return jsonify({"error": str(e)}), 400
-    conn.commit()
-    conn.close()
-    if cursor.rowcount == 0:
+    if deleted == 0:
         rval = jsonify({"error": f"Records with chain_name '{chain_name}' not found"})
     else:
         rval = jsonify({"message": "RPC url records deleted successfully"})
     return rval
 
 
+@app.route("/vacuum/orphans", methods=["POST"])
+@authenticated
+def vacuum_orphans() -> Response:
+    """Delete the RPC urls whose chain doesn't exist, then compact the database file.
+
+    curl -X POST 'http://localhost:5000/vacuum/orphans'
+    """
+    try:
+        url_count = run_write(db_repository.delete_orphaned_rpc_urls)
+        size_before = Path(app.config["DATABASE"]).stat().st_size
+        run_vacuum()
+        size_after = Path(app.config["DATABASE"]).stat().st_size
+    except sqlite3.Error as e:
+        return jsonify({"error": str(e)}), 500
+    return jsonify(
+        {
+            "message": "Orphaned RPC url records deleted and database vacuumed successfully",
+            "deleted_urls": url_count,
+            "bytes_before": size_before,
+            "bytes_after": size_after,
+        }
+    )
+
+
 @app.route("/chain_info", methods=["GET"])
+@cached_response
 def get_chain_info():
     """Get info for the chain corresponding to the input name.
 
@@ -404,59 +1483,22 @@ def get_chain_info():
     # Get parameters from the request URL
     chain_name = request.args.get("chain_name")
     if not chain_name:
-        return jsonify({"error": "Missing required parameter 'chain_name'"}), 400
-    conn = sqlite3.connect(app.config["DATABASE"])
-    cursor = conn.cursor()
-    # Fetch chain
-    cursor.execute(f"SELECT * FROM {TABLE_CHAINS} WHERE name=?", (chain_name,))
-    chain_record = cursor.fetchone()
-    if not chain_record:
-        return jsonify({"error": f"Chain '{chain_name}' not found in database"}), 404
-    # Fetch urls
-    cursor.execute(f"SELECT url, chain_name FROM {TABLE_RPC_URLS} WHERE chain_name=?", (chain_name,))
-    url_records = cursor.fetchall()
+        return {"error": "Missing required parameter 'chain_name'"}, 400
+    conn = connect_db()
+    result = db_repository.chain_info(conn, chain_name)
     conn.close()
-    urls = []
-    for ur in url_records:
-        urls.append(ur[0])
-    result = {"chain_name": chain_record[0], "api_class": chain_record[1], "urls": urls}
+    if not result:
+        return {"error": f"Chain '{chain_name}' not found in database"}, 404
     # Return the chain info as JSON
-    return jsonify(result), 200
+    return result, 200
 
 
 # UTILITY FUNCTIONS
 
-VALID_API_CLASSES = [
-    "substrate",
-    "ethereum",
-    "starknet",
-    "filecoin",
-    "sui",
-    "waves",
-    "ton",
-    "tonv3",
-    "sidecar",
-    "cosmos-tendermint",
-    "eos",
-    "eth-v1-beacon",
-    "tron",
-    "movement",
-]
-
-
-def is_valid_api(api: str) -> bool:
-    """Test that an API class string is valid."""
-    return api.lower() in VALID_API_CLASSES
-
-
-def is_valid_url(url: str) -> bool:
-    """Test that a url is valid, e.g. only http(s) and ws(s)."""
-    allowed_schemes = {"http", "https", "ws", "wss"}
-    try:
-        result = urlparse(url)
-        return all([result.scheme in allowed_schemes, result.netloc])
-    except ValueError:
-        return False
+
+def include_disabled() -> bool:
+    """Return whether a read route should include disabled urls, i.e. if url parameter 'include_disabled' is true."""
+    return request.args.get("include_disabled", "").lower() in ("1", "true", "yes")
 
 
 def url_from_request_args() -> str:
@@ -472,4 +1514,5 @@ def url_from_request_args() -> str:
 # MAIN
 
 if __name__ == "__main__":
+    init_database(app.config["DATABASE"])
     app.run(debug=False, host="0.0.0.0")
@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+
+"""Data access for the RPC endpoint database: every read and write of its chains and RPC urls.
+
+The app's routes, db_util.py and the charm's actions all query the database through this module, so a
+query is written, and tuned, in one place. Writes take lists of records and run as executemany statements,
+so that a batch of any size is applied with one prepared statement per operation. The functions don't
+commit, the caller decides the scope of the transaction, e.g. with transaction(). The module only uses the
+standard library, so that the charm can import it too.
+"""
+
+import re
+import sqlite3
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from db_schema import TABLE_CHAINS, TABLE_META, TABLE_RPC_URLS, host_and_provider
+
+VALID_API_CLASSES = [
+    "substrate",
+    "ethereum",
+    "starknet",
+    "filecoin",
+    "sui",
+    "waves",
+    "ton",
+    "tonv3",
+    "sidecar",
+    "cosmos-tendermint",
+    "eos",
+    "eth-v1-beacon",
+    "tron",
+    "movement",
+]
+
+
+# A substrate chain's genesis hash, and an EVM chain ID in decimal or hex as returned by eth_chainId
+GENESIS_HASH = re.compile(r"0x[0-9a-fA-F]{64}")
+CHAIN_ID = re.compile(r"[0-9]{1,19}|0x[0-9a-fA-F]{1,16}")
+# Largest chain ID an SQLite integer holds
+MAX_CHAIN_ID = 2**63 - 1
+
+
+def is_valid_api(api: str) -> bool:
+    """Test that an API class string is valid."""
+    return api.lower() in VALID_API_CLASSES
+
+
+def is_valid_url(url: str) -> bool:
+    """Test that a url is valid, e.g. only http(s) and ws(s)."""
+    allowed_schemes = {"http", "https", "ws", "wss"}
+    try:
+        result = urlparse(url)
+        return all([result.scheme in allowed_schemes, result.netloc])
+    except ValueError:
+        return False
+
+
+def is_valid_chain_id(chain_id) -> bool:
+    """Test that a chain ID is an integer that fits in the chains table."""
+    return isinstance(chain_id, int) and not isinstance(chain_id, bool) and 0 <= chain_id <= MAX_CHAIN_ID
+
+
+def is_valid_genesis_hash(genesis_hash) -> bool:
+    """Test that a genesis hash is a 32 byte hex string, prefixed with 0x."""
+    return isinstance(genesis_hash, str) and GENESIS_HASH.fullmatch(genesis_hash) is not None
+
+
+def parse_chain_identifier(identifier: str) -> tuple:
+    """Return the column and value a chain is looked up by for an identifier, raises ValueError if it's invalid.
+
+    A genesis hash is 0x followed by 64 hex digits, anything shorter is a chain ID in decimal or 0x-prefixed hex.
+    """
+    if GENESIS_HASH.fullmatch(identifier):
+        return "genesis_hash", identifier.lower()
+    if CHAIN_ID.fullmatch(identifier) and int(identifier, 0 if identifier.startswith("0x") else 10) <= MAX_CHAIN_ID:
+        return "chain_id", int(identifier, 0 if identifier.startswith("0x") else 10)
+    raise ValueError(f"Invalid chain identifier {identifier}, expected a chain ID or a genesis hash")
+
+
+def connect(db_file: str, factory: type = sqlite3.Connection) -> sqlite3.Connection:
+    """Open a connection to the database, with foreign keys enforced and write transactions taking the lock up front."""
+    conn = sqlite3.connect(db_file, factory=factory, isolation_level="IMMEDIATE", timeout=10)
+    conn.execute("PRAGMA foreign_keys = ON")
+    return conn
+
+
+@contextmanager
+def transaction(db_file: str):
+    """Yield a connection to the database whose statements make up one transaction.
+
+    The transaction is committed when the block exits, or rolled back if it raises, and the connection closed.
+    """
+    conn = connect(db_file)
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+# READS
+
+
+def data_version(conn: sqlite3.Connection) -> str:
+    """Return the version of the data in the database, changing on every write, as '<generation>-<version>'."""
+    meta = dict(conn.execute(f"SELECT key, value FROM {TABLE_META}").fetchall())
+    return f"{meta['generation']}-{meta['data_version']}"
+
+
+def count_rows(conn: sqlite3.Connection) -> dict:
+    """Return the number of chains, and of enabled and disabled RPC urls."""
+    chains = conn.execute(f"SELECT COUNT(*) FROM {TABLE_CHAINS}").fetchone()[0]
+    enabled, disabled = conn.execute(
+        f"SELECT COALESCE(SUM(enabled), 0), COUNT(*) - COALESCE(SUM(enabled), 0) FROM {TABLE_RPC_URLS}"
+    ).fetchone()
+    return {"chains": chains, "enabled_rpc_urls": enabled, "disabled_rpc_urls": disabled}
+
+
+def rpc_url_record(row: tuple) -> dict:
+    """Return a (url, chain_name, enabled) row as a record, disabled urls being marked as such."""
+    record = {"url": row[0], "chain_name": row[1]}
+    if not row[2]:
+        record["enabled"] = False
+    return record
+
+
+def chain_record(row: tuple) -> dict:
+    """Return a (name, api_class, chain_id, genesis_hash) row as a record, with the identifiers that are known."""
+    record = {"name": row[0], "api_class": row[1]}
+    if row[2] is not None:
+        record["chain_id"] = row[2]
+    if row[3] is not None:
+        record["genesis_hash"] = row[3]
+    return record
+
+
+def list_chains(conn: sqlite3.Connection) -> list:
+    """Return all chains ordered by name, see chain_record."""
+    rows = conn.execute(f"SELECT name, api_class, chain_id, genesis_hash FROM {TABLE_CHAINS} ORDER BY name")
+    return [chain_record(row) for row in rows]
+
+
+def list_rpc_urls(conn: sqlite3.Connection, chain_name: str = "", include_disabled: bool = True) -> list:
+    """Return the RPC urls ordered by chain and url, of one chain if a name is given, with their enabled flag."""
+    query = f"SELECT url, chain_name, enabled FROM {TABLE_RPC_URLS} WHERE enabled >= ?"
+    params = [0 if include_disabled else 1]
+    if chain_name:
+        query += " AND chain_name=?"
+        params.append(chain_name)
+    rows = conn.execute(query + " ORDER BY chain_name, url", params)
+    return [{"url": row[0], "chain_name": row[1], "enabled": bool(row[2])} for row in rows]
+
+
+def all_rpc_urls(conn: sqlite3.Connection, include_disabled: bool = False) -> list:
+    """Return all RPC urls unordered, as the API lists them, see rpc_url_record."""
+    rows = conn.execute(
+        f"SELECT url, chain_name, enabled FROM {TABLE_RPC_URLS} WHERE enabled >= ?", (0 if include_disabled else 1,)
+    )
+    return [rpc_url_record(row) for row in rows]
+
+
+def list_rpc_urls_by_host(conn: sqlite3.Connection, host: str, include_disabled: bool = False) -> list:
+    """Return the RPC urls served by a host, or by any host of a provider, see rpc_url_record."""
+    host = host.lower()
+    rows = conn.execute(
+        f"SELECT url, chain_name, enabled FROM {TABLE_RPC_URLS} WHERE (host=? OR provider=?) AND enabled >= ?",
+        (host, host, 0 if include_disabled else 1),
+    )
+    return [rpc_url_record(row) for row in rows]
+
+
+def list_providers(conn: sqlite3.Connection) -> list:
+    """Return the providers with their numbers of hosts, and of enabled and disabled urls."""
+    rows = conn.execute(
+        f"SELECT provider, COUNT(DISTINCT host), SUM(enabled), COUNT(*) - SUM(enabled) FROM {TABLE_RPC_URLS} "
+        "GROUP BY provider ORDER BY provider"
+    )
+    return [{"provider": row[0], "hosts": row[1], "urls": row[2], "disabled_urls": row[3]} for row in rows]
+
+
+def get_chain(conn: sqlite3.Connection, name: str):
+    """Return the chain with the name, or None if it doesn't exist."""
+    row = conn.execute(
+        f"SELECT name, api_class, chain_id, genesis_hash FROM {TABLE_CHAINS} WHERE name=?", (name,)
+    ).fetchone()
+    return chain_record(row) if row else None
+
+
+def get_chain_by_identifier(conn: sqlite3.Connection, identifier: str):
+    """Return the chain with the chain ID or genesis hash, or None if there's no such chain.
+
+    Raises ValueError if the identifier is neither, see parse_chain_identifier.
+    """
+    column, value = parse_chain_identifier(identifier)
+    row = conn.execute(
+        f"SELECT name, api_class, chain_id, genesis_hash FROM {TABLE_CHAINS} WHERE {column}=?", (value,)
+    ).fetchone()
+    return chain_record(row) if row else None
+
+
+def get_chain_by_url(conn: sqlite3.Connection, url: str):
+    """Return the chain of the enabled RPC url, or None if there's no such url."""
+    row = conn.execute(
+        f"SELECT c.name, c.api_class, c.chain_id, c.genesis_hash FROM {TABLE_RPC_URLS} u "
+        f"JOIN {TABLE_CHAINS} c ON c.name = u.chain_name WHERE u.url=? AND u.enabled=1",
+        (url,),
+    ).fetchone()
+    return chain_record(row) if row else None
+
+
+def get_rpc_url(conn: sqlite3.Connection, url: str):
+    """Return the enabled RPC url with its chain name, or None if there's no such url."""
+    row = conn.execute(f"SELECT url, chain_name FROM {TABLE_RPC_URLS} WHERE url=? AND enabled=1", (url,)).fetchone()
+    return {"url": row[0], "chain_name": row[1]} if row else None
+
+
+def chain_urls(conn: sqlite3.Connection, chain_name: str) -> list:
+    """Return the enabled RPC urls of the chain, as strings."""
+    rows = conn.execute(f"SELECT url FROM {TABLE_RPC_URLS} WHERE chain_name=? AND enabled=1", (chain_name,))
+    return [row[0] for row in rows]
+
+
+def chain_info(conn: sqlite3.Connection, name: str):
+    """Return the chain with its enabled RPC urls ordered, or None if it doesn't exist."""
+    chain = get_chain(conn, name)
+    if not chain:
+        return None
+    info = {"chain_name": chain.pop("name"), **chain}
+    info["urls"] = sorted(chain_urls(conn, info["chain_name"]))
+    return info
+
+
+def missing_chains(conn: sqlite3.Connection, names: list) -> list:
+    """Return the names, out of the given ones, of the chains that don't exist in the database."""
+    query = f"SELECT 1 FROM {TABLE_CHAINS} WHERE name=?"
+    distinct_names = {name.lower(): name for name in names}.values()
+    return sorted(name for name in distinct_names if not conn.execute(query, (name,)).fetchone())
+
+
+# WRITES
+
+
+def validate_chains(chains: list) -> None:
+    """Raise ValueError if any of the chains lacks an entry or has an invalid API class or identifier."""
+    for chain in chains:
+        if not all(key in chain for key in ("name", "api_class")):
+            raise ValueError(f"Both name and api_class entries are required, got {chain}")
+        if not is_valid_api(chain["api_class"]):
+            raise ValueError(f"Invalid api class {chain['api_class']} of chain {chain['name']}")
+        validate_chain_identifiers(chain)
+
+
+def validate_chain_identifiers(chain: dict) -> None:
+    """Raise ValueError if the chain has a chain ID or a genesis hash that isn't valid."""
+    if chain.get("chain_id") is not None and not is_valid_chain_id(chain["chain_id"]):
+        raise ValueError(f"Invalid chain ID {chain['chain_id']} of chain {chain['name']}")
+    if chain.get("genesis_hash") is not None and not is_valid_genesis_hash(chain["genesis_hash"]):
+        raise ValueError(f"Invalid genesis hash {chain['genesis_hash']} of chain {chain['name']}")
+
+
+def validate_rpc_urls(conn: sqlite3.Connection, rpc_urls: list) -> None:
+    """Raise ValueError if any of the RPC urls lacks an entry, is invalid or belongs to a chain that doesn't exist."""
+    for rpc_url in rpc_urls:
+        if not all(isinstance(rpc_url.get(key), str) for key in ("url", "chain_name")):
+            raise ValueError(f"Both url and chain_name entries are required, got {rpc_url}")
+        if not is_valid_url(rpc_url["url"]):
+            raise ValueError(f"Invalid url {rpc_url['url']}")
+    missing = missing_chains(conn, [rpc_url["chain_name"] for rpc_url in rpc_urls])
+    if missing:
+        raise ValueError(f"No chains named {', '.join(missing)}")
+
+
+def valid_chain_identifiers(chain: dict) -> bool:
+    """Test that the chain's identifiers, if it has any, are valid."""
+    try:
+        validate_chain_identifiers(chain)
+        return True
+    except ValueError:
+        return False
+
+
+def unique_chain_identifiers(chains: list) -> list:
+    """Return the chains without the identifiers that an earlier chain in the list has."""
+    seen = set()
+    unique = []
+    for chain in chains:
+        chain = dict(chain)
+        for column in ("chain_id", "genesis_hash"):
+            if chain.get(column) is None:
+                continue
+            key = (column, chain[column].lower() if column == "genesis_hash" else chain[column])
+            if key in seen:
+                del chain[column]
+            seen.add(key)
+        unique.append(chain)
+    return unique
+
+
+def chain_rows(chains: list) -> list:
+    """Return chains as rows of the chains table, with their identifiers if they're known."""
+    return [
+        (chain["name"], chain["api_class"], chain.get("chain_id"), (chain.get("genesis_hash") or "").lower() or None)
+        for chain in chains
+    ]
+
+
+def rpc_url_rows(rpc_urls: list) -> list:
+    """Return RPC urls as rows of the rpc_urls table, with their derived host and provider."""
+    return [(rpc_url["url"], rpc_url["chain_name"], *host_and_provider(rpc_url["url"])) for rpc_url in rpc_urls]
+
+
+def insert_chains(conn: sqlite3.Connection, chains: list, skip_existing: bool = True) -> int:
+    """Insert chains, dicts with a name and an API class, returns the number inserted.
+
+    Chains that already exist, by name or identifier, are skipped, or raise sqlite3.IntegrityError unless
+    skip_existing. Raises ValueError, before writing anything, if a chain is invalid.
+    """
+    validate_chains(chains)
+    verb = "INSERT OR IGNORE" if skip_existing else "INSERT"
+    return conn.executemany(
+        f"{verb} INTO {TABLE_CHAINS} (name, api_class, chain_id, genesis_hash) VALUES (?, ?, ?, ?)", chain_rows(chains)
+    ).rowcount
+
+
+def insert_rpc_urls(conn: sqlite3.Connection, rpc_urls: list, skip_existing: bool = True) -> int:
+    """Insert RPC urls, dicts with a url and a chain name, returns the number inserted.
+
+    Urls that already exist are skipped, or raise sqlite3.IntegrityError unless skip_existing.
+    Raises ValueError, before writing anything, if a url is invalid or its chain doesn't exist.
+    """
+    validate_rpc_urls(conn, rpc_urls)
+    verb = "INSERT OR IGNORE" if skip_existing else "INSERT"
+    return conn.executemany(
+        f"{verb} INTO {TABLE_RPC_URLS} (url, chain_name, host, provider) VALUES (?, ?, ?, ?)", rpc_url_rows(rpc_urls)
+    ).rowcount
+
+
+def upsert_chains(conn: sqlite3.Connection, chains: list) -> int:
+    """Insert chains, or update the API class of those that exist, returns the number inserted or changed.
+
+    The identifiers of existing chains are updated if given, and kept otherwise. Raises
+    sqlite3.IntegrityError if an identifier belongs to another chain.
+    """
+    validate_chains(chains)
+    return conn.executemany(
+        f"INSERT INTO {TABLE_CHAINS} (name, api_class, chain_id, genesis_hash) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(name) DO UPDATE SET api_class=excluded.api_class, "
+        "chain_id=COALESCE(excluded.chain_id, chain_id), genesis_hash=COALESCE(excluded.genesis_hash, genesis_hash) "
+        "WHERE api_class != excluded.api_class OR chain_id IS NOT COALESCE(excluded.chain_id, chain_id) "
+        "OR genesis_hash IS NOT COALESCE(excluded.genesis_hash, genesis_hash)",
+        chain_rows(chains),
+    ).rowcount
+
+
+def set_chain_identifiers(conn: sqlite3.Connection, chains: list) -> int:
+    """Set the identifiers of existing chains, dicts with a name and a chain ID, a genesis hash or both.
+
+    Returns the number of identifiers that changed. An identifier that another chain already has is
+    skipped. Raises ValueError, before writing anything, if an identifier is invalid.
+    """
+    for chain in chains:
+        validate_chain_identifiers(chain)
+    changed = 0
+    for column in ("chain_id", "genesis_hash"):
+        rows = []
+        for chain in chains:
+            value = chain.get(column)
+            if value is not None:
+                value = value.lower() if column == "genesis_hash" else value
+                rows.append((value, chain["name"], value))
+        changed += conn.executemany(
+            f"UPDATE OR IGNORE {TABLE_CHAINS} SET {column}=? WHERE name=? AND {column} IS NOT ?", rows
+        ).rowcount
+    return changed
+
+
+def upsert_rpc_urls(conn: sqlite3.Connection, rpc_urls: list) -> int:
+    """Insert RPC urls, or move those that exist to the given chain, returns the number inserted or changed."""
+    validate_rpc_urls(conn, rpc_urls)
+    return conn.executemany(
+        f"INSERT INTO {TABLE_RPC_URLS} (url, chain_name, host, provider) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(url) DO UPDATE SET chain_name=excluded.chain_name WHERE chain_name != excluded.chain_name",
+        rpc_url_rows(rpc_urls),
+    ).rowcount
+
+
+def update_rpc_url(conn: sqlite3.Connection, url: str, new_url: str, chain_name: str) -> int:
+    """Replace an RPC url and its chain, returns the number of urls updated, 0 or 1.
+
+    Raises ValueError if the new url is invalid, and sqlite3.IntegrityError if the chain doesn't exist.
+    """
+    if not is_valid_url(new_url):
+        raise ValueError(f"Invalid url {new_url}")
+    return conn.execute(
+        f"UPDATE {TABLE_RPC_URLS} SET url=?, chain_name=?, host=?, provider=? WHERE url=?",
+        (new_url, chain_name, *host_and_provider(new_url), url),
+    ).rowcount
+
+
+def set_rpc_urls_enabled(
+    conn: sqlite3.Connection, enabled: bool, urls: list = None, chain_name: str = None, host: str = None
+) -> int:
+    """Enable or disable RPC urls, selected by a list of urls, a chain name or a host or provider.
+
+    The selector is the first one given, in that order. Returns the number of urls whose state changed.
+    """
+    enabled = int(enabled)
+    if urls is not None:
+        return conn.executemany(
+            f"UPDATE {TABLE_RPC_URLS} SET enabled=? WHERE url=? AND enabled!=?",
+            [(enabled, url, enabled) for url in urls],
+        ).rowcount
+    if chain_name is not None:
+        return conn.execute(
+            f"UPDATE {TABLE_RPC_URLS} SET enabled=? WHERE chain_name=? AND enabled!=?", (enabled, chain_name, enabled)
+        ).rowcount
+    host = host.lower()
+    return conn.execute(
+        f"UPDATE {TABLE_RPC_URLS} SET enabled=? WHERE (host=? OR provider=?) AND enabled!=?",
+        (enabled, host, host, enabled),
+    ).rowcount
+
+
+def delete_chains(conn: sqlite3.Connection, names: list) -> tuple:
+    """Delete chains by name, together with their RPC urls, returns the numbers of chains and urls deleted.
+
+    The urls are deleted by the foreign key's cascade, which requires a connection from connect(). The
+    transaction is begun before the urls are counted, so that the counts match what's deleted.
+    """
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+    count_query = (
+        f"SELECT COUNT(*) FROM {TABLE_RPC_URLS} WHERE chain_name IN (SELECT name FROM {TABLE_CHAINS} WHERE name=?)"
+    )
+    url_count = sum(conn.execute(count_query, (name,)).fetchone()[0] for name in names)
+    chain_count = conn.executemany(f"DELETE FROM {TABLE_CHAINS} WHERE name=?", [(name,) for name in names]).rowcount
+    return chain_count, url_count
+
+
+def delete_rpc_urls(conn: sqlite3.Connection, urls: list) -> int:
+    """Delete RPC urls, returns the number deleted."""
+    return conn.executemany(f"DELETE FROM {TABLE_RPC_URLS} WHERE url=?", [(url,) for url in urls]).rowcount
+
+
+def delete_chain_rpc_urls(conn: sqlite3.Connection, chain_names: list) -> int:
+    """Delete the RPC urls of chains, keeping the chains, returns the number of urls deleted."""
+    return conn.executemany(
+        f"DELETE FROM {TABLE_RPC_URLS} WHERE chain_name=?", [(name,) for name in chain_names]
+    ).rowcount
+
+
+def delete_orphaned_rpc_urls(conn: sqlite3.Connection) -> int:
+    """Delete the RPC urls whose chain doesn't exist, returns the number deleted."""
+    return conn.execute(
+        f"DELETE FROM {TABLE_RPC_URLS} WHERE chain_name NOT IN (SELECT name FROM {TABLE_CHAINS})"
+    ).rowcount
+
+
+def bulk_load(conn: sqlite3.Connection, chains: list, rpc_urls: list) -> tuple:
+    """Load chains and RPC urls into a new database, returns the numbers of chains and urls loaded.
+
+    The indexes and triggers are dropped for the load and created again after it, which is faster than
+    keeping them up to date row by row. Invalid entries, also ones lacking a name or chain name, duplicates
+    and urls of missing chains are skipped, as are identifiers that an earlier chain has.
+    Meant for a database file no one else reads yet, see `db_util.py import --replace`.
+    """
+    chains = unique_chain_identifiers(
+        [
+            chain
+            for chain in chains
+            if isinstance(chain.get("name"), str)
+            and isinstance(chain.get("api_class"), str)
+            and is_valid_api(chain["api_class"])
+            and valid_chain_identifiers(chain)
+        ]
+    )
+    chain_names = {chain["name"].lower() for chain in chains}
+    rpc_urls = [
+        rpc_url
+        for rpc_url in rpc_urls
+        if isinstance(rpc_url.get("chain_name"), str)
+        and rpc_url["chain_name"].lower() in chain_names
+        and isinstance(rpc_url.get("url"), str)
+        and is_valid_url(rpc_url["url"])
+    ]
+    deferred = conn.execute(
+        "SELECT type, name, sql FROM sqlite_master WHERE type IN ('index', 'trigger') AND sql IS NOT NULL"
+    ).fetchall()
+    for object_type, name, _ in deferred:
+        conn.execute(f"DROP {object_type.upper()} {name}")
+    chain_count = conn.executemany(
+        f"INSERT OR IGNORE INTO {TABLE_CHAINS} (name, api_class, chain_id, genesis_hash) VALUES (?, ?, ?, ?)",
+        chain_rows(chains),
+    ).rowcount
+    url_count = conn.executemany(
+        f"INSERT OR IGNORE INTO {TABLE_RPC_URLS} (url, chain_name, host, provider) VALUES (?, ?, ?, ?)",
+        rpc_url_rows(rpc_urls),
+    ).rowcount
+    for _, _, sql in deferred:
+        conn.execute(sql)
+    return chain_count, url_count
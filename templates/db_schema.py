@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+"""Schema of the RPC endpoint database: its tables and the migrations between schema versions.
+
+The schema is set up by an explicit, idempotent step, init_database, rather than on import of the app,
+so that no database connection or write happens while Gunicorn loads the app. It's run by the charm
+before the service starts, through `db_util.py init`, by Gunicorn's on_starting hook and by `app.py`
+when run directly. The module only uses the standard library, so that all of them can import it.
+"""
+
+import logging
+import sqlite3
+from urllib.parse import urlparse
+
+TABLE_CHAINS = "chains"
+TABLE_RPC_URLS = "rpc_urls"
+TABLE_META = "meta"
+# Triggers incrementing the data version on every change to the data, see migrate_add_data_version
+DATA_VERSION_TRIGGERS = [
+    f"{table}_{operation}_data_version"
+    for table in (TABLE_CHAINS, TABLE_RPC_URLS)
+    for operation in ("insert", "update", "delete")
+]
+
+logger = logging.getLogger(__name__)
+
+
+def init_database(db_file: str) -> None:
+    """Create the database tables if they don't exist, and migrate an existing database to the current schema."""
+    logger.info("CREATING database and tables %s", db_file)
+    conn = sqlite3.connect(db_file)
+    cursor = conn.cursor()
+    cursor.execute(f"""CREATE TABLE IF NOT EXISTS {TABLE_CHAINS}
+                        (name TEXT PRIMARY KEY UNIQUE COLLATE NOCASE NOT NULL,
+                        api_class TEXT COLLATE NOCASE NOT NULL)""")
+    cursor.execute(f"""CREATE TABLE IF NOT EXISTS {TABLE_RPC_URLS}
+                        (url TEXT PRIMARY KEY UNIQUE COLLATE NOCASE NOT NULL,
+                        chain_name TEXT COLLATE NOCASE NOT NULL,
+                        FOREIGN KEY(chain_name) REFERENCES chains(name))""")
+    conn.commit()
+    migrate_database(conn)
+    conn.close()
+
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    """Return the schema version of the database, the number of migrations applied to it."""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def missing_data_version_triggers(conn: sqlite3.Connection) -> list:
+    """Return the names of the data version's triggers the database lacks."""
+    existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")}
+    return [name for name in DATA_VERSION_TRIGGERS if name not in existing]
+
+
+def migrate_database(conn: sqlite3.Connection) -> None:
+    """Apply the schema migrations the database file hasn't seen yet, in order.
+
+    Each migration runs in its own write transaction, the version is read inside it so that workers
+    starting at the same time apply every migration once.
+    """
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        version = schema_version(conn)
+        if version >= len(MIGRATIONS):
+            conn.rollback()
+            return
+        logger.info("MIGRATING database to schema version %s", version + 1)
+        MIGRATIONS[version](conn)
+        conn.execute(f"PRAGMA user_version = {version + 1}")
+        conn.commit()
+
+
+def migrate_add_url_host(conn: sqlite3.Connection) -> None:
+    """Add the derived host and provider columns to the rpc_urls table, with indexes."""
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({TABLE_RPC_URLS})")]
+    if "host" not in columns:
+        conn.execute(f"ALTER TABLE {TABLE_RPC_URLS} ADD COLUMN host TEXT COLLATE NOCASE")
+    if "provider" not in columns:
+        conn.execute(f"ALTER TABLE {TABLE_RPC_URLS} ADD COLUMN provider TEXT COLLATE NOCASE")
+    records = conn.execute(f"SELECT url FROM {TABLE_RPC_URLS} WHERE host IS NULL").fetchall()
+    conn.executemany(
+        f"UPDATE {TABLE_RPC_URLS} SET host=?, provider=? WHERE url=?",
+        [(*host_and_provider(record[0]), record[0]) for record in records],
+    )
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_rpc_urls_host ON {TABLE_RPC_URLS} (host)")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_rpc_urls_provider ON {TABLE_RPC_URLS} (provider)")
+
+
+def migrate_add_url_enabled(conn: sqlite3.Connection) -> None:
+    """Add the enabled flag to the rpc_urls table, with a partial index over the enabled urls."""
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({TABLE_RPC_URLS})")]
+    if "enabled" not in columns:
+        conn.execute(f"ALTER TABLE {TABLE_RPC_URLS} ADD COLUMN enabled INTEGER NOT NULL DEFAULT 1")
+    conn.execute(
+        f"CREATE INDEX IF NOT EXISTS idx_rpc_urls_chain_name_enabled ON {TABLE_RPC_URLS} (chain_name) WHERE enabled = 1"
+    )
+
+
+def migrate_cascade_url_deletes(conn: sqlite3.Connection) -> None:
+    """Rebuild the rpc_urls table with a foreign key that deletes the urls of a deleted chain.
+
+    SQLite can't alter a foreign key, so the table is copied into a new one which replaces it.
+    Urls already orphaned are kept as they are, see the /vacuum/orphans route.
+    """
+    conn.execute(f"""CREATE TABLE {TABLE_RPC_URLS}_new
+                    (url TEXT PRIMARY KEY UNIQUE COLLATE NOCASE NOT NULL,
+                    chain_name TEXT COLLATE NOCASE NOT NULL,
+                    host TEXT COLLATE NOCASE,
+                    provider TEXT COLLATE NOCASE,
+                    enabled INTEGER NOT NULL DEFAULT 1,
+                    FOREIGN KEY(chain_name) REFERENCES {TABLE_CHAINS}(name) ON DELETE CASCADE)""")
+    conn.execute(
+        f"INSERT INTO {TABLE_RPC_URLS}_new (url, chain_name, host, provider, enabled) "
+        f"SELECT url, chain_name, host, provider, enabled FROM {TABLE_RPC_URLS}"
+    )
+    conn.execute(f"DROP TABLE {TABLE_RPC_URLS}")
+    conn.execute(f"ALTER TABLE {TABLE_RPC_URLS}_new RENAME TO {TABLE_RPC_URLS}")
+    conn.execute(f"CREATE INDEX idx_rpc_urls_host ON {TABLE_RPC_URLS} (host)")
+    conn.execute(f"CREATE INDEX idx_rpc_urls_provider ON {TABLE_RPC_URLS} (provider)")
+    conn.execute(
+        f"CREATE INDEX idx_rpc_urls_chain_name_enabled ON {TABLE_RPC_URLS} (chain_name) WHERE enabled = 1"
+    )
+    # Serves the foreign key's lookups of the urls of a deleted chain
+    conn.execute(f"CREATE INDEX idx_rpc_urls_chain_name ON {TABLE_RPC_URLS} (chain_name)")
+
+
+def migrate_add_data_version(conn: sqlite3.Connection) -> None:
+    """Add the meta table with a data version, which triggers increment on every change to the data.
+
+    The generation identifies the database file, so that versions of different files never match.
+    """
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {TABLE_META} (key TEXT PRIMARY KEY NOT NULL, value NOT NULL)")
+    conn.execute(f"INSERT OR IGNORE INTO {TABLE_META} (key, value) VALUES ('generation', lower(hex(randomblob(8))))")
+    conn.execute(f"INSERT OR IGNORE INTO {TABLE_META} (key, value) VALUES ('data_version', 0)")
+    for table in (TABLE_CHAINS, TABLE_RPC_URLS):
+        for operation in ("INSERT", "UPDATE", "DELETE"):
+            conn.execute(
+                f"""CREATE TRIGGER IF NOT EXISTS {table}_{operation.lower()}_data_version AFTER {operation} ON {table}
+                    BEGIN UPDATE {TABLE_META} SET value = value + 1 WHERE key = 'data_version'; END"""
+            )
+
+
+def migrate_add_chain_identifiers(conn: sqlite3.Connection) -> None:
+    """Add the optional chain ID and genesis hash columns to the chains table, with unique indexes.
+
+    The indexes are partial, over the chains whose identifier is known, and serve the lookups by identifier.
+    """
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({TABLE_CHAINS})")]
+    if "chain_id" not in columns:
+        conn.execute(f"ALTER TABLE {TABLE_CHAINS} ADD COLUMN chain_id INTEGER")
+    if "genesis_hash" not in columns:
+        conn.execute(f"ALTER TABLE {TABLE_CHAINS} ADD COLUMN genesis_hash TEXT COLLATE NOCASE")
+    conn.execute(
+        f"CREATE UNIQUE INDEX IF NOT EXISTS idx_chains_chain_id ON {TABLE_CHAINS} (chain_id) WHERE chain_id IS NOT NULL"
+    )
+    conn.execute(
+        f"CREATE UNIQUE INDEX IF NOT EXISTS idx_chains_genesis_hash ON {TABLE_CHAINS} (genesis_hash) "
+        "WHERE genesis_hash IS NOT NULL"
+    )
+
+
+# Ordered schema migrations, the database file stores how many it has seen as PRAGMA user_version
+MIGRATIONS = [
+    migrate_add_url_host,
+    migrate_add_url_enabled,
+    migrate_cascade_url_deletes,
+    migrate_add_data_version,
+    migrate_add_chain_identifiers,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def host_and_provider(url: str) -> tuple:
+    """Return the host and provider parts of a url, e.g. ('api-x.n.dwellir.com', 'dwellir.com').
+
+    The provider is the host's two last domain labels, IP addresses are their own provider.
+    """
+    host = (urlparse(url).hostname or "").lower()
+    labels = host.split(".")
+    if len(labels) <= 2 or all(label.isdigit() for label in labels):
+        return host, host
+    return host, ".".join(labels[-2:])
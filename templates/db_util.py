@@ -8,18 +8,29 @@ Can access the endpoint database through two means:
 """
 
 import argparse
+import gzip
+import hashlib
 import json
+import shutil
 import sqlite3
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from pathlib import Path
 
 import requests
 import websocket
 
+import db_repository
+from db_schema import init_database
+from endpointdb_client import EndpointDBClient, EndpointDBError
+
 DEFAULT_URL = 'http://localhost:8000'
 
 PATH_DIR = Path(__file__).parent.absolute()
 PATH_DEFAULT_AUTH_PW = PATH_DIR / 'auth_password'
 PATH_DEFAULT_DB = PATH_DIR / 'live_database.db'
+PATH_DEFAULT_REPLICATION = PATH_DIR / 'replication.json'
 PATH_DEFAULT_DB_JSON_DIR = PATH_DIR / 'db_json'
 PATH_DEFAULT_CHAINS = PATH_DEFAULT_DB_JSON_DIR / 'chains.json'
 PATH_DEFAULT_RPC_URLS = PATH_DEFAULT_DB_JSON_DIR / 'rpc_urls.json'
@@ -27,39 +38,91 @@ PATH_DEFAULT_IN_DIR = PATH_DIR / 'in'
 PATH_DEFAULT_IN_CHAINS = PATH_DEFAULT_IN_DIR / 'chains.json'
 PATH_DEFAULT_IN_RPC_URLS = PATH_DEFAULT_IN_DIR / 'rpc_urls.json'
 PATH_DEFAULT_OUT_DIR = PATH_DIR / 'out'
+PATH_DEFAULT_SNAPSHOT = PATH_DEFAULT_OUT_DIR / 'endpoints.db'
+PATH_DEFAULT_BACKUP_DIR = PATH_DIR / 'backups'
 
-TABLE_CHAINS = 'chains'
-TABLE_RPC_URLS = 'rpc_urls'
+# JSON-RPC request that returns a chain's identifier, with the column it's stored in, by API class
+IDENTIFIER_REQUESTS = {
+    'ethereum': ('eth_chainId', [], 'chain_id'),
+    'substrate': ('chain_getBlockHash', [0], 'genesis_hash'),
+}
+# Database pages copied per step of a backup, the database is unlocked for other connections between steps
+BACKUP_PAGES_PER_STEP = 1024
+PATH_DEFAULT_CACHE_DIR = Path.home() / '.cache' / 'endpointdb'
 
 
 def main() -> None:
     parser = argparse.ArgumentParser(description='Utility script to work with an SQLite database served by a Flask API')
     subparsers = parser.add_subparsers()
+    # Init
+    parser_init = subparsers.add_parser('init', help='Create or migrate a local database to the current schema')
+    parser_init.add_argument('-db', '--target_db', type=str, required=True, help='The path to the local database file')
+    parser_init.set_defaults(func=init_data)
     # Import
     parser_import = subparsers.add_parser('import', help='Import data into a database from JSON files')
     parser_import.add_argument('--chains', type=str,
                                help=f'JSON file with chains to import, default={PATH_DEFAULT_IN_CHAINS}')
     parser_import.add_argument('--rpc_urls', type=str,
                                help=f'JSON file with RPC URL:s to import, default={PATH_DEFAULT_IN_RPC_URLS}')
+    parser_import.add_argument('--replace', action='store_true',
+                               help='Replace the local database with the imported data, built in a new file and copied in one step')
+    parser_import.add_argument('--upsert', action='store_true',
+                               help='Update existing chains and RPC URL:s of the local database rather than skip them')
     parser_import.set_defaults(func=import_data, chains=str(PATH_DEFAULT_IN_CHAINS), rpc_urls=str(PATH_DEFAULT_IN_RPC_URLS))
     import_target_group = parser_import.add_mutually_exclusive_group(required=True)
     import_target_group.add_argument('-db', '--target_db', type=str, help='The path to the local database file')
     import_target_group.add_argument('-url', '--target_url', type=str, help='The url for the API of the database')
+    # Database actions, used by the charm
+    parser_action = subparsers.add_parser('action', help='Run a database action with JSON parameters from stdin, writing JSON results')
+    parser_action.add_argument('name', type=str, choices=sorted(DATABASE_ACTIONS), help='The action to run')
+    parser_action.add_argument('-db', '--target_db', type=str, help=f'The path to the local database file, default={PATH_DEFAULT_DB}')
+    parser_action.set_defaults(func=run_action, target_db=str(PATH_DEFAULT_DB))
     # Export
     parser_export = subparsers.add_parser('export', help='Export data from a database to JSON files')
     parser_export.add_argument('--target', type=str,
                                help=f'Directory the JSON:s will exported to, default={PATH_DEFAULT_OUT_DIR}')
     parser_export.add_argument('--force', action='store_true', help='Force export to overwrite files without asking')
     parser_export.set_defaults(func=export_data, target=str(PATH_DEFAULT_OUT_DIR))
+    add_cache_arguments(parser_export)
     export_target_group = parser_export.add_mutually_exclusive_group(required=True)
     export_target_group.add_argument('-db', '--source_db', type=str, help='The path to the local database file')
     export_target_group.add_argument('-url', '--source_url', type=str, help='The URL for the API of the database')
 
+    # Snapshot
+    parser_snapshot = subparsers.add_parser('snapshot', help='Export a read-only SQLite snapshot of a database')
+    parser_snapshot.add_argument('--target', type=str,
+                                 help=f'File the snapshot is written to, default={PATH_DEFAULT_SNAPSHOT}')
+    parser_snapshot.set_defaults(func=export_snapshot, target=str(PATH_DEFAULT_SNAPSHOT))
+    snapshot_source_group = parser_snapshot.add_mutually_exclusive_group(required=True)
+    snapshot_source_group.add_argument('-db', '--source_db', type=str, help='The path to the local database file')
+    snapshot_source_group.add_argument('-url', '--source_url', type=str, help='The URL for the API of the database')
+
+    # Replicate
+    parser_replicate = subparsers.add_parser('replicate', help='Replace a local database with a snapshot of the writer\'s')
+    parser_replicate.add_argument('-url', '--source_url', type=str,
+                                  help=f'The URL for the API of the writer, default=writer_url in {PATH_DEFAULT_REPLICATION}')
+    parser_replicate.add_argument('-db', '--target_db', type=str, help=f'The path to the local database file, default={PATH_DEFAULT_DB}')
+    parser_replicate.set_defaults(func=replicate, target_db=str(PATH_DEFAULT_DB))
+
+    # Backup and restore
+    parser_backup = subparsers.add_parser('backup', help='Make a compressed, checksummed backup of a live database')
+    parser_backup.add_argument('-db', '--source_db', type=str, help=f'The path to the local database file, default={PATH_DEFAULT_DB}')
+    parser_backup.add_argument('--target', type=str,
+                               help=f'File the backup is written to, default=endpointdb-<timestamp>.db.gz in {PATH_DEFAULT_BACKUP_DIR}')
+    parser_backup.add_argument('--pages', type=int, help=f'Pages copied per backup step, default={BACKUP_PAGES_PER_STEP}')
+    parser_backup.set_defaults(func=backup, source_db=str(PATH_DEFAULT_DB), pages=BACKUP_PAGES_PER_STEP)
+    parser_restore = subparsers.add_parser('restore', help='Restore a live database from a backup')
+    parser_restore.add_argument('backup', type=str, help='The backup file to restore')
+    parser_restore.add_argument('-db', '--target_db', type=str, help=f'The path to the local database file, default={PATH_DEFAULT_DB}')
+    parser_restore.add_argument('--skip-checksum', action='store_true', help='Restore without a checksum file to verify the backup with')
+    parser_restore.set_defaults(func=restore, target_db=str(PATH_DEFAULT_DB))
+
     # Make an RPC request
     parser_request = subparsers.add_parser('request', help='Send a request to the Flask API serving the database')
     parser_request.add_argument('--url', type=str, help='The url for the API of the database')
     parser_request.add_argument('--auth-pw', type=str, help='The authentication password to get the access token for the API')
     parser_request.set_defaults(url=DEFAULT_URL)
+    add_cache_arguments(parser_request)
     request_sp = parser_request.add_subparsers()
     # Chains
     request_chains = request_sp.add_parser('chains', help='Get all chains')
@@ -81,6 +144,13 @@ def main() -> None:
     request_delete_rpc = request_sp.add_parser('delete_rpc', help='Delete a URL from the database')
     request_delete_rpc.add_argument('rpc', type=str, help='The RPC URL that should be deleted from the DB')
     request_delete_rpc.set_defaults(func=delete_rpc)
+    for action in ('disable', 'enable'):
+        request_toggle_rpcs = request_sp.add_parser(f'{action}_rpcs', help=f'{action.capitalize()} RPC URL:s in bulk')
+        toggle_target_group = request_toggle_rpcs.add_mutually_exclusive_group(required=True)
+        toggle_target_group.add_argument('--urls', type=str, nargs='+', help=f'The RPC URL:s to {action}')
+        toggle_target_group.add_argument('--chain', type=str, help=f'{action.capitalize()} all RPC URL:s of the chain')
+        toggle_target_group.add_argument('--host', type=str, help=f'{action.capitalize()} all RPC URL:s of the host or provider')
+        request_toggle_rpcs.set_defaults(func=set_rpcs_enabled, action=action)
 
     # Validate JSON files
     parser_json = subparsers.add_parser('json', help='Check and validate JSON files with chains and RPC:s')
@@ -90,10 +160,26 @@ def main() -> None:
     parser_json.add_argument('-f', '--filter', type=str, help='Filter the list of chains to validate')
     parser_json.set_defaults(func=validate_json, directory=str(PATH_DEFAULT_OUT_DIR))
 
+    # Probe chain identifiers
+    parser_identify = subparsers.add_parser('identify', help='Probe the chains\' RPC URL:s for their chain ID:s and genesis hashes')
+    parser_identify.add_argument('-db', '--target_db', type=str, help=f'The path to the local database file, default={PATH_DEFAULT_DB}')
+    parser_identify.add_argument('--all', action='store_true', help='Probe all chains, not only those whose identifier is unknown')
+    parser_identify.add_argument('--workers', type=int, help='Number of chains probed concurrently, default=16')
+    parser_identify.add_argument('--timeout', type=float, help='Timeout of each probe in seconds, default=5')
+    parser_identify.set_defaults(func=identify, target_db=str(PATH_DEFAULT_DB), workers=16, timeout=5)
+
     args = parser.parse_args()
     args.func(args)
 
 
+# # # INIT # # #
+
+def init_data(args) -> None:
+    print(f'Init target: database on path {args.target_db}')
+    init_database(args.target_db)
+    print('> Database schema is up to date')
+
+
 # # # IMPORT # # #
 
 def import_data(args) -> None:
@@ -104,88 +190,196 @@ def import_data(args) -> None:
     if args.target_url:
         print(f'Import target: API at URL {args.target_url}')
         api_import_from_json_files(chains, rpc_urls, args.target_url)
-    if args.target_db:
+    if args.target_db and args.replace:
+        print(f'Import target: new database replacing the one on path {args.target_db}')
+        local_import_replace(chains or [], rpc_urls or [], args.target_db)
+    elif args.target_db:
         print(f'Import target: database on path {args.target_db}')
-        local_import_from_json_files(chains, rpc_urls, args.target_db)
+        local_import_from_json_files(chains or [], rpc_urls or [], args.target_db, upsert=args.upsert)
 
 
-def api_import_from_json_files(chains: dict, rpc_urls: dict, api_url: str) -> None:
+def api_import_from_json_files(chains: dict, rpc_urls: dict, api_url: str, password: str = '') -> None:
     """Imports data from JSON files into an SQLite database.
     Assumes the JSON files has a specific format, see `db_json` folder in this repository.
     """
-    authorization_header = get_auth_header(api_url)
-
-    if chains:
-        url_format = api_url + '/create_chain'
-        unique_chain_counter = 0
-        for chain in chains:
-            response = requests.post(url_format, json=chain, headers=authorization_header, timeout=5)
-            if response.status_code == 201:
-                print(f'> Added chain {chain["name"]}')
-            elif "UNIQUE constraint failed" in response.text:
-                unique_chain_counter = unique_chain_counter + 1
-            else:
-                print(f"Error: {response.status_code}", response.text)
-        if unique_chain_counter > 0:
-            print(f"{unique_chain_counter} chains already existing in the database were skipped")
-
-    if rpc_urls:
-        url_format = api_url + '/create_rpc_url'
-        unique_rpc_counter = 0
-        for rpc_url in rpc_urls:
-            response = requests.post(url_format, json=rpc_url, headers=authorization_header, timeout=5)
-            if response.status_code == 201:
-                print(f'> Added RPC URL {rpc_url["url"]}')
-            elif "UNIQUE constraint failed" in response.text:
-                unique_rpc_counter = unique_rpc_counter + 1
-            else:
-                print(f"Error: {response.status_code}", response.text)
-        if unique_rpc_counter > 0:
-            print(f"{unique_rpc_counter} RPC URL:s already existing in the database were skipped")
-
-
-def local_import_from_json_files(chains: dict, rpc_urls: dict, db_file: str) -> None:
-    """Imports data from JSON files into an SQLite database.
+    with EndpointDBClient(api_url, password=password, password_file=PATH_DEFAULT_AUTH_PW) as client:
+        if chains:
+            unique_chain_counter = 0
+            for chain in chains:
+                try:
+                    client.create_chain(chain['name'], chain['api_class'], chain.get('chain_id'), chain.get('genesis_hash'))
+                    print(f'> Added chain {chain["name"]}')
+                except EndpointDBError as e:
+                    if "UNIQUE constraint failed" in e.message:
+                        unique_chain_counter = unique_chain_counter + 1
+                    else:
+                        print(f"Error: {e.status_code}", e.message)
+            if unique_chain_counter > 0:
+                print(f"{unique_chain_counter} chains already existing in the database were skipped")
+
+        if rpc_urls:
+            unique_rpc_counter = 0
+            for rpc_url in rpc_urls:
+                try:
+                    client.create_rpc_url(rpc_url['url'], rpc_url['chain_name'])
+                    print(f'> Added RPC URL {rpc_url["url"]}')
+                except EndpointDBError as e:
+                    if "UNIQUE constraint failed" in e.message:
+                        unique_rpc_counter = unique_rpc_counter + 1
+                    else:
+                        print(f"Error: {e.status_code}", e.message)
+            if unique_rpc_counter > 0:
+                print(f"{unique_rpc_counter} RPC URL:s already existing in the database were skipped")
+
+
+def local_import_from_json_files(chains: list, rpc_urls: list, db_file: str, upsert: bool = False) -> None:
+    """Imports data from JSON files into an SQLite database, in one transaction.
     Assumes the JSON files has a specific format, see `db_json` folder in this repository.
+    Chains and RPC URL:s already in the database are skipped, or updated if upsert, as are RPC URL:s of chains
+    that exist neither in the database nor in the import. If any other entry is invalid, nothing is imported.
     """
-    conn = sqlite3.connect(db_file)
-    conn.execute('PRAGMA foreign_keys = ON')
-    cursor = conn.cursor()
-
-    if chains:
-        unique_chain_counter = 0
-        for entry in chains:
-            name = entry['name']
-            api_class = entry['api_class']
-            query = f'INSERT INTO {TABLE_CHAINS} (name, api_class) VALUES (?, ?)'
-            values = (name, api_class)
-            try:
-                cursor.execute(query, values)
-                print(f'> Added chain {entry["name"]}')
-            except sqlite3.IntegrityError as e:
-                if "UNIQUE constraint failed" in str(e):
-                    unique_chain_counter = unique_chain_counter + 1
-        if unique_chain_counter > 0:
-            print(f"{unique_chain_counter} chains already existing in the database were skipped")
-
-    if rpc_urls:
-        unique_rpc_counter = 0
-        for entry in rpc_urls:
-            url = entry['url']
-            chain_name = entry['chain_name']
-            query = f'INSERT INTO {TABLE_RPC_URLS} (url, chain_name) VALUES (?, ?)'
-            values = (url, chain_name)
-            try:
-                cursor.execute(query, values)
-                print(f'> Added RPC URL {entry["url"]}')
-            except sqlite3.IntegrityError as e:
-                if "UNIQUE constraint failed" in str(e):
-                    unique_rpc_counter = unique_rpc_counter + 1
-        if unique_rpc_counter > 0:
-            print(f"{unique_rpc_counter} RPC URL:s already existing in the database were skipped")
-
-    conn.commit()
-    conn.close()
+    try:
+        with db_repository.transaction(db_file) as conn:
+            result = local_import(conn, chains, rpc_urls, upsert=upsert)
+    except ValueError as e:
+        print(f'Error: {e}, nothing was imported')
+        return
+    if result['orphans']:
+        print(f"{result['orphans']} RPC URL:s of chains missing from the database were skipped: {result['missing_chains']}")
+    if upsert:
+        print(f"> Added or updated {result['chains']} chains and {result['rpc_urls']} RPC URL:s")
+        return
+    print(f"> Added {result['chains']} chains and {result['rpc_urls']} RPC URL:s")
+    if result['skipped_chains'] or result['skipped_rpc_urls']:
+        print(f"{result['skipped_chains']} chains and {result['skipped_rpc_urls']} RPC URL:s already existing in the database were skipped")
+
+
+def local_import(conn: sqlite3.Connection, chains: list, rpc_urls: list, upsert: bool = False) -> dict:
+    """Imports chains and RPC URL:s in the connection's transaction, returns the counts of what was and wasn't imported.
+
+    See local_import_from_json_files, raises ValueError if any entry is invalid.
+    """
+    if upsert:
+        chain_count = db_repository.upsert_chains(conn, chains)
+    else:
+        chain_count = db_repository.insert_chains(conn, chains)
+    # Entries without a chain name aren't orphans, they're invalid and left for the insert to reject
+    names = [entry['chain_name'] for entry in rpc_urls if isinstance(entry.get('chain_name'), str)]
+    missing = {name.lower() for name in db_repository.missing_chains(conn, names)}
+    orphans, rpc_urls = partition(rpc_urls, lambda entry: isinstance(entry.get('chain_name'), str)
+                                  and entry['chain_name'].lower() in missing)
+    if upsert:
+        url_count = db_repository.upsert_rpc_urls(conn, rpc_urls)
+    else:
+        url_count = db_repository.insert_rpc_urls(conn, rpc_urls)
+    return {'chains': chain_count, 'rpc_urls': url_count, 'skipped_chains': len(chains) - chain_count,
+            'skipped_rpc_urls': len(rpc_urls) - url_count, 'orphans': len(orphans), 'missing_chains': sorted(missing)}
+
+
+def partition(entries: list, predicate) -> tuple:
+    """Split the entries into those the predicate holds for and the rest, keeping their order."""
+    matching, rest = [], []
+    for entry in entries:
+        (matching if predicate(entry) else rest).append(entry)
+    return matching, rest
+
+
+def local_import_replace(chains: list, rpc_urls: list, db_file: str) -> None:
+    """Build a new database from the chains and RPC URL:s, then copy it into the database file in one step.
+
+    The new database is bulk loaded in one transaction, without journal, with its indexes and triggers
+    created after the load, and vacuumed. It's copied in like a restored backup, see copy_database, so the
+    database can be replaced while it's being served. Readers of the database see either the old data or
+    all of the imported data. Invalid entries, duplicates and RPC URL:s of chains missing from the import
+    are skipped.
+    """
+    target = Path(db_file)
+    tmp_db = target.with_name(f'.{target.name}.import.tmp')
+    tmp_db.unlink(missing_ok=True)
+    try:
+        init_database(str(tmp_db))
+        conn = sqlite3.connect(tmp_db)
+        try:
+            conn.execute('PRAGMA journal_mode = OFF')
+            conn.execute('PRAGMA synchronous = OFF')
+            with conn:
+                chain_count, url_count = db_repository.bulk_load(conn, chains, rpc_urls)
+            conn.execute('VACUUM')
+        finally:
+            conn.close()
+        copy_database(tmp_db, db_file)
+    finally:
+        # Only left behind if the import failed, a half built database must not be copied in later
+        tmp_db.unlink(missing_ok=True)
+    # The database no longer holds the snapshot a replica last downloaded, see EndpointDBClient.download_snapshot
+    target.with_name(target.name + '.etag').unlink(missing_ok=True)
+    print(f'> Imported {chain_count} chains and {url_count} RPC URL:s')
+    if len(chains) > chain_count or len(rpc_urls) > url_count:
+        print(f'{len(chains) - chain_count} chains and {len(rpc_urls) - url_count} RPC URL:s, invalid, duplicates or of missing chains, were skipped')
+
+
+# # # ACTION # # #
+
+
+def run_action(args) -> None:
+    """Run a database action in one transaction, with JSON parameters read from stdin and JSON results written to stdout.
+
+    Used by the charm's actions. If the action fails nothing is written, and the error is written to stderr.
+    """
+    params = json.load(sys.stdin)
+    try:
+        with db_repository.transaction(args.target_db) as conn:
+            results = DATABASE_ACTIONS[args.name](conn, params)
+    except (ValueError, sqlite3.Error) as e:
+        sys.exit(f'Error: {e}')
+    print(json.dumps(results))
+
+
+def action_add_chains(conn: sqlite3.Connection, params: dict) -> dict:
+    added = db_repository.insert_chains(conn, params['chains'])
+    return {'added': added, 'skipped': len(params['chains']) - added}
+
+
+def action_add_rpc_urls(conn: sqlite3.Connection, params: dict) -> dict:
+    added = db_repository.insert_rpc_urls(conn, params['rpc_urls'])
+    return {'added': added, 'skipped': len(params['rpc_urls']) - added}
+
+
+def action_list_chains(conn: sqlite3.Connection, params: dict) -> dict:
+    return {'chains': db_repository.list_chains(conn)}
+
+
+def action_list_rpc_urls(conn: sqlite3.Connection, params: dict) -> dict:
+    return {'rpc_urls': db_repository.list_rpc_urls(conn, params.get('chain', ''))}
+
+
+def action_chain_info(conn: sqlite3.Connection, params: dict) -> dict:
+    return {'chain': db_repository.chain_info(conn, params['chain'])}
+
+
+def action_delete_rpc_urls(conn: sqlite3.Connection, params: dict) -> dict:
+    return {'deleted': db_repository.delete_rpc_urls(conn, params['urls'])}
+
+
+def action_delete_chains(conn: sqlite3.Connection, params: dict) -> dict:
+    chain_count, url_count = db_repository.delete_chains(conn, params['chains'])
+    return {'deleted_chains': chain_count, 'deleted_urls': url_count}
+
+
+def action_import(conn: sqlite3.Connection, params: dict) -> dict:
+    return local_import(conn, params['chains'], params['rpc_urls'], upsert=params.get('upsert', False))
+
+
+DATABASE_ACTIONS = {
+    'add_chains': action_add_chains,
+    'add_rpc_urls': action_add_rpc_urls,
+    'list_chains': action_list_chains,
+    'list_rpc_urls': action_list_rpc_urls,
+    'chain_info': action_chain_info,
+    'delete_rpc_urls': action_delete_rpc_urls,
+    'delete_chains': action_delete_chains,
+    'import': action_import,
+}
 
 
 # # # EXPORT # # #
@@ -197,19 +391,15 @@ def export_data(args) -> None:
         Path(args.target).mkdir(parents=True, exist_ok=True)
     if args.source_url:
         print(f'Export source: API at URL {args.source_url}')
-        api_export_json(Path(args.target) / 'chains.json', args.source_url + '/all/chains', sort_by='name', force=args.force)
-        api_export_json(Path(args.target) / 'rpc_urls.json', args.source_url + '/all/rpc_urls', sort_by='chain_name', force=args.force)
+        with EndpointDBClient(args.source_url, cache_dir=get_cache_dir(args)) as client:
+            api_export_json(Path(args.target) / 'chains.json', client.all_chains(), sort_by='name', force=args.force)
+            api_export_json(Path(args.target) / 'rpc_urls.json', client.all_rpc_urls(), sort_by='chain_name', force=args.force)
     if args.source_db:
         print(f'Export source: database on path {args.source_db}')
         local_export_to_json_files(Path(args.target) / 'chains.json', Path(args.target) / 'rpc_urls.json', args.source_db, force=args.force)
 
 
-def api_export_json(path: Path, url: str, sort_by: str, force: bool) -> None:
-    response = requests.get(url, timeout=5)
-    if response.status_code == 200:
-        data = response.json()
-    else:
-        print(response.text)
+def api_export_json(path: Path, data: list, sort_by: str, force: bool) -> None:
     sorted_data = sorted(data, key=lambda x: x[sort_by])
     if allow_overwrite(path, force):
         export_to_file(path, sorted_data)
@@ -219,93 +409,259 @@ def local_export_to_json_files(target_chains: Path, target_rpc_urls: Path, db_fi
     """Exports data from an SQLite database into JSON files.
     The output JSON files has a specific format, see `db_json` folder in this repository.
     """
-    conn = sqlite3.connect(db_file)
-    conn.execute('PRAGMA foreign_keys = ON')
-    cursor = conn.cursor()
-
-    if target_chains:
-        query_chains = f'SELECT name, api_class FROM {TABLE_CHAINS}'
-        entries_chains = cursor.execute(query_chains).fetchall()
-        local_export_chains(target_chains, entries_chains, force=force)
-
-    if target_rpc_urls:
-        query_rpc_urls = f'SELECT url, chain_name FROM {TABLE_RPC_URLS}'
-        entries_rpc_urls = cursor.execute(query_rpc_urls).fetchall()
-        local_export_rpc_urls(target_rpc_urls, entries_rpc_urls, force=force)
-
-    conn.commit()
-    conn.close()
+    with db_repository.transaction(db_file) as conn:
+        if target_chains:
+            local_export_chains(target_chains, db_repository.list_chains(conn), force=force)
+        if target_rpc_urls:
+            local_export_rpc_urls(target_rpc_urls, db_repository.list_rpc_urls(conn), force=force)
 
 
 def local_export_chains(target_chains: Path, entries: list, force: bool) -> None:
-    data_chains = []
-    for entry in entries:
-        name = entry[0]
-        api_class = entry[1]
-        data_chains.append({'name': name, 'api_class': api_class})
-    sorted_chains = sorted(data_chains, key=lambda x: x['name'])
+    sorted_chains = sorted(entries, key=lambda x: x['name'])
     if allow_overwrite(target_chains, force):
         export_to_file(target_chains, sorted_chains)
 
 
 def local_export_rpc_urls(target_rpc_urls: Path, entries: list, force: bool) -> None:
-    data_rpc_urls = []
-    for entry in entries:
-        url = entry[0]
-        chain_name = entry[1]
-        data_rpc_urls.append({'url': url, 'chain_name': chain_name})
+    data_rpc_urls = [{'url': entry['url'], 'chain_name': entry['chain_name']} for entry in entries]
     sorted_urls = sorted(data_rpc_urls, key=lambda x: x['chain_name'])
     if allow_overwrite(target_rpc_urls, force):
         export_to_file(target_rpc_urls, sorted_urls)
 
 
+# # # SNAPSHOT # # #
+
+def export_snapshot(args) -> None:
+    print(f'Snapshot target: file {args.target}')
+    if args.source_url:
+        print(f'Snapshot source: API at URL {args.source_url}')
+        with EndpointDBClient(args.source_url) as client:
+            updated = client.download_snapshot(args.target)
+        print('> Snapshot updated' if updated else '> Snapshot already up to date')
+    if args.source_db:
+        print(f'Snapshot source: database on path {args.source_db}')
+        local_export_snapshot(args.source_db, Path(args.target))
+        print('> Snapshot updated')
+
+
+def replicate(args) -> None:
+    """Replace the local database with the writer's current snapshot, if it has changed since the last replication.
+
+    The snapshot is swapped in atomically over the database file, the app opens a connection per request
+    and reads the new file from the next request on.
+    """
+    source_url = args.source_url
+    if not source_url:
+        replication = load_json_file(PATH_DEFAULT_REPLICATION) or {}
+        source_url = replication.get('writer_url')
+    if not source_url:
+        print(f'No writer to replicate, neither --source_url nor writer_url in {PATH_DEFAULT_REPLICATION} given')
+        return
+    with EndpointDBClient(source_url) as client:
+        updated = client.download_snapshot(args.target_db)
+    print(f'> Replicated {source_url} to {args.target_db}' if updated else '> Replica already up to date')
+
+
+def local_export_snapshot(db_file: str, target: Path) -> None:
+    """Write a compact copy of an SQLite database with VACUUM INTO, swapped in atomically over target."""
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp_target = target.with_name(f'.{target.name}.tmp')
+    tmp_target.unlink(missing_ok=True)
+    conn = sqlite3.connect(db_file)
+    conn.execute('VACUUM INTO ?', (str(tmp_target),))
+    conn.close()
+    tmp_target.replace(target)
+
+
+# # # BACKUP # # #
+
+def backup(args) -> None:
+    target = Path(args.target) if args.target else default_backup_path()
+    print(f'Backup source: database on path {args.source_db}')
+    checksum = backup_database(args.source_db, target, args.pages)
+    print(f'> Backup written to {target}, sha256 {checksum}')
+
+
+def restore(args) -> None:
+    print(f'Restore target: database on path {args.target_db}')
+    restore_database(Path(args.backup), args.target_db, verify=not args.skip_checksum)
+    print(f'> Database restored from {args.backup}')
+
+
+def default_backup_path() -> Path:
+    timestamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    return PATH_DEFAULT_BACKUP_DIR / f'endpointdb-{timestamp}.db.gz'
+
+
+def checksum_path(backup_file: Path) -> Path:
+    return backup_file.with_name(backup_file.name + '.sha256')
+
+
+def backup_database(db_file: str, target: Path, pages: int = BACKUP_PAGES_PER_STEP) -> str:
+    """Back up a live database to a gzip compressed file, with its SHA-256 checksum in '<target>.sha256'.
+
+    The database is copied with the SQLite backup API a number of pages at a time, other connections
+    can read and write between the steps. Returns the checksum of the compressed file.
+    """
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp_db = target.with_name(f'.{target.name}.db.tmp')
+    source = sqlite3.connect(db_file)
+    destination = sqlite3.connect(tmp_db)
+    try:
+        source.backup(destination, pages=pages)
+    finally:
+        destination.close()
+        source.close()
+    sha256 = hashlib.sha256()
+    tmp_target = target.with_name(f'.{target.name}.tmp')
+    with open(tmp_db, 'rb') as f_in, open(tmp_target, 'wb') as f_out:
+        with gzip.GzipFile(fileobj=HashingWriter(f_out, sha256), mode='wb') as f_gzip:
+            shutil.copyfileobj(f_in, f_gzip, length=1 << 20)
+    tmp_db.unlink()
+    tmp_target.replace(target)
+    checksum_path(target).write_text(f'{sha256.hexdigest()}  {target.name}\n', encoding='utf-8')
+    return sha256.hexdigest()
+
+
+def restore_database(backup_file: Path, db_file: str, verify: bool = True) -> None:
+    """Restore a live database from a backup made by backup_database, after verifying its checksum.
+
+    The backup is decompressed, checked for integrity and migrated to the current schema beside the
+    database, then copied into it in one step with the SQLite backup API, so that connections to the
+    database see either all of the old data or all of the restored data. The restored data gets a new
+    data version generation, ETags of the data before the restore never match it.
+    """
+    if verify:
+        expected = checksum_path(backup_file).read_text(encoding='utf-8').split()[0]
+        if file_sha256(backup_file) != expected:
+            raise ValueError(f'Checksum mismatch for {backup_file}, expected sha256 {expected}')
+    tmp_db = Path(db_file).with_name(f'.{Path(db_file).name}.restore.tmp')
+    try:
+        with gzip.open(backup_file, 'rb') as f_in, open(tmp_db, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out, length=1 << 20)
+        source = sqlite3.connect(tmp_db)
+        integrity = source.execute('PRAGMA integrity_check').fetchone()[0]
+        source.close()
+        if integrity != 'ok':
+            raise ValueError(f'Backup {backup_file} failed the integrity check: {integrity}')
+        init_database(str(tmp_db))
+        source = sqlite3.connect(tmp_db)
+        try:
+            source.execute("UPDATE meta SET value = lower(hex(randomblob(8))) WHERE key = 'generation'")
+            source.commit()
+        finally:
+            source.close()
+        copy_database(tmp_db, db_file)
+    finally:
+        tmp_db.unlink(missing_ok=True)
+
+
+def copy_database(source_file: Path, db_file: str) -> None:
+    """Replace the contents of a live database with those of another database file, in one step.
+
+    The copy is made with the SQLite backup API, which takes the database's locks like any writer and
+    keeps its journal consistent. Unlike swapping the file, it's safe while the app is serving the database:
+    no connection is left reading a replaced file, and no journal of the old file is left behind.
+    """
+    source = sqlite3.connect(source_file)
+    destination = sqlite3.connect(db_file, timeout=30)
+    try:
+        source.backup(destination)
+    finally:
+        destination.close()
+        source.close()
+
+
+class HashingWriter:
+    """A file object wrapper that updates a hash with everything written to the file."""
+
+    def __init__(self, f, hash_object):
+        self.f = f
+        self.hash_object = hash_object
+
+    def write(self, data: bytes) -> int:
+        self.hash_object.update(data)
+        return self.f.write(data)
+
+    def flush(self) -> None:
+        self.f.flush()
+
+
+def file_sha256(path: Path) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
 # # # REQUEST # # #
 
-def make_get_request(url: str) -> None:
-    response = requests.get(url, timeout=5)
-    if response.status_code == 200:
-        data = response.json()
-        for d in data:
-            print(d)
+def get_client(args) -> EndpointDBClient:
+    return EndpointDBClient(args.url, password=args.auth_pw or '', password_file=PATH_DEFAULT_AUTH_PW,
+                            cache_dir=get_cache_dir(args))
+
+
+def print_request(request) -> None:
+    """Print the result of a request made with the API client, or the error the API responded with."""
+    try:
+        result = request()
+    except EndpointDBError as e:
+        print(e.message)
+        return
+    if isinstance(result, list):
+        for r in result:
+            print(r)
     else:
-        print(response.text)
+        print(json.dumps(result))
 
 
 def get_all_chains(args) -> None:
-    make_get_request(args.url + '/all/chains')
+    with get_client(args) as client:
+        print_request(client.all_chains)
 
 
 def get_all_rpc_urls(args) -> None:
-    make_get_request(args.url + '/all/rpc_urls')
+    with get_client(args) as client:
+        print_request(client.all_rpc_urls)
 
 
 def add_rpc(args) -> None:
-    auth_header = get_auth_header(args.url, args.auth_pw)
-    rpc = {'chain_name': args.chain, 'url': args.rpc}
-    response = requests.post(args.url + '/create_rpc_url', json=rpc, headers=auth_header, timeout=5)
-    print(response.text)
+    with get_client(args) as client:
+        print_request(lambda: client.create_rpc_url(args.rpc, args.chain))
 
 
 def delete_rpc(args) -> None:
-    auth_header = get_auth_header(args.url, args.auth_pw)
-    protocol = args.rpc.split('://')[0]
-    address = args.rpc.split('://')[1]
-    response = requests.delete(args.url + f'/delete_url?protocol={protocol}&address={address}', headers=auth_header, timeout=5)
-    print(response.text)
+    with get_client(args) as client:
+        print_request(lambda: client.delete_url(args.rpc))
+
+
+def set_rpcs_enabled(args) -> None:
+    with get_client(args) as client:
+        set_enabled = client.enable_rpc_urls if args.action == 'enable' else client.disable_rpc_urls
+        print_request(lambda: set_enabled(urls=args.urls, chain_name=args.chain, host=args.host))
 
 
 def add_chain(args) -> None:
-    auth_header = get_auth_header(args.url, args.auth_pw)
-    chain = {'name': args.chain, 'api_class': args.api_class}
-    response = requests.post(args.url + '/create_chain', json=chain, headers=auth_header, timeout=5)
-    print(response.text)
+    with get_client(args) as client:
+        print_request(lambda: client.create_chain(args.chain, args.api_class))
 
 
 def delete_chain(args) -> None:
-    auth_header = get_auth_header(args.url, args.auth_pw)
-    chain = args.chain
-    response = requests.delete(args.url + f'/delete_chain?name={chain}', headers=auth_header, timeout=5)
-    print(response.text)
+    with get_client(args) as client:
+        print_request(lambda: client.delete_chain(args.chain))
+
+
+# # # CACHE # # #
+
+def add_cache_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--cache-dir', type=str, default=str(PATH_DEFAULT_CACHE_DIR),
+                        help=f'Directory caching API responses between runs, default={PATH_DEFAULT_CACHE_DIR}')
+    parser.add_argument('--no-cache', action='store_true', help='Neither use nor update the cached API responses')
+
+
+def get_cache_dir(args) -> str:
+    return '' if args.no_cache else args.cache_dir
 
 
 # # # JSON # # #
@@ -374,22 +730,79 @@ def validate_json(args) -> None:
             print(e)
 
 
-# # # UTILS # # #
+# # # IDENTIFY # # #
+
+def identify(args) -> None:
+    print(f'Identify chains of database on path {args.target_db}')
+    local_identify_chains(args.target_db, probe_all=args.all, workers=args.workers, timeout=args.timeout)
+
+
+def local_identify_chains(db_file: str, probe_all: bool = False, workers: int = 16, timeout: float = 5) -> int:
+    """Probe the enabled RPC URL:s of the database's chains for their identifiers, and store the ones found.
+
+    EVM chains are identified by eth_chainId and substrate chains by their genesis hash, chain_getBlockHash(0).
+    The chains are probed concurrently, each through its URL:s in turn until one answers. Returns the number
+    of identifiers that changed.
+    """
+    conn = db_repository.connect(db_file)
+    try:
+        chains = [chain for chain in db_repository.list_chains(conn) if chain['api_class'].lower() in IDENTIFIER_REQUESTS]
+        if not probe_all:
+            chains = [chain for chain in chains if IDENTIFIER_REQUESTS[chain['api_class'].lower()][2] not in chain]
+        urls = {chain['name']: db_repository.chain_urls(conn, chain['name']) for chain in chains}
+    finally:
+        conn.close()
+    print(f'> Probing {len(chains)} chains')
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        probed = list(executor.map(lambda chain: probe_chain_identifier(chain, urls[chain['name']], timeout), chains))
+    identified = [identifiers for identifiers in probed if identifiers]
+    with db_repository.transaction(db_file) as conn:
+        changed = db_repository.set_chain_identifiers(conn, identified)
+    print(f'> Identified {len(identified)} of {len(chains)} chains, {changed} identifiers changed')
+    return changed
+
+
+def probe_chain_identifier(chain: dict, urls: list, timeout: float):
+    """Return the chain's name and identifier from the first of its URL:s that answers, or None if none does."""
+    method, params, column = IDENTIFIER_REQUESTS[chain['api_class'].lower()]
+    # HTTP URL:s first, a request is quicker than a WebSocket handshake
+    for url in sorted(urls, key=lambda url: not url.startswith('http')):
+        try:
+            result = jsonrpc_request(url, method, params, timeout)
+            identifier = int(result, 16) if column == 'chain_id' else result
+        except (requests.exceptions.RequestException, websocket.WebSocketException, OSError, TypeError, ValueError) as e:
+            print(f'#> {url} of {chain["name"]} failed {method}: {e}')
+            continue
+        identifiers = {'name': chain['name'], column: identifier}
+        try:
+            db_repository.validate_chain_identifiers(identifiers)
+        except ValueError as e:
+            print(f'#> {url} of {chain["name"]} answered {method} with {e}')
+            continue
+        return identifiers
+    return None
+
 
-# TODO: this doesn't really return a string, does it?
-def get_auth_header(url: str, password: str = "") -> str:
-    if not password:
-        with open(PATH_DEFAULT_AUTH_PW, 'r', encoding='utf-8') as f:
-            auth_pw = f.readline().strip()
-    elif password:
-        auth_pw = password
+def jsonrpc_request(url: str, method: str, params: list, timeout: float):
+    """Send a JSON-RPC request over HTTP or WebSocket, returns its result, raises ValueError on an error response."""
+    payload = {'jsonrpc': '2.0', 'method': method, 'params': params, 'id': 1}
+    if url.startswith('http'):
+        response = requests.post(url, json=payload, timeout=timeout)
+        response.raise_for_status()
+        data = response.json()
     else:
-        raise ValueError("Missing authentication password for access token request!")
-    token_response = requests.post(url + '/token', json={'username': 'dwellir_endpointdb', 'password': f'{auth_pw}'}, timeout=5)
-    if token_response.status_code != 200:
-        raise requests.exceptions.HTTPError(f'Couldn\'t get access token, {token_response.text}')
-    return {'Authorization': f'Bearer {token_response.json()["access_token"]}'}
+        ws = websocket.create_connection(url, timeout=timeout)
+        try:
+            ws.send(json.dumps(payload))
+            data = json.loads(ws.recv())
+        finally:
+            ws.close()
+    if not isinstance(data, dict) or 'result' not in data:
+        raise ValueError(f'no result in response {data}')
+    return data['result']
+
 
+# # # UTILS # # #
 
 def get_jsonrpc_method(api_class: str) -> str:
     """Get the JSON-RPC method for the API class."""
@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+
+"""Client library for the RPC endpoint database API.
+
+Meant to be embedded by the services that query the endpoint database, and used by db_util.py.
+The client keeps its HTTP connections open between requests, fetches and refreshes the access token
+for the protected routes by itself, retries idempotent requests on connection errors and unavailable
+servers with backoff, and caches the responses of the read routes:
+
+- A response younger than the cache TTL is reused without a request.
+- An older response is revalidated with its ETag, the API's data version, and reused if the API
+  answers 304 Not Modified, so unchanged data is never transferred twice.
+- With a cache directory the responses are also kept on disk, to be reused by later processes.
+
+If the msgpack package is installed the read routes are requested as msgpack, falling back to JSON.
+
+Services with lookups on their hot path can skip the network altogether: download_snapshot fetches
+a read-only SQLite copy of the database, swapped in atomically whenever it changes, and
+EndpointDBSnapshot answers lookups from it in process.
+
+Example:
+
+    client = EndpointDBClient('http://localhost:8000', password_file='/home/ubuntu/auth_password', cache_ttl=10)
+    for url in client.urls('Polkadot'):
+        ...
+    client.disable_rpc_urls(host='dwellir.com')
+"""
+
+import base64
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from urllib.parse import quote, urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import msgpack
+except ImportError:  # The read routes are requested as JSON
+    msgpack = None
+
+USERNAME = 'dwellir_endpointdb'
+MSGPACK_MIMETYPE = 'application/msgpack'
+# Prefer msgpack, which is smaller and faster to decode, the API answers with JSON if it can't serve it
+ACCEPT = f'{MSGPACK_MIMETYPE}, application/json;q=0.9' if msgpack else 'application/json'
+# Refresh the access token this many seconds before it expires
+TOKEN_REFRESH_MARGIN_S = 30
+# Seconds a snapshot's connection is kept open after a reload, for the lookups still running on it
+SNAPSHOT_CLOSE_GRACE_S = 60
+
+
+class EndpointDBError(Exception):
+    """An error response from the endpoint database API."""
+
+    def __init__(self, status_code: int, message: str):
+        super().__init__(f'{status_code}: {message}')
+        self.status_code = status_code
+        self.message = message
+
+
+class EndpointDBClient:
+    """Client for the RPC endpoint database API, see the module docstring."""
+
+    def __init__(self, url: str, password: str = '', password_file: str = '', timeout: float = 5, retries: int = 3,
+                 backoff_factor: float = 0.2, cache_ttl: float = 0, cache_dir: str = '', pool_size: int = 10):
+        """Create a client of the API at url.
+
+        The password, given directly or read from password_file, is only needed for the protected routes.
+        Responses are reused without revalidation for cache_ttl seconds, and kept on disk in cache_dir if given.
+        """
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self._password = password
+        self._password_file = password_file
+        self._token = None
+        self._token_expires_at = 0.0
+        self._cache = {}
+        self._lock = threading.Lock()
+        self.session = requests.Session()
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=('GET', 'HEAD', 'PUT', 'PATCH', 'DELETE'),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def close(self) -> None:
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # # # AUTHENTICATION # # #
+
+    def token(self) -> str:
+        """Return a valid access token, requesting a new one if there's none or it's about to expire."""
+        with self._lock:
+            if self._token is None or time.time() >= self._token_expires_at - TOKEN_REFRESH_MARGIN_S:
+                response = self.session.post(self.url + '/token', json={'username': USERNAME, 'password': self.password()},
+                                             timeout=self.timeout)
+                if response.status_code != 200:
+                    raise EndpointDBError(response.status_code, f'Couldn\'t get access token, {response.text}')
+                self._token = response.json()['access_token']
+                self._token_expires_at = token_expiry(self._token)
+            return self._token
+
+    def password(self) -> str:
+        if self._password:
+            return self._password
+        if self._password_file:
+            with open(self._password_file, 'r', encoding='utf-8') as f:
+                return f.readline().strip()
+        raise ValueError('Missing authentication password for access token request!')
+
+    def auth_header(self) -> dict:
+        return {'Authorization': f'Bearer {self.token()}'}
+
+    # # # READ ROUTES # # #
+
+    def all_chains(self) -> list:
+        return self._get('/all/chains')
+
+    def all_rpc_urls(self, include_disabled: bool = False) -> list:
+        return self._get('/all/rpc_urls', include_disabled_params(include_disabled))
+
+    def chain_by_name(self, name: str):
+        """Return the chain, or None if there's no such chain."""
+        return self._get(f'/get_chain_by_name/{path_segment(name)}', none_if_missing=True)
+
+    def chain_by_url(self, url: str):
+        """Return the chain the RPC URL belongs to, or None if there's no such URL."""
+        return self._get('/get_chain_by_url', split_url(url), none_if_missing=True)
+
+    def chain_by_id(self, identifier):
+        """Return the chain with the chain ID or genesis hash, or None if there's no such chain."""
+        return self._get(f'/chain_by_id/{path_segment(identifier)}', none_if_missing=True)
+
+    def rpc_url(self, url: str):
+        """Return the RPC URL record, or None if there's no such URL."""
+        return self._get('/get_url', split_url(url), none_if_missing=True)
+
+    def urls(self, chain_name: str) -> list:
+        """Return the RPC URL:s of the chain, an empty list if it has none."""
+        return self._get(f'/get_urls/{path_segment(chain_name)}', none_if_missing=True) or []
+
+    def chain_info(self, chain_name: str):
+        """Return the chain with its RPC URL:s, or None if there's no such chain."""
+        return self._get('/chain_info', {'chain_name': chain_name}, none_if_missing=True)
+
+    def providers(self) -> list:
+        return self._get('/providers')
+
+    def urls_by_host(self, host: str, include_disabled: bool = False) -> list:
+        """Return the RPC URL records of the host or provider, an empty list if it has none."""
+        return self._get(f'/urls_by_host/{path_segment(host)}', include_disabled_params(include_disabled), none_if_missing=True) or []
+
+    # # # WRITE ROUTES # # #
+
+    def create_chain(self, name: str, api_class: str, chain_id: int = None, genesis_hash: str = None) -> dict:
+        chain = {'name': name, 'api_class': api_class, 'chain_id': chain_id, 'genesis_hash': genesis_hash}
+        return self._write('POST', '/create_chain', json={key: value for key, value in chain.items() if value is not None})
+
+    def create_rpc_url(self, url: str, chain_name: str) -> dict:
+        return self._write('POST', '/create_rpc_url', json={'url': url, 'chain_name': chain_name})
+
+    def update_url(self, old_url: str, new_url: str, chain_name: str) -> dict:
+        return self._write('PUT', '/update_url', params=split_url(old_url), json={'url': new_url, 'chain_name': chain_name})
+
+    def delete_chain(self, name: str) -> dict:
+        return self._write('DELETE', '/delete_chain', params={'name': name})
+
+    def delete_url(self, url: str) -> dict:
+        return self._write('DELETE', '/delete_url', params=split_url(url))
+
+    def delete_urls(self, chain_name: str) -> dict:
+        return self._write('DELETE', '/delete_urls', params={'chain_name': chain_name})
+
+    def disable_rpc_urls(self, urls: list = None, chain_name: str = None, host: str = None) -> dict:
+        """Disable RPC URL:s, selected by exactly one of a list of URL:s, a chain name or a host/provider."""
+        return self._write('PATCH', '/rpc_urls/disable', json=rpc_url_selection(urls, chain_name, host))
+
+    def enable_rpc_urls(self, urls: list = None, chain_name: str = None, host: str = None) -> dict:
+        """Enable RPC URL:s, selected by exactly one of a list of URL:s, a chain name or a host/provider."""
+        return self._write('PATCH', '/rpc_urls/enable', json=rpc_url_selection(urls, chain_name, host))
+
+    def vacuum_orphans(self) -> dict:
+        return self._write('POST', '/vacuum/orphans')
+
+    # # # SNAPSHOTS # # #
+
+    def download_snapshot(self, path: str) -> bool:
+        """Download a snapshot of the database to path, unless the snapshot already there is current.
+
+        The snapshot's ETag is kept next to it, in '<path>.etag', to make the request conditional.
+        A new snapshot is written beside the old one and swapped in atomically, so that readers never
+        see a partial file. Returns whether a new snapshot was swapped in.
+        """
+        path = Path(path)
+        etag_path = path.with_name(path.name + '.etag')
+        headers = {}
+        if path.exists() and etag_path.exists():
+            headers['If-None-Match'] = etag_path.read_text(encoding='utf-8').strip()
+        with self.session.get(self.url + '/snapshot', headers=headers, timeout=self.timeout, stream=True) as response:
+            if response.status_code == 304:
+                return False
+            if response.status_code != 200:
+                raise EndpointDBError(response.status_code, response.text)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+            with open(tmp_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=1 << 20):
+                    f.write(chunk)
+            os.replace(tmp_path, path)
+            etag_path.write_text(response.headers.get('ETag', ''), encoding='utf-8')
+        return True
+
+    # # # REQUESTS # # #
+
+    def _get(self, path: str, params: dict = None, none_if_missing: bool = False):
+        url = self.url + path + (f'?{urlencode(params)}' if params else '')
+        cached = self._cached(url)
+        if cached and time.monotonic() - cached['fetched_at'] < self.cache_ttl:
+            return decode_body(cached)
+        headers = {'Accept': ACCEPT}
+        if cached:
+            headers['If-None-Match'] = cached['etag']
+        response = self.session.get(url, headers=headers, timeout=self.timeout)
+        if response.status_code == 304 and cached:
+            cached['fetched_at'] = time.monotonic()
+            return decode_body(cached)
+        if response.status_code == 404 and none_if_missing:
+            return None
+        if response.status_code != 200:
+            raise EndpointDBError(response.status_code, response.text)
+        if response.headers.get('Content-Type', '').startswith(MSGPACK_MIMETYPE):
+            content_type, body = MSGPACK_MIMETYPE, base64.b64encode(response.content).decode()
+        else:
+            content_type, body = 'application/json', response.text
+        if response.headers.get('ETag'):
+            self._store(url, response.headers['ETag'], body, content_type)
+        return decode_body({'content_type': content_type, 'body': body})
+
+    def _write(self, method: str, path: str, **kwargs) -> dict:
+        response = self.session.request(method, self.url + path, headers=self.auth_header(), timeout=self.timeout, **kwargs)
+        if response.status_code == 401:
+            # The token may have been invalidated, e.g. by a new JWT secret key, retry once with a new one
+            with self._lock:
+                self._token = None
+            response = self.session.request(method, self.url + path, headers=self.auth_header(), timeout=self.timeout,
+                                            **kwargs)
+        if response.status_code >= 300:
+            raise EndpointDBError(response.status_code, response.text)
+        try:
+            data = response.json()
+        except ValueError:
+            data = {}
+        # The API responds 200 with an error message when there's nothing to update or delete
+        if isinstance(data, dict) and 'error' in data:
+            raise EndpointDBError(404, str(data['error']))
+        return data
+
+    # # # CACHE # # #
+
+    def _cached(self, url: str):
+        with self._lock:
+            cached = self._cache.get(url)
+        if cached is None and self.cache_dir:
+            try:
+                with open(self._cache_file(url), 'r', encoding='utf-8') as f:
+                    cached = dict(json.load(f), fetched_at=float('-inf'))
+            except (OSError, ValueError):
+                return None
+            if cached.get('content_type') == MSGPACK_MIMETYPE and msgpack is None:
+                return None  # Stored by a client that had msgpack installed
+            with self._lock:
+                self._cache[url] = cached
+        return cached
+
+    def _store(self, url: str, etag: str, body: str, content_type: str) -> None:
+        """Cache a response, whose body is kept as text, base64 encoded if it's msgpack."""
+        entry = {'url': url, 'etag': etag, 'body': body, 'content_type': content_type}
+        with self._lock:
+            self._cache[url] = dict(entry, fetched_at=time.monotonic())
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            cache_file = self._cache_file(url)
+            tmp_file = cache_file.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(entry, f)
+            tmp_file.replace(cache_file)
+
+    def _cache_file(self, url: str) -> Path:
+        return self.cache_dir / f'{hashlib.sha256(url.encode()).hexdigest()}.json'
+
+
+def decode_body(cached: dict):
+    """Decode the body of a cached response, the cache files of older clients only hold JSON."""
+    if cached.get('content_type') == MSGPACK_MIMETYPE:
+        return msgpack.unpackb(base64.b64decode(cached['body']))
+    return json.loads(cached['body'])
+
+
+class EndpointDBSnapshot:
+    """Read-only lookups, in process, in a snapshot of the database downloaded with download_snapshot.
+
+    The snapshot is opened as an immutable, memory mapped SQLite file. Snapshots are swapped by replacing
+    the file, which leaves the open one intact, and reload() switches to the new file when there is one.
+    The connection is shared by the threads doing lookups, so the one reload() switches from is only
+    closed by a later reload, SNAPSHOT_CLOSE_GRACE_S after the switch, or by close().
+    Only enabled RPC URL:s are returned.
+    """
+
+    def __init__(self, path: str, mmap_size: int = 256 * 1024 * 1024):
+        self.path = Path(path).resolve()
+        self.mmap_size = mmap_size
+        self._conn = None
+        self._inode = None
+        self._retired = []  # (time retired, connection) of the connections switched from
+        self._lock = threading.Lock()
+        self.reload()
+
+    def reload(self) -> bool:
+        """Open the snapshot file if it was swapped since it was opened, returns whether it was."""
+        with self._lock:
+            self._close_retired(time.monotonic() - SNAPSHOT_CLOSE_GRACE_S)
+            inode = os.stat(self.path).st_ino
+            if inode == self._inode:
+                return False
+            conn = sqlite3.connect(f'{self.path.as_uri()}?mode=ro&immutable=1', uri=True, check_same_thread=False)
+            conn.execute(f'PRAGMA mmap_size = {int(self.mmap_size)}')
+            old_conn, self._conn, self._inode = self._conn, conn, inode
+            if old_conn:
+                self._retired.append((time.monotonic(), old_conn))
+            return True
+
+    def close(self) -> None:
+        with self._lock:
+            self._close_retired(float('inf'))
+            self._conn.close()
+
+    def _close_retired(self, retired_before: float) -> None:
+        """Close the connections retired before the time, of time.monotonic()."""
+        kept = []
+        for retired_at, conn in self._retired:
+            if retired_at < retired_before:
+                conn.close()
+            else:
+                kept.append((retired_at, conn))
+        self._retired = kept
+
+    def version(self) -> str:
+        """Return the data version of the snapshot, the same as the ETag it was served with."""
+        meta = dict(self._conn.execute('SELECT key, value FROM meta').fetchall())
+        return f'{meta["generation"]}-{meta["data_version"]}'
+
+    def urls(self, chain_name: str) -> list:
+        rows = self._conn.execute('SELECT url FROM rpc_urls WHERE chain_name = ? AND enabled = 1', (chain_name,))
+        return [row[0] for row in rows]
+
+    def chain_by_name(self, name: str):
+        row = self._conn.execute('SELECT name, api_class FROM chains WHERE name = ?', (name,)).fetchone()
+        return {'name': row[0], 'api_class': row[1]} if row else None
+
+    def chain_by_url(self, url: str):
+        row = self._conn.execute(
+            'SELECT c.name, c.api_class FROM chains c JOIN rpc_urls r ON c.name = r.chain_name WHERE r.url = ? AND r.enabled = 1',
+            (url,)).fetchone()
+        return {'name': row[0], 'api_class': row[1]} if row else None
+
+    def urls_by_host(self, host: str) -> list:
+        """Return the RPC URL records of the host or provider."""
+        rows = self._conn.execute('SELECT url, chain_name FROM rpc_urls WHERE (host = ? OR provider = ?) AND enabled = 1',
+                                  (host.lower(), host.lower()))
+        return [{'url': row[0], 'chain_name': row[1]} for row in rows]
+
+
+# # # UTILS # # #
+
+def split_url(url: str) -> dict:
+    """Split an RPC URL into the 'protocol' and 'address' parameters the API identifies URL:s by."""
+    if '://' not in url:
+        raise ValueError(f'Invalid RPC URL {url}, expected <protocol>://<address>')
+    protocol, address = url.split('://', 1)
+    return {'protocol': protocol, 'address': address}
+
+
+def path_segment(value) -> str:
+    """Quote a value for a path segment of a route, so a '/', '?' or '#' in it doesn't change the route."""
+    return quote(str(value), safe='')
+
+
+def include_disabled_params(include_disabled: bool) -> dict:
+    return {'include_disabled': 'true'} if include_disabled else {}
+
+
+def rpc_url_selection(urls: list, chain_name: str, host: str) -> dict:
+    selection = {key: value for key, value in (('urls', urls), ('chain_name', chain_name), ('host', host)) if value}
+    if len(selection) != 1:
+        raise ValueError('Exactly one of urls, chain_name or host is required')
+    return selection
+
+
+def token_expiry(token: str) -> float:
+    """Return the expiry time of a JWT, read from its payload without verifying it, or 0 if it has none."""
+    try:
+        payload = token.split('.')[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+        return float(claims.get('exp', 0))
+    except (IndexError, ValueError):
+        return 0.0
@@ -0,0 +1,46 @@
+"""Gunicorn configuration for the endpoint DB API.
+
+Gunicorn loads this file from the working directory of the service, next to app.py, and loads it again
+on a HUP signal. The settings that can change with the charm's config, the address, the number of
+workers and threads, the write batching window and whether to send Server-Timing headers, are read from gunicorn_settings.json rather than given on the command line, so that a reload
+applies them: the master starts new workers with the new code and settings, and lets the old ones
+finish their requests before they exit.
+"""
+
+import json
+from pathlib import Path
+
+from prometheus_client import multiprocess
+
+PATH_DIR = Path(__file__).resolve().parent
+PATH_DB = PATH_DIR / "live_database.db"
+PATH_SETTINGS = PATH_DIR / "gunicorn_settings.json"
+
+# Time given to old workers to finish their requests on reload and shutdown
+graceful_timeout = 30
+# The default format, followed by the request's ID, see REQUEST_ID_HEADER in app.py, and its duration in milliseconds
+access_log_format = '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s" %({x-request-id}o)s %(M)sms'
+
+if PATH_SETTINGS.exists():
+    SETTINGS = json.loads(PATH_SETTINGS.read_text(encoding="utf-8"))
+    bind = SETTINGS["bind"]
+    workers = SETTINGS["workers"]
+    threads = SETTINGS.get("threads", 1)
+    # Read by app.py, see WriteQueue and record_request_metrics
+    raw_env = [
+        f"ENDPOINTDB_WRITE_BATCH_MS={SETTINGS.get('write_batch_ms', 0)}",
+        f"ENDPOINTDB_SERVER_TIMING={int(SETTINGS.get('server_timing', False))}",
+    ]
+
+
+def on_starting(server):
+    """Initialize the database schema once, in the master process before any worker loads the app."""
+    # Imported here, Gunicorn puts the working directory on the path after loading this file
+    from db_schema import init_database
+
+    init_database(str(PATH_DB))
+
+
+def child_exit(server, worker):
+    """Mark the metrics of an exited worker as dead, so that they're aggregated correctly."""
+    multiprocess.mark_process_dead(worker.pid)
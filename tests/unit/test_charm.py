@@ -3,66 +3,403 @@
 #
 # Learn more about testing at: https://juju.is/docs/sdk/testing
 
+import json
+import os
+import subprocess as sp
+import tempfile
 import unittest
+from pathlib import Path
+from unittest import mock
 
 import ops
 import ops.testing
-from charm import EndpointdbCharm
+import requests
 
+import constants as c
+import util
+from charm import EndpointDBCharm
+
+TEMPLATES_PATH = Path(__file__).resolve().parents[2] / 'templates'
+SUBPROCESS_RUN = sp.run
+
+
+class CharmTestCase(unittest.TestCase):
+    """Runs the charm in a Harness, with the functions of util.py that touch the machine patched."""
 
-class TestCharm(unittest.TestCase):
     def setUp(self):
-        self.harness = ops.testing.Harness(EndpointdbCharm)
+        self.harness = ops.testing.Harness(EndpointDBCharm)
         self.addCleanup(self.harness.cleanup)
+        # Leader elections and peer relation changes configure replication, in a temporary directory
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.patch(c, 'REPLICATION_PATH', Path(tmp_dir.name) / 'replication.json')
+        self.patch(c, 'REPLICA_ETAG_PATH', Path(tmp_dir.name) / 'live_database.db.etag')
+        self.systemctl = self.patch(util.sp, 'run')
         self.harness.begin()
 
-    def test_httpbin_pebble_ready(self):
-        # Expected plan after Pebble ready with default config
-        expected_plan = {
-            "services": {
-                "httpbin": {
-                    "override": "replace",
-                    "summary": "httpbin",
-                    "command": "gunicorn -b 0.0.0.0:80 httpbin:app -k gevent",
-                    "startup": "enabled",
-                    "environment": {"GUNICORN_CMD_ARGS": "--log-level info"},
-                }
-            },
-        }
-        # Simulate the container coming up and emission of pebble-ready event
-        self.harness.container_pebble_ready("httpbin")
-        # Get the plan now we've run PebbleReady
-        updated_plan = self.harness.get_container_pebble_plan("httpbin").to_dict()
-        # Check we've got the plan we expected
-        self.assertEqual(expected_plan, updated_plan)
-        # Check the service was started
-        service = self.harness.model.unit.get_container("httpbin").get_service("httpbin")
-        self.assertTrue(service.is_running())
-        # Ensure we set an ActiveStatus with no message
-        self.assertEqual(self.harness.model.unit.status, ops.ActiveStatus())
-
-    def test_config_changed_valid_can_connect(self):
-        # Ensure the simulated Pebble API is reachable
-        self.harness.set_can_connect("httpbin", True)
-        # Trigger a config-changed event with an updated value
-        self.harness.update_config({"log-level": "debug"})
-        # Get the plan now we've run PebbleReady
-        updated_plan = self.harness.get_container_pebble_plan("httpbin").to_dict()
-        updated_env = updated_plan["services"]["httpbin"]["environment"]
-        # Check the config change was effective
-        self.assertEqual(updated_env, {"GUNICORN_CMD_ARGS": "--log-level debug"})
-        self.assertEqual(self.harness.model.unit.status, ops.ActiveStatus())
-
-    def test_config_changed_valid_cannot_connect(self):
-        # Trigger a config-changed event with an updated value
-        self.harness.update_config({"log-level": "debug"})
-        # Check the charm is in WaitingStatus
-        self.assertIsInstance(self.harness.model.unit.status, ops.WaitingStatus)
-
-    def test_config_changed_invalid(self):
-        # Ensure the simulated Pebble API is reachable
-        self.harness.set_can_connect("httpbin", True)
-        # Trigger a config-changed event with an updated value
-        self.harness.update_config({"log-level": "foobar"})
-        # Check the charm is in BlockedStatus
-        self.assertIsInstance(self.harness.model.unit.status, ops.BlockedStatus)
+    def patch(self, target, name: str, *args, **kwargs) -> mock.MagicMock:
+        patcher = mock.patch.object(target, name, *args, **kwargs)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def patch_util(self, name: str, **kwargs) -> mock.MagicMock:
+        return self.patch(util, name, **kwargs)
+
+
+class TestInstallAndStart(CharmTestCase):
+    def test_install_initializes_database_before_import(self):
+        calls = mock.MagicMock()
+        for name in ('install_apt_dependencies', 'install_python_dependencies', 'generate_auth_files', 'update_service_args',
+                     'init_database', 'import_database'):
+            calls.attach_mock(self.patch_util(name), name)
+        with mock.patch.object(EndpointDBCharm, 'install_files'):
+            self.harness.add_resource('rpc-chains', '[]')
+            self.harness.add_resource('rpc-urls', '[]')
+            self.harness.charm.on.install.emit()
+        names = [call[0] for call in calls.mock_calls]
+        self.assertLess(names.index('init_database'), names.index('import_database'))
+        self.assertEqual(self.harness.model.unit.status, ops.ActiveStatus('Installation complete'))
+
+    def test_start_waits_until_ready(self):
+        start_service = self.patch_util('start_service')
+        self.patch_util('wait_until_ready', return_value=True)
+        self.harness.charm.on.start.emit()
+        start_service.assert_called_once_with(c.SERVICE_NAME)
+        self.assertEqual(self.harness.model.unit.status, ops.ActiveStatus('Service running'))
+
+    def test_start_not_ready(self):
+        self.patch_util('start_service')
+        self.patch_util('wait_until_ready', return_value=False)
+        self.harness.charm.on.start.emit()
+        self.assertEqual(self.harness.model.unit.status, ops.WaitingStatus('Service not ready'))
+
+
+class TestReload(CharmTestCase):
+    def test_upgrade_reloads_service(self):
+        calls = mock.MagicMock()
+        for name in ('update_service_args', 'init_database', 'reload_service', 'restart_service', 'wait_until_ready'):
+            calls.attach_mock(self.patch_util(name), name)
+        calls.wait_until_ready.return_value = True
+        with mock.patch.object(EndpointDBCharm, 'install_files') as install_files:
+            self.harness.charm.on.upgrade_charm.emit()
+        install_files.assert_called_once()
+        # The settings are written without a reload of their own, the service is reloaded once after the migration
+        self.assertEqual([call[0] for call in calls.mock_calls], ['update_service_args', 'init_database', 'reload_service',
+                                                                   'wait_until_ready'])
+        self.assertFalse(calls.update_service_args.call_args.args[3])
+        calls.reload_service.assert_called_once_with(c.SERVICE_NAME)
+        self.assertEqual(self.harness.model.unit.status, ops.ActiveStatus('Service running'))
+
+    def test_config_changed_reloads_service(self):
+        update_service_args = self.patch_util('update_service_args')
+        self.harness.update_config({'write-batch-ms': 5.0, 'server-timing': True})
+        args, kwargs = update_service_args.call_args
+        self.assertEqual(args, (self.harness.charm.config['wsgi-server-port'], c.SERVICE_NAME, c.GUNICORN_HARDCODED_ARGS, True))
+        self.assertEqual(kwargs, {'write_batch_ms': 5.0, 'server_timing': True})
+
+    def test_reload_service(self):
+        with mock.patch('subprocess.run') as run:
+            util.reload_service(c.SERVICE_NAME)
+        run.assert_called_once_with(['systemctl', 'reload-or-restart', f'{c.SERVICE_NAME}.service'], check=False)
+
+
+class TestBackupActions(CharmTestCase):
+    def test_backup(self):
+        def backup(args, **kwargs):
+            # Stands in for db_util.py, which writes the backup and its checksum file
+            target = Path(args[args.index('--target') + 1])
+            target.write_bytes(b'backup')
+            target.with_name(target.name + '.sha256').write_text(f'{"ab" * 32}  {target.name}\n', encoding='utf-8')
+
+        with tempfile.TemporaryDirectory() as tmp_dir, mock.patch('subprocess.run', side_effect=backup) as run:
+            output = self.harness.run_action('backup', {'target-dir': tmp_dir, 'pages': 16})
+            args = run.call_args.args[0]
+            self.assertEqual(args[:3], ['python3', c.DB_UTIL_SCRIPT_PATH, 'backup'])
+            self.assertEqual(args[args.index('--pages') + 1], '16')
+            self.assertEqual(output.results['sha256'], 'ab' * 32)
+            self.assertEqual(output.results['size'], 6)
+            self.assertRegex(output.results['path'], rf'^{tmp_dir}/endpointdb-\d{{8}}T\d{{6}}Z\.db\.gz$')
+
+    def test_backup_failure(self):
+        with mock.patch('subprocess.run', side_effect=sp.CalledProcessError(1, 'db_util.py')):
+            with self.assertRaises(ops.testing.ActionFailed) as failure:
+                self.harness.run_action('backup', {'target-dir': '/tmp', 'pages': 16})
+        self.assertIn('Unable to back up database', failure.exception.message)
+
+    def test_restore(self):
+        self.harness.set_leader(True)
+        restore_database = self.patch_util('restore_database')
+        output = self.harness.run_action('restore', {'backup-file': '/tmp/backup.db.gz'})
+        restore_database.assert_called_once_with('/tmp/backup.db.gz')
+        self.assertEqual(output.results, {'restored-from': '/tmp/backup.db.gz'})
+
+    def test_restore_checksum_mismatch(self):
+        self.harness.set_leader(True)
+        stderr = 'Traceback (most recent call last):\n...\nValueError: Checksum mismatch for /tmp/backup.db.gz\n'
+        with mock.patch('subprocess.run', side_effect=sp.CalledProcessError(1, 'db_util.py', stderr=stderr)) as run:
+            with self.assertRaises(ops.testing.ActionFailed) as failure:
+                self.harness.run_action('restore', {'backup-file': '/tmp/backup.db.gz'})
+        self.assertEqual(run.call_args.args[0][2:4], ['restore', '/tmp/backup.db.gz'])
+        self.assertEqual(failure.exception.message, 'Unable to restore database: ValueError: Checksum mismatch for /tmp/backup.db.gz')
+
+    def test_restore_on_replica(self):
+        relation_id = self.harness.add_relation(c.PEER_RELATION, self.harness.charm.app.name)
+        self.harness.update_relation_data(relation_id, self.harness.charm.app.name, {'writer-url': 'http://10.0.0.1:8000'})
+        restore_database = self.patch_util('restore_database')
+        with self.assertRaises(ops.testing.ActionFailed) as failure:
+            self.harness.run_action('restore', {'backup-file': '/tmp/backup.db.gz'})
+        self.assertIn('read-only replica', failure.exception.message)
+        restore_database.assert_not_called()
+
+
+class TestDatabaseActions(CharmTestCase):
+    """The database actions, run by the charm's copy of db_util.py on a temporary database."""
+
+    def setUp(self):
+        super().setUp()
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.patch(c, 'HOME_PATH', Path(tmp_dir.name))
+        self.patch(c, 'DATABASE_PATH', Path(tmp_dir.name) / 'live_database.db')
+        self.patch(c, 'DB_UTIL_SCRIPT_PATH', TEMPLATES_PATH / 'db_util.py')
+        self.systemctl.side_effect = SUBPROCESS_RUN
+        util.init_database()
+
+    def run_action(self, name: str, params: dict = None) -> dict:
+        return self.harness.run_action(name, params or {}).results
+
+    def add_polkadot(self):
+        self.run_action('add-chains', {'chains': json.dumps([{'name': 'Polkadot', 'api_class': 'substrate'}])})
+        self.run_action('add-rpc-urls', {'rpc-urls': json.dumps([{'url': 'wss://rpc.polkadot.io', 'chain_name': 'Polkadot'}])})
+
+    def test_add_and_list(self):
+        self.add_polkadot()
+        results = self.run_action('add-chains', {'chains': json.dumps([{'name': 'Polkadot', 'api_class': 'substrate'},
+                                                                       {'name': 'Kusama', 'api_class': 'substrate'}])})
+        self.assertEqual(results, {'added': 1, 'skipped': 1})
+        results = self.run_action('list-chains')
+        self.assertEqual([chain['name'] for chain in json.loads(results['chains'])], ['Kusama', 'Polkadot'])
+        self.assertEqual(results['count'], 2)
+        results = self.run_action('list-rpc-urls', {'chain': 'Polkadot'})
+        self.assertEqual([rpc_url['url'] for rpc_url in json.loads(results['rpc-urls'])], ['wss://rpc.polkadot.io'])
+        results = self.run_action('chain-info', {'chain': 'Polkadot'})
+        self.assertEqual(results, {'chain-name': 'Polkadot', 'api-class': 'substrate', 'urls': '["wss://rpc.polkadot.io"]'})
+
+    def test_chain_info_not_found(self):
+        with self.assertRaises(ops.testing.ActionFailed) as failure:
+            self.run_action('chain-info', {'chain': 'Polkadot'})
+        self.assertEqual(failure.exception.message, "Chain 'Polkadot' not found in database")
+
+    def test_invalid_batch_adds_nothing(self):
+        chains = [{'name': 'Polkadot', 'api_class': 'substrate'}, {'name': 'Invalid', 'api_class': 'bitcoin'}]
+        with self.assertRaises(ops.testing.ActionFailed) as failure:
+            self.run_action('add-chains', {'chains': json.dumps(chains)})
+        self.assertEqual(failure.exception.message, 'Unable to add chains, none were added: Invalid api class bitcoin of chain Invalid')
+        self.assertEqual(self.run_action('list-chains')['count'], 0)
+
+    def test_not_a_list(self):
+        with self.assertRaises(ops.testing.ActionFailed) as failure:
+            self.run_action('delete-chains', {'chains': '"Polkadot"'})
+        self.assertIn('Expected a JSON list', failure.exception.message)
+
+    def test_delete(self):
+        self.add_polkadot()
+        self.assertEqual(self.run_action('delete-rpc-urls', {'urls': '["wss://rpc.polkadot.io"]'}), {'deleted': 1})
+        self.assertEqual(self.run_action('delete-chains', {'chains': '["Polkadot"]'}), {'deleted-chains': 1, 'deleted-urls': 0})
+        self.assertEqual(self.run_action('list-chains')['count'], 0)
+
+    def test_import_json_skips_existing(self):
+        self.add_polkadot()
+        chains = [{'name': 'Polkadot', 'api_class': 'ethereum'}, {'name': 'Kusama', 'api_class': 'substrate'}]
+        rpc_urls = [{'url': 'wss://kusama-rpc.polkadot.io', 'chain_name': 'Kusama'}, {'url': 'wss://rpc.astar.network', 'chain_name': 'Astar'}]
+        results = self.run_action('import-json', {'chains': json.dumps(chains), 'rpc-urls': json.dumps(rpc_urls), 'upsert': False})
+        self.assertEqual(results, {'chains': 1, 'rpc-urls': 1, 'skipped-chains': 1, 'skipped-rpc-urls': 0, 'skipped-orphans': 1,
+                                   'missing-chains': '["astar"]'})
+        # Without upsert the existing chain isn't overwritten
+        self.assertEqual(self.run_action('chain-info', {'chain': 'Polkadot'})['api-class'], 'substrate')
+
+    def test_import_json_upsert(self):
+        self.add_polkadot()
+        chains = json.dumps([{'name': 'Polkadot', 'api_class': 'ethereum'}])
+        results = self.run_action('import-json', {'chains': chains, 'upsert': True})
+        self.assertEqual((results['chains'], results['skipped-chains']), (1, 0))
+        self.assertEqual(self.run_action('chain-info', {'chain': 'Polkadot'})['api-class'], 'ethereum')
+
+    def test_import_json_invalid_imports_nothing(self):
+        rpc_urls = json.dumps([{'url': 'not a url', 'chain_name': 'Polkadot'}])
+        with self.assertRaises(ops.testing.ActionFailed) as failure:
+            self.run_action('import-json', {'chains': '[{"name": "Polkadot", "api_class": "substrate"}]', 'rpc-urls': rpc_urls})
+        self.assertIn('nothing was imported', failure.exception.message)
+        self.assertEqual(self.run_action('list-chains')['count'], 0)
+
+
+class TestProfilingActions(CharmTestCase):
+    def setUp(self):
+        super().setUp()
+        self.patch_util('get_access_token', return_value='token')
+        self.patch_util('time', **{'monotonic.return_value': 0})
+
+    def response(self, status_code: int, json: dict = None, text: str = '') -> mock.MagicMock:
+        response = mock.MagicMock(status_code=status_code, text=text)
+        response.json.return_value = json
+        return response
+
+    def test_profile(self):
+        started = self.response(202, {'id': 'abc123', 'pid': 42})
+        polls = [self.response(202), self.response(200, text='MainThread;app.py:run 3\nworker;db.py:query 1\n')]
+        with mock.patch('requests.post', return_value=started) as post, mock.patch('requests.get', side_effect=polls) as get:
+            output = self.harness.run_action('profile', {'duration': 5, 'interval-ms': 10})
+        self.assertEqual(post.call_args.kwargs['json'], {'duration': 5, 'interval_ms': 10})
+        self.assertEqual(post.call_args.kwargs['headers'], {'Authorization': 'Bearer token'})
+        self.assertTrue(get.call_args.args[0].endswith('/profile/abc123'))
+        self.assertEqual(output.results, {'path': str(c.PROFILES_PATH / 'abc123.folded'), 'pid': 42, 'stacks': 2})
+
+    def test_profile_already_running(self):
+        with mock.patch('requests.post', return_value=self.response(409, text='A profile is already running')):
+            with self.assertRaises(ops.testing.ActionFailed) as failure:
+                self.harness.run_action('profile', {'duration': 5, 'interval-ms': 10})
+        self.assertIn('A profile is already running', failure.exception.message)
+
+    def test_profile_times_out(self):
+        util.time.monotonic.side_effect = [0, 0, 100]
+        with mock.patch('requests.post', return_value=self.response(202, {'id': 'abc123', 'pid': 42})), \
+                mock.patch('requests.get', return_value=self.response(202)):
+            with self.assertRaises(ops.testing.ActionFailed) as failure:
+                self.harness.run_action('profile', {'duration': 5, 'interval-ms': 10})
+        self.assertIn("didn't finish in time", failure.exception.message)
+
+
+    def test_set_query_profiling(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                mock.patch.object(c, 'QUERY_PROFILING_PATH', Path(tmp_dir) / 'query_profiling.json'):
+            output = self.harness.run_action('set-query-profiling', {'enabled': True, 'threshold-ms': 25})
+            self.assertEqual(json.loads(c.QUERY_PROFILING_PATH.read_text()), {'enabled': True, 'threshold_ms': 25})
+            self.assertEqual(os.listdir(tmp_dir), ['query_profiling.json'])
+        self.assertEqual(output.results, {'enabled': True, 'threshold-ms': 25})
+
+    def test_set_query_profiling_negative_threshold(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                mock.patch.object(c, 'QUERY_PROFILING_PATH', Path(tmp_dir) / 'query_profiling.json'):
+            with self.assertRaises(ops.testing.ActionFailed) as failure:
+                self.harness.run_action('set-query-profiling', {'enabled': True, 'threshold-ms': -1})
+            self.assertFalse(c.QUERY_PROFILING_PATH.exists())
+        self.assertIn('must not be negative', failure.exception.message)
+
+
+class TestUpdateStatus(CharmTestCase):
+    def setUp(self):
+        super().setUp()
+        self.harness.set_leader(True)
+        self.service_running = self.patch_util('service_running', return_value=True)
+        self.check_readiness = self.patch_util('check_readiness', return_value=(True, []))
+
+    def test_service_not_started(self):
+        self.service_running.return_value = False
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.harness.model.unit.status, ops.WaitingStatus('Service not yet started'))
+        self.check_readiness.assert_not_called()
+
+    def test_failing_checks(self):
+        self.check_readiness.return_value = (False, ['schema', 'cache'])
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.harness.model.unit.status, ops.WaitingStatus('Service not ready, failing: schema, cache'))
+
+    def test_unknown_failure(self):
+        self.check_readiness.return_value = (False, [])
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.harness.model.unit.status, ops.WaitingStatus('Service not ready, failing: unknown'))
+
+    def test_ready(self):
+        self.harness.charm.on.update_status.emit()
+        self.check_readiness.assert_called_once_with(self.harness.charm.config['wsgi-server-port'])
+        self.assertEqual(self.harness.model.unit.status, ops.ActiveStatus('Service running'))
+
+
+class TestReplication(CharmTestCase):
+    """The unit's status and whether it takes writes follow the same replication settings as the app's."""
+
+    WRITER_URL = 'http://10.0.0.1:8000'
+
+    def setUp(self):
+        super().setUp()
+        self.patch_util('service_running', return_value=True)
+        self.patch_util('check_readiness', return_value=(True, []))
+        self.load_json_list = self.patch_util('load_json_list', side_effect=ValueError('Stop before writing'))
+        self.relation_id = self.harness.add_relation(c.PEER_RELATION, self.harness.charm.app.name)
+
+    def publish_writer_url(self):
+        self.harness.update_relation_data(self.relation_id, self.harness.charm.app.name, {'writer-url': self.WRITER_URL})
+
+    def timer_call(self, command: str, timer_name: str):
+        return mock.call(['systemctl', command, '--now', f'{timer_name}.timer'], check=False)
+
+    def assert_writable(self, writable: bool):
+        with self.assertRaises(ops.testing.ActionFailed) as failure:
+            self.harness.run_action('add-chains', {'chains': '[]'})
+        self.assertEqual(self.load_json_list.called, writable, failure.exception.message)
+
+    def test_leader(self):
+        self.harness.set_leader(True)
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.harness.model.unit.status, ops.ActiveStatus('Service running'))
+        self.assertFalse(c.REPLICATION_PATH.exists())
+        self.assert_writable(True)
+        # The writer identifies new chains periodically
+        self.assertIn(self.timer_call('enable', c.IDENTIFY_SERVICE_NAME), self.systemctl.call_args_list)
+
+    def test_non_leader_without_writer_url(self):
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.harness.model.unit.status, ops.WaitingStatus("Service running, waiting for the leader's writer URL"))
+        self.assertFalse(c.REPLICATION_PATH.exists())
+        self.assert_writable(True)
+
+    def test_non_leader_with_writer_url(self):
+        self.publish_writer_url()
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.harness.model.unit.status,
+                         ops.ActiveStatus(f'Service running, read-only replica of {self.WRITER_URL}'))
+        # The app rejects writes when the settings it reads hold a writer URL
+        self.assertEqual(json.loads(c.REPLICATION_PATH.read_text()), {'writer_url': self.WRITER_URL})
+        self.assertEqual(self.systemctl.call_args, self.timer_call('enable', c.REPLICA_SERVICE_NAME))
+        self.assertIn(self.timer_call('disable', c.IDENTIFY_SERVICE_NAME), self.systemctl.call_args_list)
+        self.assertNotIn(self.timer_call('enable', c.IDENTIFY_SERVICE_NAME), self.systemctl.call_args_list)
+        self.assert_writable(False)
+
+    def test_replica_elected_leader(self):
+        self.publish_writer_url()
+        self.harness.set_leader(True)
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.harness.model.unit.status, ops.ActiveStatus('Service running'))
+        self.assertFalse(c.REPLICATION_PATH.exists())
+        self.assert_writable(True)
+
+
+class TestReadiness(unittest.TestCase):
+    """The readiness polling of util.py, against a mocked /readyz."""
+
+    def readyz(self, status_code: int, checks: dict) -> mock.MagicMock:
+        response = mock.MagicMock(status_code=status_code)
+        response.json.return_value = {'ready': status_code == 200, 'checks': checks}
+        return response
+
+    def test_check_readiness(self):
+        checks = {'database': {'ok': True}, 'schema': {'ok': False}, 'load': {'ok': False}}
+        with mock.patch('requests.get', return_value=self.readyz(503, checks)) as get:
+            self.assertEqual(util.check_readiness('8000', timeout=1), (False, ['schema', 'load']))
+        get.assert_called_once_with('http://localhost:8000/readyz', timeout=1)
+
+    def test_check_readiness_unreachable(self):
+        with mock.patch('requests.get', side_effect=requests.exceptions.ConnectionError()):
+            self.assertEqual(util.check_readiness('8000'), (False, ['unreachable']))
+
+    def test_wait_until_ready(self):
+        responses = [requests.exceptions.ConnectionError(), self.readyz(503, {}), self.readyz(200, {'database': {'ok': True}})]
+        with mock.patch('requests.get', side_effect=responses) as get, mock.patch('time.sleep'):
+            self.assertTrue(util.wait_until_ready('8000', timeout=30))
+        self.assertEqual(get.call_count, 3)
+
+    def test_wait_until_ready_times_out(self):
+        clock = iter(range(0, 100, 10))
+        with mock.patch('requests.get', return_value=self.readyz(503, {})), mock.patch('time.sleep'), \
+                mock.patch('time.monotonic', side_effect=lambda: next(clock)):
+            self.assertFalse(util.wait_until_ready('8000', timeout=30))